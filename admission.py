@@ -0,0 +1,310 @@
+# Per-worker admission control: per-route concurrency limits, read priority and per-project rate limits
+import asyncio
+import json
+import math
+import re
+import time
+from collections import OrderedDict, deque
+from starlette.responses import JSONResponse
+
+# Reasons a request is turned away
+QUEUE_FULL = "queue_full"
+QUEUE_TIMEOUT = "queue_timeout"
+RATE_LIMITED = "rate_limited"
+
+# Priority classes: reads (GET/HEAD) are admitted before writes
+READ = 0
+WRITE = 1
+
+class Slots:
+    """
+    A concurrency limit with a bounded FIFO wait queue per priority class.
+    A freed slot goes to the oldest waiting read, then the oldest waiting write.
+    `reserved` slots can only be taken by reads, so writes can never fill the limit.
+    Only touched from the event loop thread.
+    """
+
+    def __init__(self, limit, queue_size, reserved=0):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.reserved = reserved
+        self.in_flight = 0
+        self._queues = (deque(), deque())
+
+    def waiting(self, priority=None):
+        if priority is not None:
+            return len(self._queues[priority])
+        return len(self._queues[READ]) + len(self._queues[WRITE])
+
+    def _room(self, priority):
+        return self.in_flight < self.limit - (self.reserved if priority == WRITE else 0)
+
+    async def acquire(self, priority, timeout):
+        """
+        Take a slot, waiting up to timeout seconds behind earlier requests of the same or a higher priority.
+        Returns:
+            str or None: None once a slot is held, else QUEUE_FULL or QUEUE_TIMEOUT
+        """
+        ahead = self.waiting(READ) if priority == READ else self.waiting()
+        if not ahead and self._room(priority):
+            self.in_flight += 1
+            return None
+        if self.waiting() >= self.queue_size:
+            return QUEUE_FULL
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[priority].append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return None
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended
+                self.release()
+            else:
+                try:
+                    self._queues[priority].remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return QUEUE_TIMEOUT
+
+    def release(self):
+        self.in_flight -= 1
+        for queue in self._queues:
+            while queue and self._room(READ if queue is self._queues[READ] else WRITE):
+                waiter = queue.popleft()
+                if not waiter.done():
+                    self.in_flight += 1
+                    waiter.set_result(None)
+
+class RouteLimit:
+    """
+    Admission settings of one route template. `path` doubles as the route label
+    MetricsMiddleware reads from scope["route"] for requests rejected before routing.
+    """
+
+    def __init__(self, path, limit=None, queue_size=0, rate_limited=False):
+        self.path = path
+        self.slots = Slots(limit, queue_size) if limit else None
+        self.rate_limited = rate_limited
+        self.admitted = 0
+        self.rejected = {QUEUE_FULL: 0, QUEUE_TIMEOUT: 0, RATE_LIMITED: 0}
+
+class ProjectRateLimiter:
+    """
+    Token bucket per projectId: `rate` tokens a second up to `burst`. Buckets of
+    the least recently seen projects are dropped beyond max_projects; a dropped
+    project starts again with a full bucket.
+    """
+
+    def __init__(self, rate, burst, max_projects):
+        self.rate = rate
+        self.burst = burst
+        self.max_projects = max_projects
+        self._buckets = OrderedDict()   # projectId -> (tokens, updated at)
+
+    def take(self, projectId):
+        """
+        Spend one token of the project's bucket.
+        Returns:
+            float: 0 if the request may go ahead, else seconds until a token is available
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(projectId, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0.0
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[projectId] = (tokens, now)
+        if len(self._buckets) > self.max_projects:
+            self._buckets.popitem(last=False)
+        return wait
+
+class AdmissionController:
+    """
+    Decides which requests a worker runs now, queues or turns away. A request to a
+    limited route needs a slot of its route and one of the worker-wide limit shared
+    by every limited route. Routes without settings are never held back.
+    """
+
+    def __init__(self, route_limits, max_in_flight, read_reserved, queue_timeout, retry_after,
+                 rate_limiter=None, rate_limited_routes=()):
+        """
+        Args:
+            route_limits(dict): Route template -> (limit, queue size)
+            max_in_flight(int): Worker-wide limit (0 = none)
+            read_reserved(int): Worker-wide slots only reads may use
+            queue_timeout(float): Longest wait for a slot, in seconds
+            retry_after(int): Retry-After sent with 503 responses
+            rate_limiter(ProjectRateLimiter): Per-project token buckets, or None
+            rate_limited_routes(list): Route templates whose JSON body projectId is rate limited
+        """
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.rate_limiter = rate_limiter
+        self.worker = Slots(max_in_flight, sum(queue for _, queue in route_limits.values()), read_reserved) if max_in_flight else None
+        self.routes = {}
+        for path, (limit, queue_size) in route_limits.items():
+            self.routes[path] = RouteLimit(path, limit, queue_size)
+        if rate_limiter is not None:
+            for path in rate_limited_routes:
+                self.routes.setdefault(path, RouteLimit(path)).rate_limited = True
+        self._exact = {path: route for path, route in self.routes.items() if "{" not in path}
+        self._templates = [
+            (re.compile("^" + re.sub(r"\\\{[^/]+?\\\}", "[^/]+", re.escape(path)) + "$"), route)
+            for path, route in self.routes.items() if "{" in path
+        ]
+
+    def match(self, path):
+        """Return the RouteLimit of a request path, or None"""
+        route = self._exact.get(path)
+        if route is None:
+            for pattern, candidate in self._templates:
+                if pattern.match(path):
+                    return candidate
+        return route
+
+    async def admit(self, route, priority):
+        """
+        Take the route's slot and a worker-wide slot.
+        Returns:
+            str or None: None once admitted, else the rejection reason
+        """
+        deadline = time.monotonic() + self.queue_timeout
+        if route.slots is not None:
+            reason = await route.slots.acquire(priority, self.queue_timeout)
+            if reason is not None:
+                return reason
+        if self.worker is not None:
+            try:
+                reason = await self.worker.acquire(priority, max(0.0, deadline - time.monotonic()))
+            except asyncio.CancelledError:
+                if route.slots is not None:
+                    route.slots.release()
+                raise
+            if reason is not None:
+                if route.slots is not None:
+                    route.slots.release()
+                return reason
+        return None
+
+    def release(self, route):
+        if self.worker is not None:
+            self.worker.release()
+        if route.slots is not None:
+            route.slots.release()
+
+    def stats(self):
+        """
+        Return limits, current load and counters for this worker.
+        Returns:
+            dict: Worker-wide slots, per-route slots and counters, and rate limiter settings
+        """
+        routes = {}
+        for path, route in self.routes.items():
+            routes[path] = {
+                "limit": route.slots.limit if route.slots else None,
+                "queueSize": route.slots.queue_size if route.slots else None,
+                "inFlight": route.slots.in_flight if route.slots else None,
+                "waiting": route.slots.waiting() if route.slots else None,
+                "rateLimited": route.rate_limited,
+                "admitted": route.admitted,
+                "rejected": dict(route.rejected)
+            }
+        return {
+            "worker": {
+                "limit": self.worker.limit,
+                "readReserved": self.worker.reserved,
+                "inFlight": self.worker.in_flight,
+                "waitingReads": self.worker.waiting(READ),
+                "waitingWrites": self.worker.waiting(WRITE)
+            } if self.worker else None,
+            "routes": routes,
+            "projectRateLimit": {
+                "perSecond": self.rate_limiter.rate,
+                "burst": self.rate_limiter.burst
+            } if self.rate_limiter else None
+        }
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return body, message
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body, None
+
+def _project_of(body):
+    try:
+        projectId = json.loads(body).get("projectId")
+    except (ValueError, AttributeError):
+        # Left for request validation to reject
+        return None
+    return projectId if isinstance(projectId, str) else None
+
+class AdmissionMiddleware:
+    """
+    Pure ASGI middleware applying an AdmissionController before routing, so a
+    rejected request costs no database call. A request holds its slots until
+    the last chunk of its response is sent. Rate-limited routes have their
+    body read here (and replayed to the app) to find the projectId.
+    """
+
+    def __init__(self, app, controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = self.controller.match(scope["path"])
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        if route.rate_limited:
+            body, disconnect = await _read_body(receive)
+            if disconnect is not None:
+                return
+            projectId = _project_of(body)
+            wait = self.controller.rate_limiter.take(projectId) if projectId is not None else 0
+            if wait:
+                route.rejected[RATE_LIMITED] += 1
+                await self._reject(scope, receive, send, route, 429, "Too many requests for this project", math.ceil(wait))
+                return
+            replayed = False
+
+            async def receive_replayed():
+                nonlocal replayed
+                if not replayed:
+                    replayed = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                return await receive()
+            receive = receive_replayed
+
+        if route.slots is None and self.controller.worker is None:
+            route.admitted += 1
+            await self.app(scope, receive, send)
+            return
+        priority = READ if scope["method"] in ("GET", "HEAD") else WRITE
+        reason = await self.controller.admit(route, priority)
+        if reason is not None:
+            route.rejected[reason] += 1
+            await self._reject(scope, receive, send, route, 503, "Server is busy, retry later", self.controller.retry_after)
+            return
+        route.admitted += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(route)
+
+    async def _reject(self, scope, receive, send, route, status_code, error, retry_after):
+        scope["route"] = route
+        response = JSONResponse(content={"error": error}, status_code=status_code, headers={"Retry-After": str(retry_after)})
+        await response(scope, receive, send)
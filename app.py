@@ -1,55 +1,195 @@
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.responses import JSONResponse
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import asyncio
+import hashlib
+import json
 from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Optional
 import os
-import hardware_database as hardwareDB
+import hardware_database_async as hardwareDB
+import bulk_io
+import metrics
+from admission import AdmissionController, AdmissionMiddleware, ProjectRateLimiter
 from config import config
+from hardware_cache import hardware_cache
+from hardware_watcher import HardwareWatcher
+from report_cache import report_cache
+from mongo_pool import PoolStatsListener, create_async_mongodb_client
+from readiness import ReadinessProbe
+from storage import HardwareStorage, create_storage
+from waitlist import Waitlist
+from availability_stream import AvailabilityBroadcaster
 from models import (
     CheckoutRequest,
     CheckinRequest,
     CreateHardwareRequest,
-    MessageResponse
+    ShardHardwareRequest,
+    MessageResponse,
+    BatchCheckoutRequest,
+    BatchCheckinRequest,
+    RenewLeaseRequest,
+    BatchItemResult,
+    BatchResponse
 )
 
+def connect_mongodb(app: FastAPI):
+    """Create the pooled client and storage backend. The driver connects lazily, so nothing here waits on the network"""
+    print(f"Connecting to MongoDB with tlsAllowInvalidCertificates={config.mongo_allow_invalid_certs}")
+    print(f"MongoDB pool: maxPoolSize={config.mongo_max_pool_size}, minPoolSize={config.mongo_min_pool_size}, "
+          f"maxIdleTimeMS={config.mongo_max_idle_time_ms}, waitQueueTimeoutMS={config.mongo_wait_queue_timeout_ms}")
+    app.state.mongo_client = create_async_mongodb_client(app.state.pool_stats)
+    app.state.storage = create_storage(app.state.mongo_client)
+
+async def warm_up_mongodb(app: FastAPI):
+    """
+    Open the first pooled connections, ensure indexes and start the optional
+    transaction/watcher features, in the background while the worker already
+    serves requests. Failed attempts are retried with backoff; /readyz reports
+    the worker unready until one succeeds.
+    """
+    client = app.state.mongo_client
+    delay = 1
+    while True:
+        try:
+            # Concurrent pings each take their own connection, so the pool is warm before traffic arrives
+            await asyncio.gather(*(client.admin.command('ping') for _ in range(config.mongo_warmup_connections)))
+            print(f"✓ MongoDB connection successful ({config.mongo_warmup_connections} connections warmed up)")
+            for collection_name, index_name, error in await hardwareDB.ensureIndexes(client):
+                if error:
+                    print(f"⚠ Could not ensure index {collection_name}.{index_name}: {error}")
+                else:
+                    print(f"✓ Index {collection_name}.{index_name} ready")
+            if config.mongo_use_transactions:
+                if await hardwareDB.supportsTransactions(client):
+                    app.state.storage.use_transactions = True
+                    print("✓ Transactional check-out/check-in enabled")
+                else:
+                    print("⚠ MONGO_USE_TRANSACTIONS is set but the server is standalone; using compensating writes")
+            if config.hw_watcher_enabled and app.state.hardware_watcher is None:
+                # Change streams have the same deployment requirement as transactions
+                if await hardwareDB.supportsTransactions(client):
+                    watcher = HardwareWatcher(client)
+                    # Checkout writes from other workers invalidate cached reports as they arrive
+                    watcher.add_listener(report_cache.onChange)
+                    await watcher.start()
+                    app.state.hardware_watcher = watcher
+                    if app.state.broadcaster is not None:
+                        app.state.broadcaster.watch(watcher)
+                    print("✓ Hardware watcher started")
+                else:
+                    print("⚠ HW_WATCHER_ENABLED is set but the server is standalone; reading hardware from the database")
+            app.state.readiness.warmed()
+            return
+        except Exception as e:
+            app.state.readiness.warmed(e)
+            print(f"⚠ MongoDB warm-up failed, retrying in {delay}s: {e}")
+            print(f"MONGO_ALLOW_INVALID_CERTS={os.getenv('MONGO_ALLOW_INVALID_CERTS', 'not set')}")
+            print("Tip: Ensure MONGO_ALLOW_INVALID_CERTS=true is set in your .env file if you're seeing SSL errors")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+async def snapshot_ledger_periodically(storage, interval):
+    """Compact the checkout ledger every `interval` seconds; workers that find a fresh snapshot skip theirs"""
+    last_id = None
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            header = await storage.takeLedgerSnapshot(min_age_seconds=interval * 0.9)
+            if header is not None and header['id'] != last_id:
+                last_id = header['id']
+                print(f"✓ Ledger snapshot {header['id']} covers {header['entries']} entries")
+        except Exception as e:
+            print(f"⚠ Ledger snapshot failed: {e}")
+
+async def sweep_leases_periodically(storage, waitlist, interval):
+    """Return the units of overdue leases every `interval` seconds and hand them to the waitlists"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            result = await storage.expireLeases(batch_size=config.lease_sweep_batch_size)
+            if result['expired']:
+                print(f"✓ Expired {result['expired']} leases, returned {result['units']} units")
+                waitlist.schedule_drain(result['hwSetNames'])
+        except Exception as e:
+            print(f"⚠ Lease sweep failed: {e}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan event handler for startup and shutdown"""
-    # Startup
-    try:
-        # Don't use dependency injection here, create client directly
-        if not config.validate_config():
-            print("⚠ Invalid MongoDB configuration")
-        else:
-            connection_string = config.get_mongodb_connection_string()
-            # MongoDB Atlas (mongodb+srv://) automatically enables TLS
-            # Check if we need to allow invalid certificates (for Docker/development environments)
-            # Default to True for Docker environments to avoid SSL issues
-            allow_invalid_certs_env = os.getenv('MONGO_ALLOW_INVALID_CERTS', 'true').lower()
-            allow_invalid_certs = allow_invalid_certs_env == 'true'
-            
-            print(f"Connecting to MongoDB with tlsAllowInvalidCertificates={allow_invalid_certs}")
-            
-            test_client = MongoClient(
-                connection_string,
-                serverSelectionTimeoutMS=5000,
-                connectTimeoutMS=10000,
-                socketTimeoutMS=20000,
-                tlsAllowInvalidCertificates=allow_invalid_certs
-            )
-            test_client.admin.command('ping')
-            test_client.close()
-            print("✓ MongoDB connection successful")
-    except Exception as e:
-        print(f"⚠ Failed to connect to MongoDB: {e}")
-        print("App will start but database features may not work")
-        print(f"MONGO_ALLOW_INVALID_CERTS={os.getenv('MONGO_ALLOW_INVALID_CERTS', 'not set')}")
-        print("Tip: Ensure MONGO_ALLOW_INVALID_CERTS=true is set in your .env file if you're seeing SSL errors")
+    # Startup: one storage backend per worker (for Mongo, one pooled client), shared by every request
+    app.state.pool_stats = PoolStatsListener()
+    metrics.pool_collector.listener = app.state.pool_stats
+    app.state.mongo_client = None
+    app.state.storage = None
+    app.state.hardware_watcher = None
+    app.state.ledger_snapshotter = None
+    app.state.lease_sweeper = None
+    app.state.waitlist = None
+    app.state.broadcaster = None
+    app.state.warm_up = None
+    app.state.readiness = ReadinessProbe(
+        config.readiness_probe_interval_seconds,
+        config.readiness_probe_timeout_seconds,
+        config.missing
+    )
+    if config.missing:
+        print(f"⚠ Missing required environment variables: {', '.join(config.missing)}; /readyz will report this worker unready")
+    if config.storage_backend == "memory":
+        app.state.storage = create_storage()
+        app.state.readiness.warmed()
+        print("✓ Using the in-memory storage backend (nothing is persisted)")
+    else:
+        try:
+            connect_mongodb(app)
+        except Exception as e:
+            app.state.readiness.warmed(e)
+            print(f"⚠ Failed to create the MongoDB client: {e}")
+            print("App will start but database features may not work")
+    if app.state.storage is not None and config.ledger_snapshot_interval_seconds > 0:
+        app.state.ledger_snapshotter = asyncio.create_task(
+            snapshot_ledger_periodically(app.state.storage, config.ledger_snapshot_interval_seconds)
+        )
+    if app.state.storage is not None:
+        app.state.waitlist = create_waitlist(app.state.storage)
+        app.state.broadcaster = create_broadcaster(app.state.storage)
+        app.state.readiness.start(app.state.storage)
+    if app.state.mongo_client is not None:
+        # Serving starts now; /readyz turns ready once the warm-up is done
+        app.state.warm_up = asyncio.create_task(warm_up_mongodb(app))
+    if app.state.storage is not None and config.lease_sweep_interval_seconds > 0:
+        app.state.lease_sweeper = asyncio.create_task(
+            sweep_leases_periodically(app.state.storage, app.state.waitlist, config.lease_sweep_interval_seconds)
+        )
     
     yield
     
-    # Shutdown (if needed in the future)
-    pass
+    # Shutdown: stop background tasks, then release pooled sockets and monitor threads
+    await app.state.readiness.stop()
+    for task_name in ("warm_up", "lease_sweeper", "ledger_snapshotter"):
+        task = getattr(app.state, task_name)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            setattr(app.state, task_name, None)
+    if app.state.waitlist is not None:
+        await app.state.waitlist.stop()
+        app.state.waitlist = None
+    if app.state.broadcaster is not None:
+        await app.state.broadcaster.stop()
+        app.state.broadcaster = None
+    if app.state.hardware_watcher is not None:
+        await app.state.hardware_watcher.stop()
+        app.state.hardware_watcher = None
+    if app.state.storage is not None:
+        await app.state.storage.close()
+        app.state.storage = None
+        if app.state.mongo_client is not None:
+            app.state.mongo_client = None
+            print("✓ MongoDB client closed")
 
 # Initialize FastAPI application
 app = FastAPI(
@@ -59,112 +199,406 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-def get_mongodb_client():
-    """Get MongoDB client using secure connection string from environment variables"""
-    try:
-        if not config.validate_config():
-            raise ValueError("Invalid MongoDB configuration")
-        
-        connection_string = config.get_mongodb_connection_string()
-        # MongoDB Atlas (mongodb+srv://) automatically enables TLS
-        # Check if we need to allow invalid certificates (for Docker/development environments)
-        # Default to True for Docker environments to avoid SSL issues
-        allow_invalid_certs_env = os.getenv('MONGO_ALLOW_INVALID_CERTS', 'true').lower()
-        allow_invalid_certs = allow_invalid_certs_env == 'true'
-        
-        client = MongoClient(
-            connection_string,
-            serverSelectionTimeoutMS=5000,
-            connectTimeoutMS=10000,
-            socketTimeoutMS=20000,
-            tlsAllowInvalidCertificates=allow_invalid_certs,
-            directConnection=False  # Important for mongodb+srv:// connections
+def create_admission_controller():
+    """The worker's admission controller, or None when ADMISSION_ENABLED is off"""
+    if not config.admission_enabled:
+        return None
+    rate_limiter = None
+    if config.project_rate_limit_per_second > 0:
+        rate_limiter = ProjectRateLimiter(
+            config.project_rate_limit_per_second,
+            config.project_rate_limit_burst,
+            config.project_rate_limit_max_projects
         )
-        
-        return client
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database connection error: {str(e)}")
+    return AdmissionController(
+        config.admission_route_limits,
+        config.admission_max_in_flight,
+        config.admission_read_reserved,
+        config.admission_queue_timeout_seconds,
+        config.admission_retry_after_seconds,
+        rate_limiter,
+        config.project_rate_limit_routes
+    )
+
+# Admission runs inside the metrics middleware, so rejected requests are timed and counted too
+admission_controller = create_admission_controller()
+if admission_controller is not None:
+    app.add_middleware(AdmissionMiddleware, controller=admission_controller)
+    metrics.admission_collector.controller = admission_controller
+app.add_middleware(metrics.MetricsMiddleware)
+
+def create_waitlist(storage):
+    """The worker's waitlist service, with its poll/drain loop running unless WAITLIST_POLL_INTERVAL_SECONDS is 0"""
+    waitlist = Waitlist(storage, config.waitlist_poll_interval_seconds, config.waitlist_drain_interval_seconds)
+    if config.waitlist_poll_interval_seconds > 0:
+        waitlist.start()
+    return waitlist
+
+def create_broadcaster(storage, watcher=None):
+    """The worker's availability broadcaster, fed by its own writes and the watcher or its poll loop"""
+    broadcaster = AvailabilityBroadcaster(storage, config.availability_stream_poll_seconds)
+    broadcaster.start(watcher)
+    return broadcaster
+
+def get_hardware_snapshot():
+    """Return the watcher's in-memory hardware sets if it is running and loaded, else None"""
+    watcher = getattr(app.state, "hardware_watcher", None)
+    if watcher is not None and watcher.ready:
+        return watcher.snapshot
+    return None
+
+def get_storage(request: Request):
+    """Get the shared storage backend created in lifespan"""
+    storage = getattr(request.app.state, "storage", None)
+    if storage is None:
+        # Startup connection failed (or lifespan did not run); try once more lazily
+        try:
+            client = create_async_mongodb_client(request.app.state.pool_stats)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Database connection error: {str(e)}")
+        request.app.state.mongo_client = client
+        storage = request.app.state.storage = create_storage(client)
+    return storage
+
+def get_waitlist(request: Request, storage: HardwareStorage = Depends(get_storage)):
+    """Get the worker's waitlist service, creating it if storage was only connected lazily"""
+    waitlist = getattr(request.app.state, "waitlist", None)
+    if waitlist is None:
+        waitlist = request.app.state.waitlist = create_waitlist(storage)
+    return waitlist
+
+async def get_broadcaster(request: Request, storage: HardwareStorage = Depends(get_storage)):
+    """Get the worker's availability broadcaster, creating it if storage was only connected lazily"""
+    broadcaster = getattr(request.app.state, "broadcaster", None)
+    if broadcaster is None:
+        broadcaster = request.app.state.broadcaster = create_broadcaster(storage)
+    return broadcaster
+
+# Failure outcomes of the data layer mapped to (status code, error message)
+IDEMPOTENCY_ERRORS = {
+    hardwareDB.IDEMPOTENCY_IN_PROGRESS: (409, "A request with this Idempotency-Key is still in progress"),
+    hardwareDB.IDEMPOTENCY_KEY_REUSED: (422, "Idempotency-Key was already used for a different request")
+}
+
+CHECKOUT_ERRORS = {
+    **IDEMPOTENCY_ERRORS,
+    hardwareDB.HW_NOT_FOUND: (404, "Hardware does not exist"),
+    hardwareDB.NOT_ENOUGH_AVAILABLE: (400, "Not enough units available to check out"),
+    hardwareDB.EXCEEDS_CAPACITY: (400, "Requested quantity exceeds the hardware set's capacity"),
+    hardwareDB.RECORD_UPDATE_FAILED: (500, "Failed to update project checkout record")
+}
+
+CHECKIN_ERRORS = {
+    **IDEMPOTENCY_ERRORS,
+    hardwareDB.HW_NOT_FOUND: (404, "Hardware does not exist"),
+    hardwareDB.MORE_THAN_CHECKED_OUT: (400, "Cannot check in more than currently checked out"),
+    hardwareDB.EXCEEDS_CAPACITY: (400, "Too big to check in"),
+    hardwareDB.RECORD_UPDATE_FAILED: (500, "Failed to update project checkout record")
+}
+
+CANCEL_WAIT_ERRORS = {
+    hardwareDB.NO_WAIT_ENTRY: (404, "Waitlist entry does not exist"),
+    hardwareDB.WAIT_FINISHED: (409, "Waitlist entry is already granted, cancelled or expired")
+}
+
+RENEW_ERRORS = {
+    hardwareDB.NO_HOLDING: (404, "Project holds none of this hardware set"),
+    hardwareDB.NOT_LEASED: (409, "This holding has no lease to renew"),
+    hardwareDB.LEASE_EXPIRED: (409, "Lease has already expired")
+}
+
+SHARD_ERRORS = {
+    hardwareDB.HW_NOT_FOUND: (404, "Hardware does not exist"),
+    hardwareDB.ALREADY_SHARDED: (409, "Hardware set is already sharded")
+}
+
+BATCH_ERRORS = {
+    hardwareDB.BATCH_NOT_APPLIED: "Not applied because another item in the batch failed",
+    hardwareDB.BATCH_CONFLICT: "Availability changed concurrently; retry the batch"
+}
+
+def lease_seconds(requested):
+    """
+    The lease for a request: its leaseSeconds, else LEASE_DEFAULT_SECONDS (0 means none).
+    Returns (seconds or None, error response or None).
+    """
+    seconds = requested or config.lease_default_seconds or None
+    if seconds is not None and seconds > config.lease_max_seconds:
+        error = {"error": f"leaseSeconds may be at most {config.lease_max_seconds}"}
+        return None, JSONResponse(content=error, status_code=400)
+    return seconds, None
+
+def hw_info(hw_set):
+    """The public view of a hardware set"""
+    return {
+        "hardwareName": hw_set.get("hwSetName"),
+        "capacity": hw_set.get("capacity"),
+        "availability": hw_set.get("availability")
+    }
+
+def hw_etag(hw_set):
+    """ETag of a hardware set: its version, which every availability write bumps"""
+    return f'"{hw_set.get("version", 0)}"'
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header lists etag (weak comparison, as RFC 9110 asks for this header)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def batch_response(request, outcomes, errors, action):
+    """Build the per-item batch response; all-or-nothing failures are a 400"""
+    results = [
+        BatchItemResult(
+            hwSetName=item.hwSetName,
+            qty=item.qty,
+            success=outcome == hardwareDB.CHECKOUT_OK,
+            error=None if outcome == hardwareDB.CHECKOUT_OK else BATCH_ERRORS.get(outcome) or errors[outcome][1]
+        )
+        for item, outcome in zip(request.items, outcomes)
+    ]
+    succeeded = sum(result.success for result in results)
+    if succeeded == len(results):
+        return BatchResponse(message=f"{action} successfully", results=results)
+    if request.atomic or succeeded == 0:
+        response = BatchResponse(message=f"Batch rejected; nothing was {action.lower()}", results=results)
+        return JSONResponse(content=response.model_dump(), status_code=400)
+    return BatchResponse(message=f"{action} {succeeded} of {len(results)} items", results=results)
 
 @app.get("/")
 async def root():
     """Root endpoint"""
     return {"message": "Hardware Service API", "version": "1.0.0"}
 
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness probe: the process is up and its event loop is answering. Never touches the database.
+    
+    Returns:
+        JSON response with status "alive"
+    """
+    return {"status": "alive"}
+
+@app.get("/readyz")
+async def readyz(request: Request):
+    """
+    Readiness probe, answered from the worker's cached probe state: configuration
+    complete, warm-up (connections, indexes, watcher) done and the last storage
+    ping, taken every READINESS_PROBE_INTERVAL_SECONDS, successful.
+    
+    Returns:
+        JSON response with ready and each check's result; 200 when ready, else 503
+    """
+    readiness = getattr(request.app.state, "readiness", None)
+    if readiness is None:
+        return JSONResponse(content={"ready": False, "checks": {"startup": "pending"}}, status_code=503)
+    state = readiness.snapshot()
+    return JSONResponse(content=state, status_code=200 if state["ready"] else 503)
+
 @app.get("/get_hw_info")
 async def get_hw_info(
     hwSetName: str,
-    client: MongoClient = Depends(get_mongodb_client)
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    storage: HardwareStorage = Depends(get_storage)
 ):
     """
     Get hardware set information by name.
     Matches Flask app endpoint format.
     
+    The response carries an ETag (the set's version). A poll sending it back in
+    If-None-Match gets an empty 304 while the set is unchanged; with the set
+    cached (or in the watcher snapshot) that costs no database round-trip.
+    
     Args:
         hwSetName: The name of the hardware set to query
     
     Returns:
-        JSON response with hardwareName, capacity, and availability
+        JSON response with hardwareName, capacity, and availability, or 304
     """
     if not hwSetName:
         return JSONResponse(content={"error": "Missing 'hwSetName' in request"}, status_code=400)
     
-    success, result = hardwareDB.queryHardwareSet(client, hwSetName)
+    snapshot = get_hardware_snapshot()
+    if snapshot is not None:
+        # Served from the change-stream snapshot: no database round-trip
+        result = snapshot.get(hwSetName)
+        success = result is not None
+        if not success:
+            result = "Hardware set does not exist"
+    if snapshot is None or (success and result.get("shards")):
+        # No snapshot, or a sharded set: its availability lives on shard documents the watcher doesn't follow
+        success, result = await storage.queryHardwareSet(hwSetName, readOnly=True)
     
     if not success:
         return JSONResponse(content={"message": result}, status_code=404)
     
-    return {
-        "hardwareName": result.get("hwSetName"),
-        "capacity": result.get("capacity"),
-        "availability": result.get("availability")
-    }
+    etag = hw_etag(result)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=hw_info(result), headers={"ETag": etag})
+
+@app.get("/get_hw_info_batch")
+async def get_hw_info_batch(
+    hwSetName: List[str] = Query(..., description="Hardware set names; repeat the parameter for each one"),
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Get several hardware sets in one request: cached sets are served from memory
+    and the rest are read with one $in query.
+    
+    The ETag covers every requested name and its version, so a dashboard poll
+    sending it back in If-None-Match gets an empty 304 until one of them changes.
+    
+    Args:
+        hwSetName: Hardware set names (at most HW_INFO_MAX_NAMES distinct ones)
+    
+    Returns:
+        JSON response with hardwareSets (in request order) and the missing names, or 304
+    """
+    names = list(dict.fromkeys(hwSetName))
+    if len(names) > config.hw_info_max_names:
+        return JSONResponse(content={"error": f"At most {config.hw_info_max_names} hwSetName values per request"}, status_code=400)
+    
+    snapshot = get_hardware_snapshot()
+    if snapshot is not None:
+        found = {name: snapshot[name] for name in names if name in snapshot and not snapshot[name].get("shards")}
+        # Sharded sets' availability lives on shard documents the watcher doesn't follow
+        rest = [name for name in names if name in snapshot and name not in found]
+    else:
+        found, rest = {}, names
+    if rest:
+        found.update(await storage.queryHardwareSets(rest, readOnly=True))
+    
+    versions = "\n".join(f"{name}:{found[name].get('version', 0) if name in found else '-'}" for name in names)
+    etag = f'"{hashlib.sha1(versions.encode()).hexdigest()}"'
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content={
+        "hardwareSets": [hw_info(found[name]) for name in names if name in found],
+        "missing": [name for name in names if name not in found]
+    }, headers={"ETag": etag})
+
+@app.get("/availability/stream")
+async def availability_stream(
+    request: Request,
+    hwSetName: List[str] = Query(..., description="Hardware set names; repeat the parameter for each one"),
+    broadcaster: AvailabilityBroadcaster = Depends(get_broadcaster)
+):
+    """
+    Follow the availability of some hardware sets as server-sent events: one
+    event per set now, then one whenever a check-out, check-in or other
+    availability write changes it. Every stream in a worker shares that
+    worker's single source of changes. A client that reads slower than the
+    sets change gets each set's latest value, not every intermediate one.
+    Idle streams get a keep-alive comment every AVAILABILITY_STREAM_HEARTBEAT_SECONDS.
+    
+    Args:
+        hwSetName: Hardware set names (at most HW_INFO_MAX_NAMES distinct ones)
+    
+    Returns:
+        text/event-stream response of "availability" events with hardwareName,
+        capacity, availability, version and change (null on the first event) as JSON data
+    """
+    names = list(dict.fromkeys(hwSetName))
+    if len(names) > config.hw_info_max_names:
+        return JSONResponse(content={"error": f"At most {config.hw_info_max_names} hwSetName values per request"}, status_code=400)
+    
+    subscription, current, missing = await broadcaster.subscribe(names)
+    if missing:
+        broadcaster.unsubscribe(subscription)
+        return JSONResponse(content={"error": "Hardware does not exist", "missing": missing}, status_code=404)
+
+    async def events():
+        try:
+            for event in current:
+                yield f"event: availability\ndata: {json.dumps(event)}\n\n"
+            while not await request.is_disconnected():
+                changes = await subscription.next(config.availability_stream_heartbeat_seconds)
+                if not changes:
+                    yield ": keep-alive\n\n"
+                for event in changes:
+                    yield f"event: availability\ndata: {json.dumps(event)}\n\n"
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.post("/check_out")
 async def check_out(
     request: CheckoutRequest,
-    client: MongoClient = Depends(get_mongodb_client)
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255),
+    storage: HardwareStorage = Depends(get_storage),
+    waitlist: Waitlist = Depends(get_waitlist)
 ):
     """
     Check out hardware for a project.
     Matches Flask app endpoint format.
     
+    With waitlist=true the request joins the hardware set's waitlist instead of
+    failing when not enough units are available; waitlisted requests are served
+    by priority, then in arrival order. If it is granted right away the response
+    is the usual 200, otherwise 202 with the waitlist entry to follow via
+    GET /waitlist/{waitId} or /waitlist/{waitId}/events.
+    
     Args:
-        request: CheckoutRequest containing projectId, hwSetName, qty, and userId
+        request: CheckoutRequest containing projectId, hwSetName, qty, userId and optional
+            leaseSeconds, waitlist and priority
+        idempotency_key: Optional Idempotency-Key header; a retry with the same key
+            returns the original response without checking out again
     
     Returns:
-        JSON response with message or error
+        JSON response with message (and waitId when waitlisted) or error
     """
     # Validate required fields (matching Flask app validation)
     if not all([request.projectId, request.hwSetName, request.qty, request.userId]):
         return JSONResponse(content={"error": "Missing required fields"}, status_code=400)
+    lease, error = lease_seconds(request.leaseSeconds)
+    if error is not None:
+        return error
+    if request.waitlist:
+        return await join_waitlist(request, lease, idempotency_key, storage, waitlist)
     
-    # Check if hardware exists
-    hw_exists, hw_data = hardwareDB.queryHardwareSet(client, request.hwSetName)
-    if not hw_exists:
-        return JSONResponse(content={"error": "Hardware does not exist"}, status_code=404)
-    
-    # Check availability
-    available = hw_data.get("availability", 0)
-    if available < request.qty:
-        return JSONResponse(content={"error": "Not enough units available to check out"}, status_code=400)
-    
-    # Request space (updates availability)
-    if not hardwareDB.requestSpace(client, request.hwSetName, request.qty):
-        return JSONResponse(content={"error": "Failed to check out hardware"}, status_code=400)
-    
-    # Update project checkout record
-    if not hardwareDB.updateProjectCheckout(client, request.projectId, request.hwSetName, request.qty):
-        # Rollback availability if checkout record update fails
-        hardwareDB.updateAvailability(client, request.hwSetName, request.qty)
-        return JSONResponse(content={"error": "Failed to update project checkout record"}, status_code=500)
+    outcome = await storage.checkOutHardware(
+        request.projectId, request.hwSetName, request.qty,
+        idempotency_key=idempotency_key, userId=request.userId, leaseSeconds=lease
+    )
+    metrics.count_outcomes("check_out", [outcome])
+    if outcome != hardwareDB.CHECKOUT_OK:
+        status_code, error = CHECKOUT_ERRORS[outcome]
+        return JSONResponse(content={"error": error}, status_code=status_code)
     
     return {"message": "Checked out successfully"}
 
+async def join_waitlist(request, lease, idempotency_key, storage, waitlist):
+    """Queue a check-out behind the set's earlier waiters, then drain so it is granted now if it fits"""
+    outcome, entry = await storage.enqueueCheckout(
+        request.projectId, request.hwSetName, request.qty, userId=request.userId,
+        priority=request.priority, leaseSeconds=lease, idempotency_key=idempotency_key
+    )
+    if outcome != hardwareDB.CHECKOUT_OK:
+        metrics.count_outcomes("check_out", [outcome])
+        status_code, error = CHECKOUT_ERRORS[outcome]
+        return JSONResponse(content={"error": error}, status_code=status_code)
+    
+    if entry['status'] == hardwareDB.WAIT_WAITING:
+        await waitlist.drain(request.hwSetName)
+        entry = await storage.getWaitlistEntry(entry['waitId'])
+    if entry['status'] == hardwareDB.WAIT_GRANTED:
+        metrics.count_outcomes("check_out", [hardwareDB.CHECKOUT_OK])
+        return {"message": "Checked out successfully", "waitId": entry['waitId']}
+    metrics.count_outcomes("check_out", ["waitlisted"])
+    return JSONResponse(content={"message": "Waiting for enough units to become available", **entry}, status_code=202)
+
 @app.post("/check_in")
 async def check_in(
     request: CheckinRequest,
-    client: MongoClient = Depends(get_mongodb_client)
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255),
+    storage: HardwareStorage = Depends(get_storage),
+    waitlist: Waitlist = Depends(get_waitlist)
 ):
     """
     Check in hardware for a project.
@@ -172,6 +606,8 @@ async def check_in(
     
     Args:
         request: CheckinRequest containing projectId, hwSetName, qty, and userId
+        idempotency_key: Optional Idempotency-Key header; a retry with the same key
+            returns the original response without checking in again
     
     Returns:
         JSON response with message or error
@@ -180,54 +616,179 @@ async def check_in(
     if not all([request.projectId, request.hwSetName, request.qty, request.userId]):
         return JSONResponse(content={"error": "Missing required fields"}, status_code=400)
     
-    # Check if hardware exists
-    hw_exists, hw_data = hardwareDB.queryHardwareSet(client, request.hwSetName)
-    if not hw_exists:
-        return JSONResponse(content={"error": "Hardware does not exist"}, status_code=404)
+    outcome = await storage.checkInHardware(
+        request.projectId, request.hwSetName, request.qty,
+        idempotency_key=idempotency_key, userId=request.userId
+    )
+    metrics.count_outcomes("check_in", [outcome])
+    if outcome != hardwareDB.CHECKOUT_OK:
+        status_code, error = CHECKIN_ERRORS[outcome]
+        return JSONResponse(content={"error": error}, status_code=status_code)
+    
+    # The returned units may let waiting check-outs through
+    waitlist.schedule_drain([request.hwSetName])
+    return {"message": "Checked in successfully"}
+
+@app.post("/check_out_batch", response_model=BatchResponse)
+async def check_out_batch(
+    request: BatchCheckoutRequest,
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Check out several hardware sets for a project in one request.
     
-    # Check project's current checkout
-    current_checkout = hardwareDB.getProjectCheckout(client, request.projectId, request.hwSetName)
-    if current_checkout < request.qty:
-        return JSONResponse(content={"error": "Cannot check in more than currently checked out"}, status_code=400)
+    Args:
+        request: BatchCheckoutRequest containing projectId, userId, items, atomic and optional leaseSeconds
     
-    # Check capacity constraints
-    currAvailability = hw_data.get("availability")
-    currCapacity = hw_data.get("capacity")
-    newAvailability = currAvailability + request.qty
+    Returns:
+        BatchResponse: Overall message plus one result per item
+    """
+    lease, error = lease_seconds(request.leaseSeconds)
+    if error is not None:
+        return error
+    items = [(item.hwSetName, item.qty) for item in request.items]
+    outcomes = await storage.checkOutHardwareBatch(
+        request.projectId, items, atomic=request.atomic, userId=request.userId, leaseSeconds=lease
+    )
+    metrics.count_outcomes("check_out", outcomes)
+    return batch_response(request, outcomes, CHECKOUT_ERRORS, "Checked out")
+
+@app.post("/check_in_batch", response_model=BatchResponse)
+async def check_in_batch(
+    request: BatchCheckinRequest,
+    storage: HardwareStorage = Depends(get_storage),
+    waitlist: Waitlist = Depends(get_waitlist)
+):
+    """
+    Check in several hardware sets for a project in one request.
     
-    if newAvailability > currCapacity:
-        return JSONResponse(content={"error": "Too big to check in"}, status_code=400)
+    Args:
+        request: BatchCheckinRequest containing projectId, userId, items and atomic
     
-    # Update availability (check-in increases availability)
-    if not hardwareDB.updateAvailability(client, request.hwSetName, request.qty):
-        return JSONResponse(content={"error": "Failed to check in hardware"}, status_code=400)
+    Returns:
+        BatchResponse: Overall message plus one result per item
+    """
+    items = [(item.hwSetName, item.qty) for item in request.items]
+    outcomes = await storage.checkInHardwareBatch(request.projectId, items, atomic=request.atomic, userId=request.userId)
+    metrics.count_outcomes("check_in", outcomes)
+    waitlist.schedule_drain(name for (name, _), outcome in zip(items, outcomes) if outcome == hardwareDB.CHECKOUT_OK)
+    return batch_response(request, outcomes, CHECKIN_ERRORS, "Checked in")
+
+@app.post("/renew_lease")
+async def renew_lease(
+    request: RenewLeaseRequest,
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Extend a leased holding so it expires leaseSeconds from now.
     
-    # Update project checkout record (negative qty for check-in)
-    if not hardwareDB.updateProjectCheckout(client, request.projectId, request.hwSetName, -request.qty):
-        # Rollback availability if checkout record update fails
-        hardwareDB.updateAvailability(client, request.hwSetName, -request.qty)
-        return JSONResponse(content={"error": "Failed to update project checkout record"}, status_code=500)
+    Args:
+        request: RenewLeaseRequest containing projectId, hwSetName and optional leaseSeconds
     
-    return {"message": "Checked in successfully"}
+    Returns:
+        JSON response with message and the new expiresAt, or error
+    """
+    lease, error = lease_seconds(request.leaseSeconds)
+    if error is not None:
+        return error
+    if lease is None:
+        return JSONResponse(content={"error": "Missing leaseSeconds"}, status_code=400)
+    
+    outcome, expires_at = await storage.renewLease(request.projectId, request.hwSetName, lease)
+    if outcome != hardwareDB.CHECKOUT_OK:
+        status_code, error = RENEW_ERRORS[outcome]
+        return JSONResponse(content={"error": error}, status_code=status_code)
+    
+    return {"message": "Lease renewed", "expiresAt": expires_at.isoformat()}
+
+@app.get("/waitlist/{waitId}")
+async def get_waitlist_entry(
+    waitId: str,
+    wait: float = Query(0, ge=0, description="Hold the request up to this many seconds until the entry is finished"),
+    waitlist: Waitlist = Depends(get_waitlist)
+):
+    """
+    Get a waitlist entry; with wait > 0, long-poll until it is granted, cancelled
+    or expired. Held requests are answered by this worker's waitlist service
+    (one database query per poll interval for all of them), not by repeated reads.
+    
+    Args:
+        waitId: The waitId returned by /check_out
+        wait: Longest time to hold the request (capped at WAITLIST_LONG_POLL_MAX_SECONDS)
+    
+    Returns:
+        JSON response with the entry: status, position while waiting, grantedAt once granted
+    """
+    entry = await waitlist.wait(waitId, min(wait, config.waitlist_long_poll_max_seconds))
+    if entry is None:
+        return JSONResponse(content={"error": CANCEL_WAIT_ERRORS[hardwareDB.NO_WAIT_ENTRY][1]}, status_code=404)
+    return entry
+
+@app.get("/waitlist/{waitId}/events")
+async def waitlist_events(waitId: str, waitlist: Waitlist = Depends(get_waitlist)):
+    """
+    Follow a waitlist entry as server-sent events: the entry now, again every
+    WAITLIST_LONG_POLL_MAX_SECONDS while it waits (doubling as a keep-alive),
+    and once more when it finishes, after which the stream ends.
+    
+    Args:
+        waitId: The waitId returned by /check_out
+    
+    Returns:
+        text/event-stream response of "waitlist" events with the entry as JSON data
+    """
+    if await waitlist.storage.getWaitlistEntry(waitId) is None:
+        return JSONResponse(content={"error": CANCEL_WAIT_ERRORS[hardwareDB.NO_WAIT_ENTRY][1]}, status_code=404)
+
+    async def events():
+        async for entry in waitlist.follow(waitId, config.waitlist_long_poll_max_seconds):
+            yield f"event: waitlist\ndata: {json.dumps(entry)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.delete("/waitlist/{waitId}")
+async def cancel_wait(
+    waitId: str,
+    storage: HardwareStorage = Depends(get_storage),
+    waitlist: Waitlist = Depends(get_waitlist)
+):
+    """
+    Leave the waitlist. Only waiting entries can be cancelled.
+    
+    Args:
+        waitId: The waitId returned by /check_out
+    
+    Returns:
+        JSON response with message or error
+    """
+    outcome = await storage.cancelWait(waitId)
+    if outcome != hardwareDB.CHECKOUT_OK:
+        status_code, error = CANCEL_WAIT_ERRORS[outcome]
+        return JSONResponse(content={"error": error}, status_code=status_code)
+    # Answer this worker's long-polls now; other workers see it on their next poll
+    waitlist.resolve([{"waitId": waitId}])
+    return {"message": "Left the waitlist"}
 
 @app.post("/create_hardware_set", response_model=MessageResponse)
 async def create_hardware_set(
     request: CreateHardwareRequest,
-    client: MongoClient = Depends(get_mongodb_client)
+    storage: HardwareStorage = Depends(get_storage)
 ):
     """
     Create a new hardware set.
     
     Args:
-        request: CreateHardwareRequest containing hwSetName and capacity
+        request: CreateHardwareRequest containing hwSetName, capacity and optional shards
     
     Returns:
         MessageResponse: Success message
     """
-    success, message = hardwareDB.createHardwareSet(
-        client, 
+    if request.shards is not None and request.shards > config.hw_shards_max:
+        raise HTTPException(status_code=400, detail=f"shards may be at most {config.hw_shards_max}")
+    success, message = await storage.createHardwareSet(
         request.hwSetName, 
-        request.capacity
+        request.capacity,
+        request.shards
     )
     
     if not success:
@@ -235,8 +796,34 @@ async def create_hardware_set(
     
     return MessageResponse(message=message)
 
+@app.post("/shard_hardware_set")
+async def shard_hardware_set(
+    request: ShardHardwareRequest,
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Split an existing hardware set's availability across sub-counter documents,
+    so concurrent check-outs of a very busy set stop queueing on one document.
+    Reads keep returning the set's total availability.
+    
+    Args:
+        request: ShardHardwareRequest containing hwSetName and shards
+    
+    Returns:
+        JSON response with hwSetName and the shard count it ended up with, or error
+    """
+    if request.shards > config.hw_shards_max:
+        return JSONResponse(content={"error": f"shards may be at most {config.hw_shards_max}"}, status_code=400)
+    
+    outcome, shards = await storage.shardHardwareSet(request.hwSetName, request.shards)
+    if outcome != hardwareDB.CHECKOUT_OK:
+        status_code, error = SHARD_ERRORS[outcome]
+        return JSONResponse(content={"error": error, "shards": shards}, status_code=status_code)
+    
+    return {"hwSetName": request.hwSetName, "shards": shards}
+
 @app.get("/get_all_hw_names")
-async def get_all_hw_names(client: MongoClient = Depends(get_mongodb_client)):
+async def get_all_hw_names(storage: HardwareStorage = Depends(get_storage)):
     """
     Get all hardware set names.
     Matches Flask app endpoint format (returns empty dict for now, can be extended).
@@ -244,11 +831,332 @@ async def get_all_hw_names(client: MongoClient = Depends(get_mongodb_client)):
     Returns:
         JSON response (empty dict to match Flask app, or list of names)
     """
-    hardware_names = hardwareDB.getAllHwSetNames(client)
+    snapshot = get_hardware_snapshot()
+    if snapshot is not None:
+        hardware_names = list(snapshot)
+    else:
+        hardware_names = await storage.getAllHwSetNames()
     # Return empty dict to match Flask app behavior, or return names if needed
     # return {}  # Matches Flask app exactly
     return {"hardwareNames": hardware_names}  # More useful format
 
+@app.get("/get_hw_names")
+async def get_hw_names(
+    limit: int = Query(100, ge=1, description="Maximum names per page"),
+    after: Optional[str] = Query(None, description="nextCursor from the previous page"),
+    prefix: Optional[str] = Query(None, description="Only names starting with this prefix"),
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Get hardware set names one page at a time, in name order.
+    
+    Args:
+        limit: Maximum number of names (capped at HW_NAMES_MAX_PAGE_SIZE)
+        after: Cursor returned by the previous page
+        prefix: Optional name prefix filter
+    
+    Returns:
+        JSON response with hardwareNames and nextCursor (null on the last page)
+    """
+    limit = min(limit, config.hw_names_max_page_size)
+    names, next_cursor = await storage.getHwSetNamesPage(limit, after=after, prefix=prefix)
+    return {"hardwareNames": names, "nextCursor": next_cursor}
+
+@app.get("/get_hw_names/stream")
+async def stream_hw_names(
+    prefix: Optional[str] = Query(None, description="Only names starting with this prefix"),
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Stream every hardware set name as NDJSON ({"hwSetName": ...} per line).
+    Names go straight from the storage cursor to the response, so memory use does
+    not grow with the collection.
+    
+    Args:
+        prefix: Optional name prefix filter
+    
+    Returns:
+        application/x-ndjson streaming response
+    """
+    batch_size = config.hw_names_stream_batch_size
+
+    async def lines():
+        chunk = []
+        async for name in storage.streamHwSetNames(prefix=prefix, batch_size=batch_size):
+            chunk.append(json.dumps({"hwSetName": name}) + "\n")
+            if len(chunk) >= batch_size:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.post("/import_hardware_sets")
+async def import_hardware_sets(
+    request: Request,
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Bulk import hardware sets from the request body.
+    NDJSON by default; send Content-Type: text/csv for CSV with a header row.
+    The body is parsed as it streams in and inserted in unordered batches, so
+    duplicates and invalid rows are reported without aborting the import.
+    
+    Returns:
+        JSON response with inserted/duplicates/errors counts and the first offending records
+    """
+    content_type = request.headers.get("content-type", "")
+    format_name = "csv" if "csv" in content_type else "ndjson"
+    records = bulk_io.parser_for(format_name)(bulk_io.iter_lines(request.stream()))
+    return await storage.importRecords(records, batch_size=config.import_batch_size)
+
+@app.get("/export")
+async def export_state(
+    only: Optional[str] = Query(None, pattern="^(hardware|checkout)$", description="Export a single record type"),
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Stream hardware sets and checkout records as NDJSON for backups and migrations.
+    The output can be posted back to /import_hardware_sets.
+    
+    Args:
+        only: Optional record type ("hardware" or "checkout")
+    
+    Returns:
+        application/x-ndjson streaming response
+    """
+    include = (only,) if only else ("hardware", "checkout")
+
+    async def lines():
+        async for record in storage.exportState(include=include, batch_size=config.import_batch_size):
+            yield json.dumps(record) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/projects/{projectId}/holdings")
+async def get_project_holdings(projectId: str, storage: HardwareStorage = Depends(get_storage)):
+    """
+    Get every hardware set a project holds, in one aggregation.
+    
+    Args:
+        projectId: The project ID
+    
+    Returns:
+        JSON response with holdings (hwSetName, quantity, capacity) and totalQuantity
+    """
+    return await storage.getProjectHoldings(projectId)
+
+@app.get("/projects/{projectId}/holdings/stream")
+async def stream_project_holdings(projectId: str, storage: HardwareStorage = Depends(get_storage)):
+    """
+    Stream a project's holdings as NDJSON, one {"hwSetName", "quantity", "capacity"} per line.
+    Not cached; rows go straight from the aggregation cursor to the response.
+    
+    Args:
+        projectId: The project ID
+    
+    Returns:
+        application/x-ndjson streaming response
+    """
+    async def lines():
+        async for holding in storage.streamProjectHoldings(projectId, batch_size=config.hw_names_stream_batch_size):
+            yield json.dumps(holding) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/utilization")
+async def get_utilization(storage: HardwareStorage = Depends(get_storage)):
+    """
+    Get capacity, availability, units checked out and holding projects for every
+    hardware set, plus fleet-wide totals, in one aggregation.
+    
+    Returns:
+        JSON response with hardwareSets and totals
+    """
+    return await storage.getUtilization()
+
+@app.get("/utilization/stream")
+async def stream_utilization(storage: HardwareStorage = Depends(get_storage)):
+    """
+    Stream the utilization report as NDJSON, one hardware set per line, in name order.
+    Not cached; rows go straight from the aggregation cursor to the response.
+    
+    Returns:
+        application/x-ndjson streaming response
+    """
+    async def lines():
+        async for record in storage.streamUtilization(batch_size=config.hw_names_stream_batch_size):
+            yield json.dumps(record) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/ledger")
+async def get_ledger(
+    projectId: Optional[str] = Query(None, description="Only this project's entries"),
+    hwSetName: Optional[str] = Query(None, description="Only this hardware set's entries"),
+    since: Optional[datetime] = Query(None, description="Entries at or after this time (ISO 8601)"),
+    until: Optional[datetime] = Query(None, description="Entries at or before this time (ISO 8601)"),
+    limit: int = Query(100, ge=1, description="Maximum entries per page"),
+    after: Optional[str] = Query(None, description="nextCursor from the previous page"),
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Get checkout ledger entries (one per applied check-out/check-in) in log order.
+    
+    Args:
+        projectId: Optional project filter
+        hwSetName: Optional hardware set filter
+        since: Optional start of the time range
+        until: Optional end of the time range
+        limit: Maximum number of entries (capped at HW_NAMES_MAX_PAGE_SIZE)
+        after: Cursor returned by the previous page
+    
+    Returns:
+        JSON response with entries and nextCursor (null on the last page)
+    """
+    limit = min(limit, config.hw_names_max_page_size)
+    try:
+        entries, next_cursor = await storage.getLedger(projectId, hwSetName, since, until, limit, after)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return {"entries": entries, "nextCursor": next_cursor}
+
+@app.get("/ledger/balances")
+async def get_ledger_balances(
+    at: Optional[datetime] = Query(None, description="Point in time (ISO 8601); defaults to now"),
+    projectId: Optional[str] = Query(None, description="Only this project's holdings"),
+    hwSetName: Optional[str] = Query(None, description="Only this hardware set's holdings"),
+    storage: HardwareStorage = Depends(get_storage)
+):
+    """
+    Get holdings as they were at a point in time, rebuilt from the newest ledger
+    snapshot before it plus the entries after the snapshot.
+    
+    Args:
+        at: Optional point in time
+        projectId: Optional project filter
+        hwSetName: Optional hardware set filter
+    
+    Returns:
+        JSON response with the snapshot used, entries replayed and the balances
+    """
+    return await storage.getBalancesAt(at, projectId, hwSetName)
+
+@app.post("/ledger/snapshot")
+async def take_ledger_snapshot(storage: HardwareStorage = Depends(get_storage)):
+    """
+    Compact the ledger into a new snapshot now (normally done every
+    LEDGER_SNAPSHOT_INTERVAL_SECONDS).
+    
+    Returns:
+        JSON response with the snapshot header
+    """
+    return {"snapshot": await storage.takeLedgerSnapshot()}
+
+@app.get("/ledger/audit")
+async def audit_ledger(storage: HardwareStorage = Depends(get_storage)):
+    """
+    Compare holdings rebuilt from the ledger with the checkout records.
+    
+    Returns:
+        JSON response with a consistent flag and the first mismatches
+    """
+    return await storage.auditLedger()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    Prometheus scrape endpoint: request latency per route and status, data-layer
+    operation latency, rollback and check-out/check-in outcome counters, and
+    connection pool usage.
+    
+    Returns:
+        Metrics in the Prometheus text exposition format
+    """
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/pool_stats")
+async def pool_stats(request: Request):
+    """
+    Get connection pool settings and per-server connection counters.
+    Useful for sizing MONGO_MAX_POOL_SIZE and MONGO_WAIT_QUEUE_TIMEOUT_MS under load.
+    
+    Returns:
+        JSON response with pool settings and counters
+    """
+    return request.app.state.pool_stats.snapshot()
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """
+    Get hardware set cache settings and hit/miss/eviction counters, with the
+    holdings/utilization report cache under "reports".
+    
+    Returns:
+        JSON response with cache counters
+    """
+    return {**hardware_cache.stats(), "reports": report_cache.stats()}
+
+@app.get("/waitlist_stats")
+async def waitlist_stats(waitlist: Waitlist = Depends(get_waitlist)):
+    """
+    Get this worker's waitlist counters (waiting clients, drains, grants, polls).
+    
+    Returns:
+        JSON response with waitlist counters
+    """
+    return waitlist.stats()
+
+@app.get("/availability_stats")
+async def availability_stats(broadcaster: AvailabilityBroadcaster = Depends(get_broadcaster)):
+    """
+    Get this worker's availability stream counters (streams, followed sets, published and coalesced events, polls).
+    
+    Returns:
+        JSON response with broadcaster counters
+    """
+    return broadcaster.stats()
+
+@app.get("/admission_stats")
+async def admission_stats():
+    """
+    Get this worker's admission limits, current load and admitted/rejected counters per route.
+    
+    Returns:
+        JSON response with admission counters
+    """
+    if admission_controller is None:
+        return {"enabled": False}
+    return {"enabled": True, **admission_controller.stats()}
+
+@app.get("/combiner_stats")
+async def combiner_stats(storage: HardwareStorage = Depends(get_storage)):
+    """
+    Get write combiner settings and counters (requests submitted, flushes, batch sizes).
+    
+    Returns:
+        JSON response with combiner counters
+    """
+    combiner = getattr(storage, "combiner", None)
+    if combiner is None:
+        return {"enabled": False}
+    return {"enabled": True, **combiner.stats()}
+
+@app.get("/watcher_stats")
+async def watcher_stats():
+    """
+    Get change-stream watcher state (enabled, ready, snapshot size, event/reload counters).
+    
+    Returns:
+        JSON response with watcher counters
+    """
+    watcher = app.state.hardware_watcher
+    if watcher is None:
+        return {"enabled": False}
+    return {"enabled": True, **watcher.stats()}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=config.service_port)
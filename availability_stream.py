@@ -0,0 +1,261 @@
+# Per-worker availability broadcaster: one source of change events fanned out to every live stream
+import asyncio
+import hardware_database_async as hardwareDB
+from config import config
+
+def availabilityEvent(hw_set, previous=None):
+    """
+    One hardware set's state as pushed to subscribers.
+    Args:
+        hw_set(dict): The hardware set
+        previous(dict): The last event published for it, or None
+
+    Returns:
+        dict: hardwareName, capacity, availability, version and the change since the previous event
+    """
+    return {
+        "hardwareName": hw_set["hwSetName"],
+        "capacity": hw_set["capacity"],
+        "availability": hw_set["availability"],
+        "version": hw_set.get("version", 0),
+        "change": hw_set["availability"] - previous["availability"] if previous is not None else None
+    }
+
+class Subscription:
+    """
+    One client's stream. Holds at most one unsent event per hardware set: a newer
+    change replaces the unsent one, so a slow reader gets the latest value
+    instead of a backlog that grows without limit.
+    """
+
+    def __init__(self, hwSetNames):
+        self.hwSetNames = hwSetNames
+        self.pending = {}   # hwSetName -> latest unsent event
+        self.ready = asyncio.Event()
+        self.coalesced = 0
+
+    def offer(self, event):
+        if event["hardwareName"] in self.pending:
+            self.coalesced += 1
+        self.pending[event["hardwareName"]] = event
+        self.ready.set()
+
+    async def next(self, timeout):
+        """
+        Wait up to timeout seconds for changes.
+        Returns:
+            list: The pending events (empty on timeout)
+        """
+        if not self.pending:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        events = list(self.pending.values())
+        self.pending.clear()
+        self.ready.clear()
+        return events
+
+class AvailabilityBroadcaster:
+    """
+    Pushes availability changes of followed hardware sets to every subscribed
+    stream in this worker. Changes come from one place per worker:
+
+    - every availability write this worker makes (requestSpace, updateAvailability
+      and everything built on them), through hardware_database_async's availability
+      listeners; writes whose result isn't known yet (sharded sets, transactions)
+      trigger one coalesced re-read of those sets
+    - the hardware watcher's change stream when it runs, which also carries other
+      workers' writes
+    - otherwise a poll every poll_interval: one queryHardwareSets for every set any
+      stream follows, however many streams follow it
+
+    An event is only published when a set's version moves forward, so the same
+    change arriving from several sources is pushed once.
+    Only touched from the event loop thread; writes announced from other threads
+    (the in-memory backend) are handed over to it.
+    """
+
+    def __init__(self, storage, poll_interval):
+        self.storage = storage
+        self.poll_interval = poll_interval
+        self._subscribers = {}   # hwSetName -> set of Subscriptions following it
+        self._latest = {}        # hwSetName -> last event published, for followed sets only
+        self._sharded = set()    # Followed sets whose availability the watcher can't see
+        self._stale = set()      # Sets to re-read
+        self._refresher = None
+        self._task = None
+        self._loop = None
+        self.watched = False
+        self.published = 0
+        self.coalesced = 0
+        self.polls = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def start(self, watcher=None):
+        """Start listening to this worker's writes, plus the watcher or the poll loop"""
+        self._loop = asyncio.get_running_loop()
+        hardwareDB.addAvailabilityListener(self._onWrite)
+        if watcher is not None:
+            self.watch(watcher)
+        if self.poll_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def watch(self, watcher):
+        """Take other workers' writes from the hardware watcher; from then on only sharded sets are polled"""
+        watcher.add_listener(self._onChange)
+        self.watched = True
+
+    async def stop(self):
+        """Stop listening and cancel the background tasks"""
+        hardwareDB.removeAvailabilityListener(self._onWrite)
+        self.watched = False
+        tasks = [task for task in (self._task, self._refresher) if task is not None]
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._refresher = None
+
+    async def subscribe(self, hwSetNames):
+        """
+        Follow some hardware sets.
+        Args:
+            hwSetNames(list): Distinct hardware set names
+
+        Returns:
+            tuple:
+                - Subscription: Pass to unsubscribe when the stream ends
+                - list: The current event of every set that exists
+                - list: Names that don't exist
+        """
+        subscription = Subscription(hwSetNames)
+        # Registered before the read, so a change landing in between is still delivered
+        for name in hwSetNames:
+            self._subscribers.setdefault(name, set()).add(subscription)
+        found = await self.storage.queryHardwareSets(hwSetNames, readOnly=True)
+        for hw_set in found.values():
+            self.publish(hw_set)
+        current = [self._latest[name] for name in hwSetNames if name in self._latest]
+        # Already in the current events
+        subscription.pending.clear()
+        return subscription, current, [name for name in hwSetNames if name not in found]
+
+    def unsubscribe(self, subscription):
+        self.coalesced += subscription.coalesced
+        for name in subscription.hwSetNames:
+            followers = self._subscribers.get(name)
+            if followers is None:
+                continue
+            followers.discard(subscription)
+            if not followers:
+                del self._subscribers[name]
+                self._latest.pop(name, None)
+                self._sharded.discard(name)
+
+    def publish(self, hw_set):
+        """Push a set's state to its followers if it is newer than the last one pushed"""
+        name = hw_set["hwSetName"]
+        followers = self._subscribers.get(name)
+        if not followers:
+            return
+        if "availability" not in hw_set:
+            # A sharded set's own document, e.g. from the watcher: its availability is on the shards
+            self._sharded.add(name)
+            self.refresh([name])
+            return
+        if hw_set.get("shards"):
+            self._sharded.add(name)
+        previous = self._latest.get(name)
+        if previous is not None and previous["version"] >= hw_set.get("version", 0):
+            return
+        event = self._latest[name] = availabilityEvent(hw_set, previous)
+        self.published += 1
+        for subscription in followers:
+            subscription.offer(event)
+
+    def refresh(self, hwSetNames):
+        """Re-read these sets in the background; re-reads requested while one runs are merged into the next"""
+        self._stale.update(name for name in hwSetNames if name in self._subscribers)
+        if self._stale and self._refresher is None:
+            self._refresher = asyncio.create_task(self._refreshLoop())
+
+    async def _refreshLoop(self):
+        try:
+            while self._stale:
+                names, self._stale = list(self._stale), set()
+                self.refreshes += 1
+                try:
+                    # From the primary: the write that asked for this re-read must be visible
+                    for hw_set in (await self.storage.queryHardwareSets(names)).values():
+                        self.publish(hw_set)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"⚠ Availability refresh failed: {e}")
+        finally:
+            self._refresher = None
+
+    def _handleWrite(self, hwSetName, hw_set):
+        if hw_set is not None:
+            self.publish(hw_set)
+        else:
+            self.refresh([hwSetName])
+
+    def _onWrite(self, hwSetName, hw_set):
+        """Availability listener; may be called from another thread by the in-memory backend"""
+        if hwSetName not in self._subscribers:
+            return
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self._handleWrite(hwSetName, hw_set)
+        else:
+            self._loop.call_soon_threadsafe(self._handleWrite, hwSetName, hw_set)
+
+    def _onChange(self, change):
+        """Hardware watcher listener"""
+        if not self.watched or change.get("ns", {}).get("coll") != config.mongo_collection_hardware:
+            return
+        document = change.get("fullDocument")
+        if document is not None:
+            self.publish(document)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            # With the watcher, only sharded sets need polling
+            names = list(self._sharded if self.watched else self._subscribers)
+            if not names:
+                continue
+            try:
+                self.polls += 1
+                for hw_set in (await self.storage.queryHardwareSets(names, readOnly=True)).values():
+                    self.publish(hw_set)
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠ Availability poll failed: {e}")
+
+    def stats(self):
+        """
+        Return broadcaster counters for this worker.
+        Returns:
+            dict: Streams, followed sets and published/coalesced/poll/refresh/error counters
+        """
+        streams = set().union(*self._subscribers.values()) if self._subscribers else set()
+        return {
+            "streams": len(streams),
+            "followedSets": len(self._subscribers),
+            "watched": self.watched,
+            "published": self.published,
+            "coalesced": self.coalesced + sum(subscription.coalesced for subscription in streams),
+            "polls": self.polls,
+            "refreshes": self.refreshes,
+            "errors": self.errors
+        }
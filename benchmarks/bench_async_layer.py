@@ -0,0 +1,83 @@
+"""
+Concurrent-request throughput: blocking pymongo calls vs the async data layer.
+
+Both modes run inside one asyncio event loop, the way uvicorn runs the routes.
+"sync" awaits nothing and calls hardware_database directly (the old route code),
+so every round-trip stalls the loop; "async" awaits hardware_database_async.
+
+Usage (from the repository root, with .env pointing at a disposable database):
+    python benchmarks/bench_async_layer.py --requests 2000 --concurrency 50
+    python benchmarks/bench_async_layer.py --url http://localhost:5002 --requests 2000
+
+With --url, the same concurrency is driven against a running service instead, so
+the numbers can be compared between a deployment before and after the change.
+"""
+import argparse
+import asyncio
+import json
+import uuid
+
+from common import drive, summarize
+
+import hardware_database as hardwareDB
+import hardware_database_async as hardwareDBAsync
+from config import config
+from mongo_pool import create_async_mongodb_client, create_mongodb_client
+
+async def bench_database(total, concurrency):
+    hwSetName = f"bench-{uuid.uuid4().hex[:8]}"
+    sync_client = create_mongodb_client()
+    async_client = create_async_mongodb_client()
+    try:
+        hardwareDB.createHardwareSet(sync_client, hwSetName, 1000)
+
+        async def sync_call():
+            # Old route behaviour: a blocking call inside a coroutine
+            hardwareDB.queryHardwareSet(sync_client, hwSetName)
+
+        async def async_call():
+            await hardwareDBAsync.queryHardwareSet(async_client, hwSetName)
+
+        # Warm both pools so connection setup is not measured
+        await drive(concurrency, concurrency, sync_call)
+        await drive(concurrency, concurrency, async_call)
+
+        results = []
+        for mode, call in (("sync", sync_call), ("async", async_call)):
+            latencies, elapsed, errors = await drive(total, concurrency, call)
+            results.append(summarize(mode, latencies, elapsed, errors, concurrency))
+        return results
+    finally:
+        sync_client[config.mongo_database][config.mongo_collection_hardware].delete_one({"hwSetName": hwSetName})
+        sync_client.close()
+        await async_client.close()
+
+async def bench_service(url, total, concurrency, hwSetName):
+    import httpx
+
+    async with httpx.AsyncClient(base_url=url, timeout=30) as http:
+        async def call():
+            response = await http.get("/get_hw_info", params={"hwSetName": hwSetName})
+            if response.status_code >= 500:
+                raise RuntimeError(response.status_code)
+
+        await drive(concurrency, concurrency, call)
+        latencies, elapsed, errors = await drive(total, concurrency, call)
+        return [summarize("http", latencies, elapsed, errors, concurrency)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--url", help="Benchmark a running service instead of the data layer")
+    parser.add_argument("--hw-set", default="HWSet1", help="Hardware set queried in --url mode")
+    args = parser.parse_args()
+
+    if args.url:
+        results = asyncio.run(bench_service(args.url, args.requests, args.concurrency, args.hw_set))
+    else:
+        results = asyncio.run(bench_database(args.requests, args.concurrency))
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
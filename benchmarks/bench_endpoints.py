@@ -0,0 +1,190 @@
+"""
+Endpoint load test: /get_hw_info, /check_out, /check_in and a mixed workload.
+
+Requests go through the real FastAPI app in-process (httpx ASGITransport, with
+the app's lifespan), so no server is needed. The storage backend is whatever
+STORAGE_BACKEND selects: "memory" measures the HTTP layer on its own, "mongo"
+uses the database in .env (use a local, disposable mongod). With --url the
+same workloads are driven against a running service instead.
+
+After every workload the invariant
+    sum of checked-out quantities + availability == capacity
+is checked for each benchmark hardware set (via /export), so correctness drift
+shows up next to latency. Output is JSON; the exit status is 1 if any run
+broke an invariant.
+
+Usage (from the repository root):
+    STORAGE_BACKEND=memory SERVICE_PORT=5002 ENVIRONMENT=test \\
+        python benchmarks/bench_endpoints.py --requests 5000 --concurrency 64
+    python benchmarks/bench_endpoints.py --workloads mixed --mix get_hw_info=80,check_out=10,check_in=10
+    python benchmarks/bench_endpoints.py --url http://localhost:5002
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager
+
+from common import drive, summarize
+
+WORKLOADS = ("get_hw_info", "check_out", "check_in", "mixed")
+
+@asynccontextmanager
+async def http_client(url):
+    """An httpx client for a running service, or for the app in-process with its lifespan running"""
+    import httpx
+
+    if url:
+        async with httpx.AsyncClient(base_url=url, timeout=30) as http:
+            yield http, None
+        return
+
+    from app import app
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=30) as http:
+            yield http, app
+
+def parse_mix(text):
+    """'get_hw_info=70,check_out=15,check_in=15' -> ([names], [weights])"""
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in WORKLOADS[:3]:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r} in --mix")
+        weights[name] = float(weight)
+    return list(weights), list(weights.values())
+
+class LoadTest:
+    """One set of benchmark hardware sets and projects, driven through the HTTP API"""
+
+    def __init__(self, http, hw_sets, capacity, projects, seed):
+        run_id = uuid.uuid4().hex[:8]
+        self.http = http
+        self.capacity = capacity
+        self.hw_sets = [f"bench-{run_id}-{i}" for i in range(hw_sets)]
+        self.projects = [f"bench-project-{run_id}-{i}" for i in range(projects)]
+        self.random = random.Random(seed)
+        self.statuses = Counter()
+
+    async def setup(self):
+        for name in self.hw_sets:
+            response = await self.http.post("/create_hardware_set", json={"hwSetName": name, "capacity": self.capacity})
+            response.raise_for_status()
+
+    async def _send(self, method, path, **kwargs):
+        response = await self.http.request(method, path, **kwargs)
+        self.statuses[response.status_code] += 1
+        # 4xx are business rejections (not enough units, nothing to check in); only 5xx are errors
+        if response.status_code >= 500:
+            raise RuntimeError(response.status_code)
+        return response
+
+    def _payload(self, qty=1):
+        return {
+            "projectId": self.random.choice(self.projects),
+            "hwSetName": self.random.choice(self.hw_sets),
+            "qty": qty,
+            "userId": "bench-user"
+        }
+
+    async def get_hw_info(self):
+        await self._send("GET", "/get_hw_info", params={"hwSetName": self.random.choice(self.hw_sets)})
+
+    async def check_out(self):
+        await self._send("POST", "/check_out", json=self._payload())
+
+    async def check_in(self):
+        await self._send("POST", "/check_in", json=self._payload())
+
+    async def prefill(self, total, concurrency):
+        """Untimed check-outs so a check-in workload has something to return"""
+        await drive(min(total, self.capacity * len(self.hw_sets)), concurrency, self.check_out)
+
+    async def holdings(self):
+        """(hwSetName -> availability, hwSetName -> total checked out) for the benchmark sets"""
+        availability = {}
+        checked_out = Counter()
+        response = await self.http.get("/export")
+        response.raise_for_status()
+        wanted = set(self.hw_sets)
+        for line in response.text.splitlines():
+            record = json.loads(line)
+            if record["hwSetName"] not in wanted:
+                continue
+            if record["type"] == "hardware":
+                availability[record["hwSetName"]] = (record["availability"], record["capacity"])
+            else:
+                checked_out[record["hwSetName"]] += record["quantity"]
+        return availability, checked_out
+
+    async def check_invariants(self):
+        """
+        Verify every benchmark set against its checkout records.
+        Returns:
+            dict: ok flag and one entry per violated set
+        """
+        availability, checked_out = await self.holdings()
+        violations = []
+        for name in self.hw_sets:
+            if name not in availability:
+                violations.append({"hwSetName": name, "error": "missing"})
+                continue
+            available, capacity = availability[name]
+            held = checked_out[name]
+            if held + available != capacity or not 0 <= available <= capacity:
+                violations.append({"hwSetName": name, "availability": available, "checkedOut": held, "capacity": capacity})
+        return {"ok": not violations, "violations": violations}
+
+async def run(args):
+    results = []
+    async with http_client(args.url) as (http, app):
+        for workload in args.workloads:
+            # A fresh set of hardware per workload keeps the runs independent
+            test = LoadTest(http, args.hw_sets, args.capacity, args.projects, args.seed)
+            await test.setup()
+            if workload == "mixed":
+                names, weights = args.mix
+                operations = [getattr(test, name) for name in names]
+                call = lambda: test.random.choices(operations, weights)[0]()
+            else:
+                call = getattr(test, workload)
+            if workload == "check_in":
+                await test.prefill(args.requests, args.concurrency)
+
+            # Warm up connections and caches, then measure from clean status counts
+            await drive(args.concurrency, args.concurrency, test.get_hw_info)
+            test.statuses.clear()
+            latencies, elapsed, errors = await drive(args.requests, args.concurrency, call)
+            results.append(summarize(
+                workload, latencies, elapsed, errors, args.concurrency,
+                backend=args.url or app.state.storage.name,
+                status_counts={str(status): count for status, count in sorted(test.statuses.items())},
+                invariants=await test.check_invariants()
+            ))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument("--requests", type=int, default=2000, help="Timed requests per workload")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--hw-sets", type=int, default=4, help="Hardware sets the requests are spread over")
+    parser.add_argument("--capacity", type=int, default=500, help="Capacity of each hardware set")
+    parser.add_argument("--projects", type=int, default=16, help="Projects the requests are spread over")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("get_hw_info=70,check_out=15,check_in=15"),
+                        help="Operation weights for the mixed workload")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible request sequences")
+    parser.add_argument("--url", help="Drive a running service instead of the in-process app")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if not all(result["invariants"]["ok"] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Primary offload: read-only lookups on the primary vs routed to secondaries.
+
+Workers run read-only calls (queryHardwareSet with readOnly=True and
+getAllHwSetNames) against a few hardware sets, once per --read-preference value.
+Between runs MONGO_READ_ONLY_READ_PREFERENCE is switched in-process; the max
+staleness and read concern come from .env as usual. Connection checkouts are
+counted per server with a PoolStatsListener, so each run reports how many of
+its operations reached the primary. The in-process hardware cache is switched
+off for the run, so every lookup reaches the database in every mode.
+
+Needs a replica set with at least one secondary for the offload to show; on a
+standalone server every mode reads from the same node.
+
+Usage (from the repository root, with .env pointing at a disposable database):
+    python benchmarks/bench_read_routing.py --requests 5000 --concurrency 64 --read-preference primary secondaryPreferred
+"""
+import argparse
+import asyncio
+import json
+import random
+import uuid
+
+from common import drive, summarize
+
+import hardware_database_async as hardwareDB
+from config import READ_PREFERENCES, config
+from hardware_cache import hardware_cache
+from mongo_pool import PoolStatsListener, create_async_mongodb_client
+
+def checkouts(listener):
+    return {address: stats["checkOuts"] for address, stats in listener.snapshot()["servers"].items()}
+
+async def bench(requests, concurrency, preferences, sets):
+    listener = PoolStatsListener()
+    client = create_async_mongodb_client(listener)
+    prefix = f"bench-routing-{uuid.uuid4().hex[:8]}"
+    hwSetNames = [f"{prefix}-{i}" for i in range(sets)]
+    db = client[config.mongo_database]
+    configured = config.mongo_read_only_read_preference
+    cache_entries = hardware_cache.max_entries
+    hardware_cache.max_entries = 0
+    try:
+        for hwSetName in hwSetNames:
+            await hardwareDB.createHardwareSet(client, hwSetName, 100)
+        primary = (await client.admin.command("hello")).get("primary")
+
+        results = []
+        for preference in preferences:
+            config.mongo_read_only_read_preference = preference
+
+            async def read():
+                if random.random() < 0.9:
+                    found, _ = await hardwareDB.queryHardwareSet(client, random.choice(hwSetNames), readOnly=True)
+                    if not found:
+                        raise RuntimeError("hardware set not found")
+                else:
+                    await hardwareDB.getAllHwSetNames(client)
+
+            before = checkouts(listener)
+            latencies, elapsed, errors = await drive(requests, concurrency, read)
+            by_server = {
+                address: count - before.get(address, 0)
+                for address, count in checkouts(listener).items() if count - before.get(address, 0)
+            }
+            total = sum(by_server.values())
+            results.append(summarize(
+                preference, latencies, elapsed, errors, concurrency, unit="read-only call",
+                primary=primary,
+                checkouts_by_server=by_server,
+                primary_share=round(by_server.get(primary, 0) / total, 3) if total and primary else None
+            ))
+        return results
+    finally:
+        config.mongo_read_only_read_preference = configured
+        hardware_cache.max_entries = cache_entries
+        await db[config.mongo_collection_hardware].delete_many({"hwSetName": {"$in": hwSetNames}})
+        await client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--read-preference", nargs="+", choices=READ_PREFERENCES, default=["primary", "secondaryPreferred"])
+    parser.add_argument("--sets", type=int, default=8)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(bench(args.requests, args.concurrency, args.read_preference, args.sets)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Check-out/check-in latency and throughput: compensating writes vs transactions.
+
+Every worker hammers the same hardware set with check-out + check-in pairs, so
+both modes run under maximum document contention. Transactions need a replica
+set; on a standalone server only the compensating mode is reported.
+
+Usage (from the repository root, with .env pointing at a disposable database):
+    python benchmarks/bench_transactions.py --pairs 1000 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import uuid
+
+from common import drive, summarize
+
+import hardware_database_async as hardwareDB
+from config import config
+from mongo_pool import create_async_mongodb_client
+
+async def bench(pairs, concurrency):
+    client = create_async_mongodb_client()
+    hwSetName = f"bench-txn-{uuid.uuid4().hex[:8]}"
+    db = client[config.mongo_database]
+    try:
+        # Enough capacity for every worker to hold one unit at a time
+        await hardwareDB.createHardwareSet(client, hwSetName, concurrency)
+        modes = [False]
+        if await hardwareDB.supportsTransactions(client):
+            modes.append(True)
+
+        results = []
+        for use_transaction in modes:
+            counter = iter(range(pairs))
+
+            async def pair():
+                projectId = f"bench-project-{next(counter)}"
+                outcome = await hardwareDB.checkOutHardware(client, projectId, hwSetName, 1, use_transaction=use_transaction)
+                if outcome != hardwareDB.CHECKOUT_OK:
+                    raise RuntimeError(outcome)
+                outcome = await hardwareDB.checkInHardware(client, projectId, hwSetName, 1, use_transaction=use_transaction)
+                if outcome != hardwareDB.CHECKOUT_OK:
+                    raise RuntimeError(outcome)
+
+            latencies, elapsed, errors = await drive(pairs, concurrency, pair)
+            _, hw_set = await hardwareDB.queryHardwareSet(client, hwSetName)
+            results.append(summarize(
+                "transaction" if use_transaction else "compensating",
+                latencies, elapsed, errors, concurrency,
+                unit="check-out + check-in pair",
+                availability_after=hw_set["availability"],
+                capacity=hw_set["capacity"]
+            ))
+        return results
+    finally:
+        await db[config.mongo_collection_hardware].delete_one({"hwSetName": hwSetName})
+        await db[config.mongo_collection_checkouts].delete_many({"hwSetName": hwSetName})
+        await client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(bench(args.pairs, args.concurrency)), indent=2))
+
+if __name__ == "__main__":
+    main()
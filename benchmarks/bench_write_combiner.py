@@ -0,0 +1,79 @@
+"""
+Hot hardware set throughput: one update per check-out/check-in vs the write combiner.
+
+Every worker hammers the same hardware set with check-out + check-in pairs. The
+"direct" mode calls checkOutHardware/checkInHardware; the "combined" modes send
+the same calls through a WriteCombiner with each --window-ms value, so
+concurrent requests share one availability update and one checkout bulk write.
+
+Usage (from the repository root, with .env pointing at a disposable database):
+    python benchmarks/bench_write_combiner.py --pairs 2000 --concurrency 64 --window-ms 0 1 2
+"""
+import argparse
+import asyncio
+import json
+import uuid
+
+from common import drive, summarize
+
+import hardware_database_async as hardwareDB
+from config import config
+from mongo_pool import create_async_mongodb_client
+from write_combiner import WriteCombiner
+
+async def bench(pairs, concurrency, windows, max_batch):
+    client = create_async_mongodb_client()
+    hwSetName = f"bench-combiner-{uuid.uuid4().hex[:8]}"
+    db = client[config.mongo_database]
+    try:
+        # Enough capacity for every worker to hold one unit at a time
+        await hardwareDB.createHardwareSet(client, hwSetName, concurrency)
+
+        modes = [("direct", None)] + [
+            (f"combined-{window}ms", WriteCombiner(client, window / 1000, max_batch)) for window in windows
+        ]
+        results = []
+        for mode, combiner in modes:
+            counter = iter(range(pairs))
+
+            async def check_out(projectId):
+                if combiner is None:
+                    return await hardwareDB.checkOutHardware(client, projectId, hwSetName, 1)
+                return await combiner.submit(hwSetName, projectId, 1)
+
+            async def check_in(projectId):
+                if combiner is None:
+                    return await hardwareDB.checkInHardware(client, projectId, hwSetName, 1)
+                return await combiner.submit(hwSetName, projectId, -1)
+
+            async def pair():
+                projectId = f"bench-project-{next(counter)}"
+                for step in (check_out, check_in):
+                    outcome = await step(projectId)
+                    if outcome != hardwareDB.CHECKOUT_OK:
+                        raise RuntimeError(outcome)
+
+            latencies, elapsed, errors = await drive(pairs, concurrency, pair)
+            _, hw_set = await hardwareDB.queryHardwareSet(client, hwSetName)
+            extra = {"availability_after": hw_set["availability"], "capacity": hw_set["capacity"]}
+            if combiner is not None:
+                extra["combiner"] = combiner.stats()
+            results.append(summarize(mode, latencies, elapsed, errors, concurrency, unit="check-out + check-in pair", **extra))
+        return results
+    finally:
+        await db[config.mongo_collection_hardware].delete_one({"hwSetName": hwSetName})
+        await db[config.mongo_collection_checkouts].delete_many({"hwSetName": hwSetName})
+        await db[config.mongo_collection_ledger].delete_many({"hwSetName": hwSetName})
+        await client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--window-ms", type=float, nargs="+", default=[0.0, 1.0])
+    parser.add_argument("--max-batch", type=int, default=256)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(bench(args.pairs, args.concurrency, args.window_ms, args.max_batch)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Shared helpers for the benchmark scripts: concurrency driver and latency summaries."""
+import asyncio
+import os
+import sys
+import time
+
+# Benchmarks run as scripts from the repository root; make the service modules importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+def summarize(mode, latencies, elapsed, errors, concurrency, **extra):
+    """
+    Build the JSON-friendly result for one benchmark run.
+    Args:
+        mode(str): Label for the run
+        latencies(list): Per-call latency in seconds
+        elapsed(float): Wall-clock seconds for the whole run
+        errors(int): Number of calls that raised
+        concurrency(int): Calls in flight
+
+    Returns:
+        dict: Throughput, p50/p95/p99 latency in milliseconds and error count
+    """
+    ordered = sorted(latencies)
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    result = {
+        "mode": mode,
+        "requests": len(latencies) + errors,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round((len(latencies) + errors) / elapsed, 1) if elapsed else None,
+        "p50_ms": to_ms(percentile(ordered, 50)),
+        "p95_ms": to_ms(percentile(ordered, 95)),
+        "p99_ms": to_ms(percentile(ordered, 99)),
+        "errors": errors
+    }
+    result.update(extra)
+    return result
+
+async def drive(total, concurrency, call):
+    """
+    Run `total` calls of the coroutine function `call` with at most `concurrency` in flight.
+
+    Returns:
+        tuple: (per-call latencies in seconds, wall-clock seconds, error count)
+    """
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                await call()
+            except Exception:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start, errors
@@ -0,0 +1,133 @@
+"""
+Bulk import/export of hardware sets.
+
+Import takes NDJSON (one {"hwSetName": ..., "capacity": ...} object per line) or
+CSV with a header row (hwSetName,capacity[,availability]). Export writes NDJSON
+of hardware sets and checkout records that can be imported again.
+
+Usage (from the repository root, with .env configured):
+    python bulk_io.py import hardware.ndjson
+    python bulk_io.py import hardware.csv --format csv --batch-size 2000
+    python bulk_io.py export backup.ndjson
+    python bulk_io.py export - --only hardware > hardware.ndjson
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+
+import hardware_database_async as hardwareDB
+from config import config
+from mongo_pool import create_async_mongodb_client
+
+async def iter_lines(chunks):
+    """
+    Split an async stream of byte chunks (e.g. a request body) into text lines.
+    Only the current partial line is buffered.
+    """
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8").rstrip("\r")
+    if buffer:
+        yield buffer.decode("utf-8").rstrip("\r")
+
+async def parse_ndjson(lines):
+    """
+    Yield (line number, record) for each non-blank NDJSON line.
+    Lines that are not valid JSON yield None as the record (reported by the importer).
+    """
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except json.JSONDecodeError:
+            yield line_no, None
+
+async def parse_csv(lines):
+    """
+    Yield (line number, record) for each CSV row after the header row.
+    Rows are parsed one line at a time, so quoted fields cannot contain newlines.
+    """
+    header = None
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if not line.strip():
+            continue
+        row = next(csv.reader([line]))
+        if header is None:
+            header = [column.strip() for column in row]
+            continue
+        yield line_no, {column: value.strip() for column, value in zip(header, row) if value.strip()}
+
+def parser_for(format_name):
+    """Return the record parser for 'ndjson' or 'csv'"""
+    return parse_csv if format_name == "csv" else parse_ndjson
+
+async def _file_chunks(path):
+    handle = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        while True:
+            chunk = handle.read(1 << 16)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        if handle is not sys.stdin.buffer:
+            handle.close()
+
+async def run_import(path, format_name, batch_size):
+    client = create_async_mongodb_client()
+    try:
+        records = parser_for(format_name)(iter_lines(_file_chunks(path)))
+        return await hardwareDB.importRecords(client, records, batch_size=batch_size)
+    finally:
+        await client.close()
+
+async def run_export(path, include, batch_size):
+    client = create_async_mongodb_client()
+    handle = sys.stdout if path == "-" else open(path, "w", encoding="utf-8")
+    exported = 0
+    try:
+        async for record in hardwareDB.exportState(client, include=include, batch_size=batch_size):
+            handle.write(json.dumps(record) + "\n")
+            exported += 1
+        return exported
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+        await client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="Import hardware sets from NDJSON or CSV")
+    import_parser.add_argument("path", help="Input file, or - for stdin")
+    import_parser.add_argument("--format", choices=["ndjson", "csv"], help="Defaults to csv for *.csv, else ndjson")
+    import_parser.add_argument("--batch-size", type=int, default=config.import_batch_size)
+
+    export_parser = commands.add_parser("export", help="Export hardware and checkout state as NDJSON")
+    export_parser.add_argument("path", help="Output file, or - for stdout")
+    export_parser.add_argument("--only", choices=["hardware", "checkout"], help="Export a single record type")
+    export_parser.add_argument("--batch-size", type=int, default=config.import_batch_size)
+
+    args = parser.parse_args()
+    if args.command == "import":
+        format_name = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+        summary = asyncio.run(run_import(args.path, format_name, args.batch_size))
+        print(json.dumps(summary, indent=2))
+    else:
+        include = (args.only,) if args.only else ("hardware", "checkout")
+        exported = asyncio.run(run_export(args.path, include, args.batch_size))
+        print(f"Exported {exported} records", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+# Append-only checkout ledger, compacted snapshots and replay/audit over them
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from config import config
+from metrics import timed
+from mongo_pool import routed_database
+
+'''
+Structure of a Ledger entry (one per applied check-out/check-in item or expired lease, never updated):
+LedgerEntry = {
+    '_id': ObjectId,       # Orders the log; snapshots cover every entry below their upTo
+    'projectId': str,
+    'hwSetName': str,
+    'userId': str or None,
+    'qty': int,            # Signed: positive for check-out, negative for check-in and expire
+    'op': str,             # "check_out", "check_in", "import" or "expire" (a lease returned by the sweeper)
+    'at': datetime
+}
+
+Structure of a Snapshot header, plus one balance document per non-zero holding:
+SnapshotHeader = {'_id': ObjectId, 'upTo': ObjectId, 'takenAt': datetime, 'entries': int, 'balances': int}
+SnapshotBalance = {'snapshotId': ObjectId, 'projectId': str, 'hwSetName': str, 'quantity': int}
+
+The checkouts collection stays the materialized projection of the ledger.
+'''
+
+# Indexes the ledger queries rely on: (collection attribute on config, keys, options)
+# Ledger reads filter by project or hardware set and walk the log in _id order; time
+# ranges become _id ranges because an ObjectId starts with its creation second
+LEDGER_INDEXES = [
+    ('mongo_collection_ledger', [('hwSetName', ASCENDING), ('_id', ASCENDING)], {'name': 'hwSetName_id'}),
+    ('mongo_collection_ledger', [('projectId', ASCENDING), ('_id', ASCENDING)], {'name': 'projectId_id'}),
+    ('mongo_collection_ledger_snapshots', [('upTo', DESCENDING)], {'name': 'upTo', 'sparse': True}),
+    ('mongo_collection_ledger_snapshots', [('snapshotId', ASCENDING)], {'name': 'snapshotId', 'sparse': True})
+]
+
+def utc(moment):
+    """Treat naive datetimes (as returned by PyMongo and accepted from query strings) as UTC"""
+    if moment is not None and moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment
+
+def ledgerEntry(projectId, hwSetName, qty, userId, op):
+    """
+    Build one ledger entry.
+    Args:
+        projectId(str): The project ID
+        hwSetName(str): The hardware set name
+        qty(int): Signed quantity (negative for check-in)
+        userId(str): The user who made the request, or None
+        op(str): "check_out", "check_in", "import" or "expire"
+
+    Returns:
+        dict: The ledger entry (without _id)
+    """
+    return {
+        'projectId': projectId,
+        'hwSetName': hwSetName,
+        'userId': userId,
+        'qty': qty,
+        'op': op,
+        'at': datetime.now(timezone.utc)
+    }
+
+def foldEntries(balances, entries):
+    """
+    Apply ledger entries to a balances dict in place.
+    Args:
+        balances(dict): (projectId, hwSetName) -> quantity
+        entries(iterable): Ledger entries in log order
+
+    Returns:
+        int: Number of entries applied
+    """
+    count = 0
+    for entry in entries:
+        key = (entry['projectId'], entry['hwSetName'])
+        quantity = balances.get(key, 0) + entry['qty']
+        if quantity:
+            balances[key] = quantity
+        else:
+            balances.pop(key, None)
+        count += 1
+    return count
+
+def balanceList(balances):
+    """(projectId, hwSetName) -> quantity dict as a sorted list of balance dicts"""
+    return [
+        {'projectId': projectId, 'hwSetName': hwSetName, 'quantity': quantity}
+        for (projectId, hwSetName), quantity in sorted(balances.items())
+    ]
+
+def compareBalances(rebuilt, projection, limit=100):
+    """
+    Differences between balances rebuilt from the ledger and the checkouts projection.
+    Returns:
+        tuple: (number of mismatching holdings, the first `limit` of them)
+    """
+    mismatches = []
+    count = 0
+    for key in sorted(set(rebuilt) | set(projection)):
+        if rebuilt.get(key, 0) != projection.get(key, 0):
+            count += 1
+            if len(mismatches) < limit:
+                mismatches.append({
+                    'projectId': key[0],
+                    'hwSetName': key[1],
+                    'ledger': rebuilt.get(key, 0),
+                    'checkouts': projection.get(key, 0)
+                })
+    return count, mismatches
+
+def publicEntry(entry):
+    """JSON-friendly ledger entry"""
+    return {
+        'id': str(entry['_id']),
+        'projectId': entry['projectId'],
+        'hwSetName': entry['hwSetName'],
+        'userId': entry.get('userId'),
+        'qty': entry['qty'],
+        'op': entry['op'],
+        'at': utc(entry['at']).isoformat()
+    }
+
+def _filters(projectId=None, hwSetName=None):
+    query = {}
+    if projectId is not None:
+        query['projectId'] = projectId
+    if hwSetName is not None:
+        query['hwSetName'] = hwSetName
+    return query
+
+def _idBound(until):
+    """Exclusive _id upper bound for entries at or before `until` (an _id is created just after its `at`)"""
+    return ObjectId.from_datetime(until + timedelta(seconds=2))
+
+# Function to append entries to the ledger
+async def appendLedger(client, entries, session=None):
+    """
+    Append ledger entries. Inside a transaction they commit or roll back with the checkout writes.
+    Args:
+        client: An AsyncMongoClient instance
+        entries(list): Entries from ledgerEntry
+        session: Optional AsyncClientSession (used when running inside a transaction)
+    """
+    if not entries:
+        return
+    # Stamp at write time (and again on a transaction retry) so `at` and the _id's
+    # creation second agree, which lets time ranges be answered as _id ranges
+    now = datetime.now(timezone.utc)
+    for entry in entries:
+        entry['at'] = now
+        entry['_id'] = ObjectId()
+    ledger_col = client[config.mongo_database][config.mongo_collection_ledger]
+    if len(entries) == 1:
+        await ledger_col.insert_one(entries[0], session=session)
+    else:
+        await ledger_col.insert_many(entries, ordered=True, session=session)
+
+# Function to read ledger entries
+@timed('getLedger')
+async def getLedger(client, projectId=None, hwSetName=None, since=None, until=None, limit=100, after=None):
+    """
+    Get ledger entries in log order, optionally filtered, one page at a time.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): Only this project's entries, or None
+        hwSetName(str): Only this hardware set's entries, or None
+        since(datetime): Only entries at or after this time, or None
+        until(datetime): Only entries at or before this time, or None
+        limit(int): Maximum number of entries
+        after(str): Cursor from the previous page, or None
+
+    Returns:
+        tuple:
+            - list: JSON-friendly ledger entries
+            - str or None: Cursor for the next page, None on the last page
+    """
+    if after is not None and not ObjectId.is_valid(after):
+        raise ValueError("invalid cursor")
+    ledger_col = routed_database(client, 'getLedger')[config.mongo_collection_ledger]
+    query = _filters(projectId, hwSetName)
+    id_range = {}
+    if since is not None:
+        query.setdefault('at', {})['$gte'] = since
+        id_range['$gte'] = ObjectId.from_datetime(since)
+    if until is not None:
+        query.setdefault('at', {})['$lte'] = until
+        id_range['$lt'] = _idBound(until)
+    if after is not None:
+        id_range['$gt'] = ObjectId(after)
+    if id_range:
+        query['_id'] = id_range
+    cursor = ledger_col.find(query).sort('_id', ASCENDING).limit(limit + 1)
+    entries = [publicEntry(entry) async for entry in cursor]
+    if len(entries) > limit:
+        return entries[:limit], entries[limit - 1]['id']
+    return entries, None
+
+async def _latestSnapshot(db, before=None):
+    """Newest snapshot header, or the newest one covering only entries before `before` (an ObjectId)"""
+    snapshots_col = db[config.mongo_collection_ledger_snapshots]
+    query = {'upTo': {'$exists': True}}
+    if before is not None:
+        query['upTo'] = {'$lte': before}
+    return await snapshots_col.find_one(query, sort=[('upTo', DESCENDING)])
+
+async def _snapshotBalances(db, header, projectId=None, hwSetName=None):
+    balances = {}
+    if header is None:
+        return balances
+    snapshots_col = db[config.mongo_collection_ledger_snapshots]
+    async for balance in snapshots_col.find({'snapshotId': header['_id'], **_filters(projectId, hwSetName)}):
+        balances[(balance['projectId'], balance['hwSetName'])] = balance['quantity']
+    return balances
+
+async def _replayTail(db, header, balances, projectId=None, hwSetName=None, until=None):
+    """Fold every entry the snapshot doesn't cover (optionally up to a time) into balances"""
+    query = _filters(projectId, hwSetName)
+    if header is not None:
+        query['_id'] = {'$gte': header['upTo']}
+    if until is not None:
+        query['at'] = {'$lte': until}
+        query.setdefault('_id', {})['$lt'] = _idBound(until)
+    cursor = db[config.mongo_collection_ledger].find(
+        query, {'projectId': 1, 'hwSetName': 1, 'qty': 1}
+    ).sort('_id', ASCENDING)
+    return foldEntries(balances, [entry async for entry in cursor])
+
+def _publicHeader(header):
+    if header is None:
+        return None
+    return {
+        'id': str(header['_id']),
+        'upTo': utc(header['upTo'].generation_time).isoformat(),
+        'takenAt': utc(header['takenAt']).isoformat(),
+        'entries': header['entries'],
+        'balances': header['balances']
+    }
+
+# Function to rebuild balances at a point in time
+@timed('getBalancesAt')
+async def getBalancesAt(client, at=None, projectId=None, hwSetName=None):
+    """
+    Rebuild holdings at a point in time from the newest snapshot before it plus the ledger tail.
+    Args:
+        client: An AsyncMongoClient instance
+        at(datetime): Point in time (None for now)
+        projectId(str): Only this project's holdings, or None
+        hwSetName(str): Only this hardware set's holdings, or None
+
+    Returns:
+        dict: snapshot used, number of tail entries replayed and the balances
+    """
+    db = routed_database(client, 'getBalancesAt')
+    header = await _latestSnapshot(db, before=ObjectId.from_datetime(at) if at is not None else None)
+    balances = await _snapshotBalances(db, header, projectId, hwSetName)
+    replayed = await _replayTail(db, header, balances, projectId, hwSetName, until=at)
+    return {'snapshot': _publicHeader(header), 'replayed': replayed, 'balances': balanceList(balances)}
+
+# Function to compact the ledger into a new snapshot
+@timed('takeLedgerSnapshot')
+async def takeLedgerSnapshot(client, lag_seconds=60, keep=3, min_age_seconds=0, batch_size=1000):
+    """
+    Fold the entries since the previous snapshot into a new one.
+    Only entries older than lag_seconds are covered. An ObjectId is created on the
+    writing worker before its insert commits, so recent ids can still appear out of
+    order; the lag keeps them in the tail.
+    Args:
+        client: An AsyncMongoClient instance
+        lag_seconds(float): Leave entries newer than this in the tail
+        keep(int): Snapshots to keep (older ones are deleted; the ledger itself is never trimmed)
+        min_age_seconds(float): Skip if the latest snapshot is younger than this (another worker took it)
+        batch_size(int): Balance documents per insert_many
+
+    Returns:
+        dict: The new (or, when nothing is new, the latest) snapshot header
+    """
+    db = client[config.mongo_database]
+    snapshots_col = db[config.mongo_collection_ledger_snapshots]
+    upTo = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=lag_seconds))
+    previous = await _latestSnapshot(db)
+    if previous is not None and (
+        previous['upTo'] >= upTo or
+        utc(previous['takenAt']) > datetime.now(timezone.utc) - timedelta(seconds=min_age_seconds)
+    ):
+        return _publicHeader(previous)
+
+    balances = await _snapshotBalances(db, previous)
+    query = {'_id': {'$lt': upTo}}
+    if previous is not None:
+        query['_id']['$gte'] = previous['upTo']
+    cursor = db[config.mongo_collection_ledger].find(query, {'projectId': 1, 'hwSetName': 1, 'qty': 1}).sort('_id', ASCENDING)
+    entries = foldEntries(balances, [entry async for entry in cursor])
+    if previous is not None and entries == 0:
+        return _publicHeader(previous)
+
+    # Balance documents first, header last: a snapshot without its header is never read
+    snapshotId = ObjectId()
+    documents = [{'snapshotId': snapshotId, **balance} for balance in balanceList(balances)]
+    for start in range(0, len(documents), batch_size):
+        await snapshots_col.insert_many(documents[start:start + batch_size], ordered=False)
+    header = {
+        '_id': snapshotId,
+        'upTo': upTo,
+        'takenAt': datetime.now(timezone.utc),
+        'entries': entries + (previous['entries'] if previous else 0),
+        'balances': len(documents)
+    }
+    await snapshots_col.insert_one(header)
+
+    stale = [old['_id'] async for old in snapshots_col.find(
+        {'upTo': {'$exists': True}}, {'_id': 1}
+    ).sort('upTo', DESCENDING).skip(keep)]
+    if stale:
+        await snapshots_col.delete_many({'_id': {'$in': stale}})
+        await snapshots_col.delete_many({'snapshotId': {'$in': stale}})
+    return _publicHeader(header)
+
+# Function to audit the checkouts projection against the ledger
+@timed('auditLedger')
+async def auditLedger(client):
+    """
+    Rebuild current holdings from the newest snapshot plus the tail and compare them
+    with the checkouts collection. Check-outs in flight while the audit runs can show
+    up as transient mismatches; rerun to confirm.
+    Args:
+        client: An AsyncMongoClient instance
+
+    Returns:
+        dict: consistent flag, snapshot used, tail length and the first mismatches
+    """
+    # Compared with the checkout records, so both are read from the primary
+    db = client[config.mongo_database]
+    header = await _latestSnapshot(db)
+    rebuilt = await _snapshotBalances(db, header)
+    replayed = await _replayTail(db, header, rebuilt)
+    projection = {}
+    async for record in client[config.mongo_database][config.mongo_collection_checkouts].find({}):
+        if record.get('quantity', 0):
+            projection[(record['projectId'], record['hwSetName'])] = record['quantity']
+    count, mismatches = compareBalances(rebuilt, projection)
+    return {
+        'consistent': count == 0,
+        'snapshot': _publicHeader(header),
+        'replayed': replayed,
+        'holdings': len(projection),
+        'mismatchCount': count,
+        'mismatches': mismatches
+    }
@@ -4,38 +4,236 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv('.env', override=False)
 
+# Accepted read preference modes and read concern levels
+READ_PREFERENCES = ('primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest')
+READ_CONCERNS = ('local', 'available', 'majority')
+
 class Config:
     """Configuration class that loads settings from environment variables"""
     
-    def _get_env_var(self, var_name: str) -> str:
-        """Get environment variable with proper error handling"""
+    def _get_env_var(self, var_name: str, default: str = None) -> str:
+        """Get environment variable (required unless a default is given). A missing required one is
+        recorded in `missing` and returned as None, so the process still starts and reports itself unready"""
         value = os.getenv(var_name)
         if not value:
-            raise ValueError(f"Environment variable {var_name} is required but not set")
+            if default is not None:
+                return default
+            self.missing.append(var_name)
+            return None
         return value
     
+    def _get_int_env_var(self, var_name: str, default: int) -> int:
+        """Get optional integer environment variable, falling back to a default"""
+        value = os.getenv(var_name)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"Environment variable {var_name} must be an integer, got {value!r}")
+    
+    def _get_float_env_var(self, var_name: str, default: float) -> float:
+        """Get optional float environment variable, falling back to a default"""
+        value = os.getenv(var_name)
+        if not value:
+            return default
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(f"Environment variable {var_name} must be a number, got {value!r}")
+    
+    def _get_bool_env_var(self, var_name: str, default: bool) -> bool:
+        """Get optional boolean environment variable ('true'/'false'), falling back to a default"""
+        value = os.getenv(var_name)
+        if not value:
+            return default
+        return value.lower() == 'true'
+    
+    def _get_route_limits_env_var(self, var_name: str, default: str, queue_size: int) -> dict:
+        """Parse 'route=limit[:queue],...' into {route: (limit, queue)}; routes without a queue get queue_size"""
+        value = os.getenv(var_name) or default
+        limits = {}
+        for item in filter(None, (part.strip() for part in value.split(','))):
+            route, _, numbers = item.partition('=')
+            limit, _, queue = numbers.partition(':')
+            try:
+                limits[route.strip()] = (int(limit), int(queue) if queue else queue_size)
+            except ValueError:
+                raise ValueError(f"Environment variable {var_name} must look like '/route=limit[:queue],...', got {item!r}")
+        return limits
+    
     def __init__(self):
+        # Required variables that are not set; /readyz reports them and MongoDB is not connected
+        self.missing = []
+        # Storage backend: "mongo" (default) or "memory" (in-process engine for CI and benchmarks)
+        self.storage_backend = os.getenv('STORAGE_BACKEND', 'mongo').lower()
+        if self.storage_backend not in ('mongo', 'memory'):
+            raise ValueError("STORAGE_BACKEND must be 'mongo' or 'memory'")
+        # The memory backend never connects, so the MongoDB settings only need defaults
+        memory = self.storage_backend == 'memory'
+        
         # MONGO_HOST must be a full MongoDB connection string (mongodb:// or mongodb+srv://)
-        self.mongo_host = self._get_env_var('MONGO_HOST')
-        if not (self.mongo_host.startswith('mongodb://') or self.mongo_host.startswith('mongodb+srv://')):
+        self.mongo_host = self._get_env_var('MONGO_HOST', 'mongodb://localhost:27017' if memory else None)
+        if self.mongo_host and not (self.mongo_host.startswith('mongodb://') or self.mongo_host.startswith('mongodb+srv://')):
             raise ValueError("MONGO_HOST must be a full MongoDB connection string (starting with mongodb:// or mongodb+srv://)")
         
-        self.mongo_database = self._get_env_var('MONGO_DATABASE')
-        self.mongo_collection_hardware = self._get_env_var('MONGO_COLLECTION_HARDWARE')
-        self.mongo_collection_checkouts = self._get_env_var('MONGO_COLLECTION_CHECKOUTS')
-        self.service_port = int(self._get_env_var('SERVICE_PORT'))
+        self.mongo_database = self._get_env_var('MONGO_DATABASE', 'HardwareService' if memory else None)
+        self.mongo_collection_hardware = self._get_env_var('MONGO_COLLECTION_HARDWARE', 'hardware' if memory else None)
+        self.mongo_collection_checkouts = self._get_env_var('MONGO_COLLECTION_CHECKOUTS', 'project_checkouts' if memory else None)
+        # Falls back to the port the Dockerfile exposes, so a misconfigured worker can still answer probes
+        self.service_port = int(self._get_env_var('SERVICE_PORT') or 5002)
         self.environment = self._get_env_var('ENVIRONMENT')
-    
+        
+        # Connection pool settings (optional) - one pooled client is shared per worker
+        self.mongo_allow_invalid_certs = self._get_bool_env_var('MONGO_ALLOW_INVALID_CERTS', True)
+        self.mongo_max_pool_size = self._get_int_env_var('MONGO_MAX_POOL_SIZE', 100)
+        self.mongo_min_pool_size = self._get_int_env_var('MONGO_MIN_POOL_SIZE', 0)
+        self.mongo_max_idle_time_ms = self._get_int_env_var('MONGO_MAX_IDLE_TIME_MS', 60000)
+        self.mongo_wait_queue_timeout_ms = self._get_int_env_var('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000)
+        self.mongo_server_selection_timeout_ms = self._get_int_env_var('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)
+        self.mongo_connect_timeout_ms = self._get_int_env_var('MONGO_CONNECT_TIMEOUT_MS', 10000)
+        self.mongo_socket_timeout_ms = self._get_int_env_var('MONGO_SOCKET_TIMEOUT_MS', 20000)
+        if self.mongo_min_pool_size > self.mongo_max_pool_size:
+            raise ValueError("MONGO_MIN_POOL_SIZE cannot be greater than MONGO_MAX_POOL_SIZE")
+        # Write path (check-out/check-in, leases, waitlist, imports): always the primary, with this
+        # write concern ('majority' or a node count; timeout 0 = wait indefinitely) and read concern
+        self.mongo_write_concern = os.getenv('MONGO_WRITE_CONCERN', 'majority')
+        self.mongo_write_concern_timeout_ms = self._get_int_env_var('MONGO_WRITE_CONCERN_TIMEOUT_MS', 0)
+        self.mongo_read_concern = os.getenv('MONGO_READ_CONCERN', 'local')
+        # Read-only operations (hardware lookups for /get_hw_info*, name listings, reports, ledger
+        # queries, export) may be routed elsewhere: read preference, max staleness (-1 = unbounded,
+        # otherwise at least 90 s as MongoDB requires) and read concern, plus per-operation
+        # read preference overrides as 'operation=readPreference,...'
+        self.mongo_read_only_read_preference = os.getenv('MONGO_READ_ONLY_READ_PREFERENCE', 'primary')
+        self.mongo_read_only_max_staleness_seconds = self._get_int_env_var('MONGO_READ_ONLY_MAX_STALENESS_SECONDS', -1)
+        self.mongo_read_only_read_concern = os.getenv('MONGO_READ_ONLY_READ_CONCERN', 'local')
+        self.mongo_operation_read_preferences = dict(
+            (name.strip(), preference.strip()) for name, _, preference in
+            (item.partition('=') for item in os.getenv('MONGO_OPERATION_READ_PREFERENCES', '').split(',') if item.strip())
+        )
+        for preference in (self.mongo_read_only_read_preference, *self.mongo_operation_read_preferences.values()):
+            if preference not in READ_PREFERENCES:
+                raise ValueError(f"Read preferences must be one of {', '.join(READ_PREFERENCES)}, got {preference!r}")
+        for level in (self.mongo_read_concern, self.mongo_read_only_read_concern):
+            if level not in READ_CONCERNS:
+                raise ValueError(f"Read concerns must be one of {', '.join(READ_CONCERNS)}, got {level!r}")
+        if self.mongo_read_only_max_staleness_seconds != -1 and self.mongo_read_only_max_staleness_seconds < 90:
+            raise ValueError("MONGO_READ_ONLY_MAX_STALENESS_SECONDS must be -1 or at least 90")
+        # Connections opened by the background warm-up before the worker reports ready
+        self.mongo_warmup_connections = min(
+            self._get_int_env_var('MONGO_WARMUP_CONNECTIONS', max(1, self.mongo_min_pool_size)),
+            self.mongo_max_pool_size
+        )
+        # Readiness probe behind /readyz: how often each worker pings storage, and how long a ping may take
+        self.readiness_probe_interval_seconds = self._get_float_env_var('READINESS_PROBE_INTERVAL_SECONDS', 5.0)
+        self.readiness_probe_timeout_seconds = self._get_float_env_var('READINESS_PROBE_TIMEOUT_SECONDS', 2.0)
+        
+        # Run check-out/check-in writes in one transaction (ignored on a standalone server)
+        self.mongo_use_transactions = self._get_bool_env_var('MONGO_USE_TRANSACTIONS', False)
+        
+        # Hardware set read cache; the TTL bounds how stale a read can be after another process writes
+        self.hw_cache_enabled = self._get_bool_env_var('HW_CACHE_ENABLED', True)
+        self.hw_cache_ttl_seconds = self._get_float_env_var('HW_CACHE_TTL_SECONDS', 1.0)
+        self.hw_cache_max_entries = self._get_int_env_var('HW_CACHE_MAX_ENTRIES', 10000)
+        # Holdings/utilization report cache (TTL 0 disables it); local checkout writes invalidate immediately
+        self.report_cache_ttl_seconds = self._get_float_env_var('REPORT_CACHE_TTL_SECONDS', 5.0)
+        self.report_cache_max_entries = self._get_int_env_var('REPORT_CACHE_MAX_ENTRIES', 1000)
+        
+        # Change-stream watcher serving hardware reads from memory (replica set or sharded cluster only)
+        self.hw_watcher_enabled = self._get_bool_env_var('HW_WATCHER_ENABLED', False)
+        self.hw_watcher_persist_seconds = self._get_float_env_var('HW_WATCHER_PERSIST_SECONDS', 5.0)
+        # Hardware name listing: largest page for /get_hw_names and cursor batch size for streaming
+        self.hw_names_max_page_size = self._get_int_env_var('HW_NAMES_MAX_PAGE_SIZE', 1000)
+        self.hw_names_stream_batch_size = self._get_int_env_var('HW_NAMES_STREAM_BATCH_SIZE', 500)
+        # Most names one /get_hw_info_batch request may ask for
+        self.hw_info_max_names = self._get_int_env_var('HW_INFO_MAX_NAMES', 500)
+        
+        # Documents per insert_many batch (bulk import) and per cursor batch (export)
+        self.import_batch_size = self._get_int_env_var('IMPORT_BATCH_SIZE', 1000)
+        
+        self.mongo_collection_service_state = os.getenv('MONGO_COLLECTION_SERVICE_STATE', 'service_state')
+        
+        # Idempotency-Key records for /check_out and /check_in; a TTL index removes them after the TTL
+        self.mongo_collection_idempotency = os.getenv('MONGO_COLLECTION_IDEMPOTENCY', 'idempotency_keys')
+        self.idempotency_ttl_seconds = self._get_int_env_var('IDEMPOTENCY_TTL_SECONDS', 86400)
+        self.idempotency_cache_max_entries = self._get_int_env_var('IDEMPOTENCY_CACHE_MAX_ENTRIES', 10000)
+        
+        # Append-only checkout ledger and its compacted snapshots (interval 0 disables periodic snapshots)
+        self.mongo_collection_ledger = os.getenv('MONGO_COLLECTION_LEDGER', 'checkout_ledger')
+        self.mongo_collection_ledger_snapshots = os.getenv('MONGO_COLLECTION_LEDGER_SNAPSHOTS', 'checkout_ledger_snapshots')
+        self.ledger_snapshot_interval_seconds = self._get_float_env_var('LEDGER_SNAPSHOT_INTERVAL_SECONDS', 3600.0)
+        self.ledger_snapshot_lag_seconds = self._get_float_env_var('LEDGER_SNAPSHOT_LAG_SECONDS', 60.0)
+        self.ledger_snapshots_kept = self._get_int_env_var('LEDGER_SNAPSHOTS_KEPT', 3)
+        
+        # Checkout leases: default/maximum lease length (default 0 = no lease unless requested)
+        # and how often each worker sweeps overdue leases (0 disables the sweeper)
+        self.lease_default_seconds = self._get_int_env_var('LEASE_DEFAULT_SECONDS', 0)
+        self.lease_max_seconds = self._get_int_env_var('LEASE_MAX_SECONDS', 30 * 86400)
+        self.lease_sweep_interval_seconds = self._get_float_env_var('LEASE_SWEEP_INTERVAL_SECONDS', 30.0)
+        self.lease_sweep_batch_size = self._get_int_env_var('LEASE_SWEEP_BATCH_SIZE', 500)
+        
+        # Write combiner: concurrent check-outs/check-ins of one hardware set are gathered for up to
+        # WRITE_COMBINER_WINDOW_MS and applied as one write (Mongo backend only)
+        self.write_combiner_enabled = self._get_bool_env_var('WRITE_COMBINER_ENABLED', False)
+        self.write_combiner_window_ms = self._get_float_env_var('WRITE_COMBINER_WINDOW_MS', 1.0)
+        self.write_combiner_max_batch = self._get_int_env_var('WRITE_COMBINER_MAX_BATCH', 256)
+        
+        # Sharded availability counters: a sharded set keeps its availability on up to
+        # HW_SHARDS_MAX sub-counter documents instead of one field (Mongo backend only)
+        self.mongo_collection_hw_shards = os.getenv('MONGO_COLLECTION_HW_SHARDS', 'hardware_shards')
+        self.hw_shards_max = self._get_int_env_var('HW_SHARDS_MAX', 64)
+        
+        # Checkout waitlist: how long an entry may wait, how long finished entries are kept (TTL index),
+        # how often each worker checks on entries its clients are waiting for and drains every
+        # waitlist (0 disables the periodic drain), and the longest long-poll
+        self.mongo_collection_waitlist = os.getenv('MONGO_COLLECTION_WAITLIST', 'checkout_waitlist')
+        self.waitlist_max_wait_seconds = self._get_int_env_var('WAITLIST_MAX_WAIT_SECONDS', 3600)
+        self.waitlist_retention_seconds = self._get_int_env_var('WAITLIST_RETENTION_SECONDS', 86400)
+        self.waitlist_poll_interval_seconds = self._get_float_env_var('WAITLIST_POLL_INTERVAL_SECONDS', 1.0)
+        self.waitlist_drain_interval_seconds = self._get_float_env_var('WAITLIST_DRAIN_INTERVAL_SECONDS', 10.0)
+        self.waitlist_long_poll_max_seconds = self._get_float_env_var('WAITLIST_LONG_POLL_MAX_SECONDS', 60.0)
+
+        # Live availability stream: how often each worker re-reads followed sets the watcher
+        # can't see (every followed set without the watcher; 0 disables polling, leaving only
+        # this worker's own writes), and the keep-alive comment interval of idle streams
+        self.availability_stream_poll_seconds = self._get_float_env_var('AVAILABILITY_STREAM_POLL_SECONDS', 1.0)
+        self.availability_stream_heartbeat_seconds = self._get_float_env_var('AVAILABILITY_STREAM_HEARTBEAT_SECONDS', 15.0)
+
+        # Admission control (per worker): each listed route runs at most `limit` requests at once
+        # with up to `queue` more waiting; all of them also share ADMISSION_MAX_IN_FLIGHT slots, of
+        # which ADMISSION_READ_RESERVED only GET requests may use. Requests that find the queue full
+        # or wait longer than ADMISSION_QUEUE_TIMEOUT_SECONDS get 503 with Retry-After
+        self.admission_enabled = self._get_bool_env_var('ADMISSION_ENABLED', False)
+        self.admission_queue_size = self._get_int_env_var('ADMISSION_QUEUE_SIZE', 64)
+        self.admission_route_limits = self._get_route_limits_env_var(
+            'ADMISSION_ROUTE_LIMITS',
+            '/check_out=64,/check_in=64,/check_out_batch=16,/check_in_batch=16,/renew_lease=32,'
+            '/get_hw_info=256:256,/get_hw_info_batch=64,/projects/{projectId}/holdings=32,/utilization=8',
+            self.admission_queue_size
+        )
+        self.admission_max_in_flight = self._get_int_env_var('ADMISSION_MAX_IN_FLIGHT', 256)
+        self.admission_read_reserved = self._get_int_env_var('ADMISSION_READ_RESERVED', 32)
+        self.admission_queue_timeout_seconds = self._get_float_env_var('ADMISSION_QUEUE_TIMEOUT_SECONDS', 1.0)
+        self.admission_retry_after_seconds = self._get_int_env_var('ADMISSION_RETRY_AFTER_SECONDS', 1)
+        if self.admission_max_in_flight and self.admission_read_reserved >= self.admission_max_in_flight:
+            raise ValueError("ADMISSION_READ_RESERVED must be less than ADMISSION_MAX_IN_FLIGHT")
+        # Per-project token bucket on routes whose JSON body carries projectId (0 disables it)
+        self.project_rate_limit_per_second = self._get_float_env_var('PROJECT_RATE_LIMIT_PER_SECOND', 0.0)
+        self.project_rate_limit_burst = self._get_int_env_var('PROJECT_RATE_LIMIT_BURST', 20)
+        self.project_rate_limit_routes = [route.strip() for route in os.getenv(
+            'PROJECT_RATE_LIMIT_ROUTES', '/check_out,/check_in,/check_out_batch,/check_in_batch,/renew_lease'
+        ).split(',') if route.strip()]
+        self.project_rate_limit_max_projects = self._get_int_env_var('PROJECT_RATE_LIMIT_MAX_PROJECTS', 100000)
+
     def get_mongodb_connection_string(self) -> str:
         """Return MongoDB connection string with TLS parameters if needed"""
+        if self.missing:
+            raise ValueError(f"Missing required environment variables: {', '.join(self.missing)}")
         conn_str = self.mongo_host
         
         # Add tlsAllowInvalidCertificates to connection string if needed
         # This is more reliable than client parameter for mongodb+srv://
-        import os
-        allow_invalid_certs = os.getenv('MONGO_ALLOW_INVALID_CERTS', 'true').lower() == 'true'
-        
-        if allow_invalid_certs and 'mongodb+srv://' in conn_str:
+        if self.mongo_allow_invalid_certs and 'mongodb+srv://' in conn_str:
             # Add tlsAllowInvalidCertificates to query parameters
             if '?' in conn_str:
                 if 'tlsAllowInvalidCertificates' not in conn_str:
@@ -47,7 +245,7 @@ class Config:
     
     def validate_config(self) -> bool:
         """Validate that required configuration is present"""
-        return bool(self.mongo_host and self.mongo_database)
+        return not self.missing and bool(self.mongo_host and self.mongo_database)
 
 # Global config instance
 config = Config()
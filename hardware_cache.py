@@ -0,0 +1,107 @@
+# In-process read-through cache for hardware set documents
+import time
+from collections import OrderedDict
+from config import config
+
+class HardwareCache:
+    """
+    LRU cache of hardware set documents keyed by hwSetName, with a TTL.
+    The TTL is the staleness bound for writes made by other processes; writes made
+    through this process's data layer update or invalidate entries immediately.
+    Only touched from the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, hwSetName):
+        """
+        Return the cached document, or None on a miss or an expired entry.
+        Args:
+            hwSetName(str): The hardware set name
+
+        Returns:
+            dict or None: The cached hardware set document
+        """
+        entry = self._entries.get(hwSetName)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, hw_set = entry
+        if expires_at <= time.monotonic():
+            del self._entries[hwSetName]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(hwSetName)
+        self.hits += 1
+        return hw_set
+
+    def put(self, hw_set):
+        """
+        Store (or refresh) a hardware set document, evicting the least recently used entry if full.
+        A document older (by version) than the cached one is ignored, so concurrent writes
+        finishing out of order can't roll the cached copy back.
+        Args:
+            hw_set(dict): A hardware set document including hwSetName
+        """
+        if not self.enabled:
+            return
+        hwSetName = hw_set['hwSetName']
+        current = self._entries.get(hwSetName)
+        if current is not None and current[1].get('version', 0) > hw_set.get('version', 0):
+            return
+        self._entries[hwSetName] = (time.monotonic() + self.ttl_seconds, hw_set)
+        self._entries.move_to_end(hwSetName)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, hwSetName):
+        """
+        Drop a hardware set from the cache.
+        Args:
+            hwSetName(str): The hardware set name
+        """
+        if self._entries.pop(hwSetName, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """
+        Return cache counters.
+        Returns:
+            dict: Settings, size and hit/miss/eviction counters
+        """
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "maxEntries": self.max_entries,
+            "ttlSeconds": self.ttl_seconds,
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+# Global cache instance shared by the async data layer
+hardware_cache = HardwareCache(
+    config.hw_cache_max_entries if config.hw_cache_enabled else 0,
+    config.hw_cache_ttl_seconds
+)
@@ -1,5 +1,6 @@
 # Import necessary libraries and modules
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from config import config
 
 '''
@@ -35,17 +36,17 @@ def createHardwareSet(client, hwSetName, initCapacity):
     db = client[config.mongo_database]
     hw_col = db[config.mongo_collection_hardware]
 
-    existing = hw_col.find_one({"hwSetName": hwSetName})
-    if existing:
-        return False, f"{hwSetName} set already exists"
-
     hw_set = {
         'hwSetName': hwSetName,
         'capacity': initCapacity,
         'availability': initCapacity
     }
 
-    hw_col.insert_one(hw_set)
+    # The unique index on hwSetName rejects duplicates atomically (no find-then-insert race)
+    try:
+        hw_col.insert_one(hw_set)
+    except DuplicateKeyError:
+        return False, f"{hwSetName} set already exists"
     return True, "Hardware set created successfully!"
 
 # Function to query a hardware set by its name
@@ -74,6 +75,8 @@ def queryHardwareSet(client, hwSetName):
 def updateAvailability(client, hwSetName, delta):
     """
     Update the availability of an existing hardware set.
+    The bounds check and the increment happen in one conditional update, so
+    concurrent callers can never push availability below 0 or above capacity.
     Args:
         client: A MongoClient instance
         hwSetName(str): The hardware set name
@@ -85,53 +88,38 @@ def updateAvailability(client, hwSetName, delta):
     db = client[config.mongo_database]
     hw_col = db[config.mongo_collection_hardware]
 
-    hw_set = hw_col.find_one({"hwSetName": hwSetName})
-    if not hw_set:
-        return False
-    
-    currAvailability = hw_set.get('availability')
-    currCapacity = hw_set.get("capacity")
-    newAvailability = currAvailability + delta
-
-    # Check if the new availability is valid (not negative, not exceeding capacity)
-    if newAvailability < 0 or newAvailability > currCapacity:
-        return False
+    if delta >= 0:
+        guard = {'$expr': {'$lte': [{'$add': ['$availability', delta]}, '$capacity']}}
+    else:
+        guard = {'availability': {'$gte': -delta}}
 
-    hw_col.update_one(
-        {'hwSetName': hwSetName}, 
-        {'$set': {'availability': newAvailability}}
+    result = hw_col.update_one(
+        {'hwSetName': hwSetName, **guard},
+        {'$inc': {'availability': delta}}
     )
-    return True
+    return result.matched_count == 1
 
 # Function to request space from a hardware set
 def requestSpace(client, hwSetName, amount):
     """
     Request a certain amount of hardware and update availability.
+    A single guarded $inc: it only matches when enough units are available.
     Args:
         client: A MongoClient instance
         hwSetName(str): The hardware set name
         amount(int): The amount to request
     
     Returns:
-        bool: True if successful, False otherwise
+        bool: True if successful, False otherwise (missing set or not enough units)
     """
     db = client[config.mongo_database]
     hw_col = db[config.mongo_collection_hardware]
 
-    hw_set = hw_col.find_one({"hwSetName": hwSetName})
-    if not hw_set:
-        return False
-
-    currAvailability = hw_set.get('availability')
-
-    if currAvailability >= amount:
-        hw_col.update_one(
-            {'hwSetName': hwSetName}, 
-            {'$set': {'availability': currAvailability - amount}}
-        )
-        return True
-    else:
-        return False
+    result = hw_col.update_one(
+        {'hwSetName': hwSetName, 'availability': {'$gte': amount}},
+        {'$inc': {'availability': -amount}}
+    )
+    return result.modified_count == 1
 
 # Function to get all hardware set names
 def getAllHwSetNames(client):
@@ -177,6 +165,8 @@ def getProjectCheckout(client, projectId, hwSetName):
 def updateProjectCheckout(client, projectId, hwSetName, qty):
     """
     Update or create a project's checkout record.
+    Check-outs are an upserted $inc; check-ins are a $inc guarded by the quantity
+    currently held, so the record can never go negative.
     Args:
         client: A MongoClient instance
         projectId(str): The project ID
@@ -188,39 +178,25 @@ def updateProjectCheckout(client, projectId, hwSetName, qty):
     """
     db = client[config.mongo_database]
     checkout_col = db[config.mongo_collection_checkouts]
+    record_filter = {"projectId": projectId, "hwSetName": hwSetName}
     
-    # Try to find existing record
-    existing = checkout_col.find_one({
-        "projectId": projectId,
-        "hwSetName": hwSetName
-    })
+    if qty > 0:
+        # Create the record on first checkout, otherwise add to it; the unique
+        # (projectId, hwSetName) index makes concurrent first upserts converge on one record
+        checkout_col.update_one(record_filter, {"$inc": {"quantity": qty}}, upsert=True)
+        return True
     
-    if existing:
-        # Update existing record
-        new_qty = existing.get('quantity', 0) + qty
-        if new_qty < 0:
-            return False  # Cannot have negative checkout
-        if new_qty == 0:
-            # Remove record if quantity becomes zero
-            checkout_col.delete_one({
-                "projectId": projectId,
-                "hwSetName": hwSetName
-            })
-        else:
-            checkout_col.update_one(
-                {"projectId": projectId, "hwSetName": hwSetName},
-                {"$set": {"quantity": new_qty}}
-            )
-    else:
-        # Create new record if qty > 0
-        if qty > 0:
-            checkout_col.insert_one({
-                "projectId": projectId,
-                "hwSetName": hwSetName,
-                "quantity": qty
-            })
-        else:
-            return False  # Cannot check in more than checked out
+    updated = checkout_col.find_one_and_update(
+        {**record_filter, "quantity": {"$gte": -qty}},
+        {"$inc": {"quantity": qty}},
+        projection={"quantity": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated:
+        return False  # Cannot check in more than checked out
+    
+    if updated.get('quantity', 0) == 0:
+        # Remove record once nothing is checked out; matching on 0 keeps a concurrent checkout intact
+        checkout_col.delete_one({**record_filter, "quantity": 0})
     
     return True
-
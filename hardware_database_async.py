@@ -0,0 +1,2144 @@
+# Async counterpart of hardware_database: same functions and return values,
+# awaited from the FastAPI routes so Mongo round-trips don't block the event loop
+import asyncio
+import random
+import re
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from config import config
+from hardware_cache import hardware_cache
+from report_cache import UTILIZATION, holdings_key, report_cache
+from idempotency import idempotency_cache, request_fingerprint
+from checkout_ledger import LEDGER_INDEXES, appendLedger, ledgerEntry, utc
+from metrics import count_lease_return_failure, count_rollback, timed
+from mongo_pool import read_preference_of, routed_database
+
+'''
+Structure of Hardware Set entry:
+HardwareSet = {
+    'hwSetName': hwSetName,
+    'capacity': int,
+    'availability': int,  # Absent on sharded sets
+    'version': int,       # Bumped by every availability write; served as the ETag
+    'shards': int         # Only on sharded sets: number of HardwareShard documents
+}
+
+Structure of a Hardware Shard entry (one sub-counter of a sharded set):
+HardwareShard = {
+    'hwSetName': str,
+    'shard': int,         # 0 .. shards - 1
+    'capacity': int,      # The shards' capacities add up to the set's capacity
+    'availability': int,
+    'version': int        # A sharded set's version is its own plus the sum of its shards'
+}
+
+Structure of Project Checkout entry:
+ProjectCheckout = {
+    'projectId': str,
+    'hwSetName': str,
+    'quantity': int,
+    'expiresAt': datetime, # Only on leased holdings; the lease sweeper returns the units after it
+    'grants': [str]        # waitIds of waitlist grants without a transaction that are not finished yet
+}
+
+Structure of a Waitlist entry (a check-out waiting for availability):
+WaitlistEntry = {
+    '_id': ObjectId,        # Arrival order; also the waitId
+    'hwSetName': str,
+    'projectId': str,
+    'userId': str or None,
+    'qty': int,
+    'priority': int,        # Higher is served first
+    'leaseSeconds': int or None,
+    'status': str,          # "waiting", "granting", "granted", "cancelled" or "expired"
+    'grantingAt': datetime, # When the current grant claimed the entry (granting only)
+    'createdAt': datetime,  # TTL index field
+    'giveUpAt': datetime,
+    'grantedAt': datetime,
+    'idempotencyKey': str   # Only when the request carried an Idempotency-Key
+}
+'''
+
+# Indexes every query path relies on: (collection attribute on config, keys, options)
+INDEXES = [
+    ('mongo_collection_hardware', [('hwSetName', ASCENDING)], {'name': 'hwSetName_unique', 'unique': True}),
+    ('mongo_collection_hw_shards', [('hwSetName', ASCENDING), ('shard', ASCENDING)],
+     {'name': 'hwSetName_shard_unique', 'unique': True}),
+    # The (projectId, hwSetName) prefix also serves per-project listing, so no separate projectId index
+    ('mongo_collection_checkouts', [('projectId', ASCENDING), ('hwSetName', ASCENDING)],
+     {'name': 'projectId_hwSetName_unique', 'unique': True}),
+    # Per-set totals for the utilization report
+    ('mongo_collection_checkouts', [('hwSetName', ASCENDING), ('projectId', ASCENDING)],
+     {'name': 'hwSetName_projectId'}),
+    # Overdue leases in expiry order; sparse, so unleased holdings cost the sweeper nothing
+    ('mongo_collection_checkouts', [('expiresAt', ASCENDING)], {'name': 'expiresAt', 'sparse': True}),
+    # Idempotency-Key records are removed by the server once they are older than the TTL
+    ('mongo_collection_idempotency', [('createdAt', ASCENDING)],
+     {'name': 'createdAt_ttl', 'expireAfterSeconds': config.idempotency_ttl_seconds}),
+    # Queue heads in service order for one hardware set
+    ('mongo_collection_waitlist', [('hwSetName', ASCENDING), ('status', ASCENDING), ('priority', DESCENDING), ('_id', ASCENDING)],
+     {'name': 'hwSetName_status_priority_id'}),
+    ('mongo_collection_waitlist', [('status', ASCENDING), ('giveUpAt', ASCENDING)], {'name': 'status_giveUpAt'}),
+    ('mongo_collection_waitlist', [('idempotencyKey', ASCENDING)], {'name': 'idempotencyKey_unique', 'unique': True, 'sparse': True}),
+    # Finished entries are removed by the server once they are older than the retention
+    ('mongo_collection_waitlist', [('createdAt', ASCENDING)],
+     {'name': 'createdAt_ttl', 'expireAfterSeconds': config.waitlist_retention_seconds}),
+    *LEDGER_INDEXES
+]
+
+# Function to create the indexes the service needs
+async def ensureIndexes(client):
+    """
+    Create the service's indexes. create_index is a no-op when an identical index
+    already exists, so this is safe to run on every startup.
+    Args:
+        client: An AsyncMongoClient instance
+    
+    Returns:
+        list: (collection name, index name, error message or None) per index
+    """
+    db = client[config.mongo_database]
+    results = []
+    for collection_attr, keys, options in INDEXES:
+        collection_name = getattr(config, collection_attr)
+        try:
+            await db[collection_name].create_index(keys, **options)
+            results.append((collection_name, options['name'], None))
+        except OperationFailure as e:
+            # e.g. existing duplicates block a unique index; keep serving without it
+            results.append((collection_name, options['name'], str(e)))
+    return results
+
+def _cacheAfterWrite(hwSetName, updated, session):
+    """Write-through: cache the post-write document, or drop the entry when it can't be trusted"""
+    if updated is not None and session is None:
+        hardware_cache.put(updated)
+    else:
+        # A failed guard means our copy may be stale; a transaction write is not committed yet
+        hardware_cache.invalidate(hwSetName)
+    report_cache.invalidateUtilization()
+
+# Callbacks told about every availability write this process makes: callback(hwSetName, hw_set).
+# hw_set is the set after the write, or None when it isn't known (sharded sets, transactions)
+_availabilityListeners = []
+
+def addAvailabilityListener(callback):
+    _availabilityListeners.append(callback)
+
+def removeAvailabilityListener(callback):
+    if callback in _availabilityListeners:
+        _availabilityListeners.remove(callback)
+
+def announceAvailability(hwSetName, hw_set=None):
+    """Tell the availability listeners a set changed. Also called by the in-memory storage backend"""
+    for callback in _availabilityListeners:
+        try:
+            callback(hwSetName, hw_set)
+        except Exception as e:
+            print(f"⚠ Availability listener failed: {e}")
+
+# session -> names of the sets its transaction changed, announced by _runInTransaction once it commits
+_pendingAnnouncements = {}
+
+def _announceWrite(hwSetName, hw_set=None, session=None):
+    """Announce a write now, or after commit when it is part of a transaction (a listener's
+    re-read before then would see the old value, and an aborted write must not be announced)"""
+    pending = _pendingAnnouncements.get(session) if session is not None else None
+    if pending is not None:
+        pending.add(hwSetName)
+    else:
+        announceAvailability(hwSetName, hw_set if session is None else None)
+
+# hwSetName -> shard count of every sharded set this worker has seen. A set never goes back to
+# a single counter, so an entry stays valid for the life of the process
+_shardCounts = {}
+
+def _shardCollection(client):
+    return client[config.mongo_database][config.mongo_collection_hw_shards]
+
+def _availabilityGuard(delta):
+    """Filter that only matches a document whose availability stays within [0, capacity] after adding delta"""
+    if delta >= 0:
+        # $exists: on a sharded set's document a missing availability would pass the $expr as null
+        return {'availability': {'$exists': True}, '$expr': {'$lte': [{'$add': ['$availability', delta]}, '$capacity']}}
+    return {'availability': {'$gte': -delta}}
+
+def splitCapacity(capacity, shards):
+    """Capacity of each of `shards` sub-counters: as even as possible, adding up to capacity"""
+    return [capacity // shards + (1 if i < capacity % shards else 0) for i in range(shards)]
+
+async def _shardsOf(client, hwSetName, session=None):
+    """Shard count of a set (0 when it has a single counter or does not exist), read from the database"""
+    if hwSetName in _shardCounts:
+        return _shardCounts[hwSetName]
+    hw_set = await client[config.mongo_database][config.mongo_collection_hardware].find_one(
+        {'hwSetName': hwSetName}, {'shards': 1}, session=session
+    )
+    shards = (hw_set or {}).get('shards', 0)
+    if shards:
+        _shardCounts[hwSetName] = shards
+    return shards
+
+async def _withShardTotals(client, hw_sets, session=None, db=None):
+    """Fill in the availability and version of sharded sets among hw_sets (in place) with one $in query over their shards.
+    db is a routed database for read-only callers (see mongo_pool.routed_database)"""
+    sharded = {hw_set['hwSetName']: hw_set for hw_set in hw_sets if hw_set.get('shards')}
+    if not sharded:
+        return hw_sets
+    totals = Counter()
+    shard_col = _shardCollection(client) if db is None else db[config.mongo_collection_hw_shards]
+    cursor = shard_col.find(
+        {'hwSetName': {'$in': list(sharded)}}, {'hwSetName': 1, 'availability': 1, 'version': 1}, session=session
+    )
+    versions = Counter()
+    async for shard in cursor:
+        totals[shard['hwSetName']] += shard['availability']
+        versions[shard['hwSetName']] += shard.get('version', 0)
+    for hwSetName, hw_set in sharded.items():
+        _shardCounts[hwSetName] = hw_set['shards']
+        hw_set['availability'] = totals[hwSetName]
+        # Every shard's version only grows, so the sum does too
+        hw_set['version'] = hw_set.get('version', 0) + versions[hwSetName]
+    return hw_sets
+
+async def _loadHardwareSet(client, hwSetName, session=None, db=None):
+    """Read a set from the database (never the cache), with a sharded set's availability summed"""
+    if db is None:
+        db = client[config.mongo_database]
+    hw_set = await db[config.mongo_collection_hardware].find_one({'hwSetName': hwSetName}, session=session)
+    if hw_set is not None:
+        await _withShardTotals(client, [hw_set], session=session, db=db)
+    return hw_set
+
+async def _spreadShardInc(client, hwSetName, shards, delta, session=None):
+    """No single shard can take delta: move it piece by piece, fullest (or emptiest) shards first.
+    Everything moved is put back if the shards stop being able to take it part way through"""
+    shard_col = _shardCollection(client)
+    sign = 1 if delta > 0 else -1
+    room = (lambda shard: shard['capacity'] - shard['availability']) if delta > 0 else (lambda shard: shard['availability'])
+    need, moved = abs(delta), 0
+    shard_docs = sorted([shard async for shard in shard_col.find({'hwSetName': hwSetName}, session=session)], key=room, reverse=True)
+    if sum(room(shard) for shard in shard_docs) < need:
+        # Don't move anything: units added to some shards could be taken before they were put back
+        return False
+    for shard in shard_docs:
+        part = min(need - moved, room(shard))
+        if part <= 0:
+            continue
+        result = await shard_col.update_one(
+            {'_id': shard['_id'], **_availabilityGuard(sign * part)},
+            {'$inc': {'availability': sign * part, 'version': 1}}, session=session
+        )
+        moved += part * result.modified_count
+        if moved == need:
+            return True
+    if moved:
+        count_rollback('compensating')
+        if not await _shardedInc(client, hwSetName, shards, -sign * moved, session=session):
+            print(f"⚠ Could not put back {moved} units moved between shards of {hwSetName}")
+    return False
+
+async def _shardedInc(client, hwSetName, shards, delta, session=None):
+    """
+    Guarded change of a sharded set's availability. A random shard is tried first,
+    so concurrent writers land on different documents; if it can't take the whole
+    delta, one query picks the fullest shard (taking units) or the emptiest one
+    (returning units), which also keeps the shards level without a separate
+    rebalancing pass. Only when no single shard can take it is delta spread over several.
+    """
+    shard_col = _shardCollection(client)
+    guard = _availabilityGuard(delta)
+    result = await shard_col.update_one(
+        {'hwSetName': hwSetName, 'shard': random.randrange(shards), **guard},
+        {'$inc': {'availability': delta, 'version': 1}}, session=session
+    )
+    if result.modified_count:
+        return True
+    updated = await shard_col.find_one_and_update(
+        {'hwSetName': hwSetName, **guard}, {'$inc': {'availability': delta, 'version': 1}},
+        projection={'_id': 1}, sort=[('availability', DESCENDING if delta < 0 else ASCENDING)], session=session
+    )
+    if updated is not None:
+        return True
+    return await _spreadShardInc(client, hwSetName, shards, delta, session=session)
+
+async def _incAvailability(client, hwSetName, delta, session=None):
+    """Guarded $inc of a set's availability, on its shards when it is sharded"""
+    shards = _shardCounts.get(hwSetName)
+    if shards is None:
+        updated = await client[config.mongo_database][config.mongo_collection_hardware].find_one_and_update(
+            {'hwSetName': hwSetName, **_availabilityGuard(delta)},
+            {'$inc': {'availability': delta, 'version': 1}},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        _cacheAfterWrite(hwSetName, updated, session)
+        if updated is not None:
+            _announceWrite(hwSetName, updated, session)
+            return True
+        # The guard also fails on a sharded set we have not seen yet
+        shards = await _shardsOf(client, hwSetName, session=session)
+        if not shards:
+            return False
+    applied = await _shardedInc(client, hwSetName, shards, delta, session=session)
+    # The cached total can't be updated from one shard's document
+    _cacheAfterWrite(hwSetName, None, session)
+    if applied:
+        _announceWrite(hwSetName, session=session)
+    return applied
+
+async def _incAvailabilities(client, changes, session=None):
+    """
+    Apply (hwSetName, delta) changes: one unordered bulk write for single-counter sets,
+    shard by shard for sharded ones. Returns True if every guard held.
+    The sets must have been read first (see _findHardwareSets), so sharded ones are known.
+    """
+    plain = [(name, delta) for name, delta in changes if name not in _shardCounts]
+    if plain:
+        result = await client[config.mongo_database][config.mongo_collection_hardware].bulk_write([
+            UpdateOne({'hwSetName': name, **_availabilityGuard(delta)}, {'$inc': {'availability': delta, 'version': 1}})
+            for name, delta in plain
+        ], ordered=False, session=session)
+        if result.modified_count != len(plain):
+            return False
+    for name, delta in changes:
+        if name in _shardCounts and not await _shardedInc(client, name, _shardCounts[name], delta, session=session):
+            return False
+    for name, _ in changes:
+        _announceWrite(name, session=session)
+    return True
+
+# Function to create a new hardware set
+@timed('createHardwareSet')
+async def createHardwareSet(client, hwSetName, initCapacity, shards=None):
+    """
+    Create a new hardware set in the database.
+    Args:
+        client: An AsyncMongoClient instance
+        hwSetName(str): The unique hardware set name
+        initCapacity(int): The initial capacity of the hardware set
+        shards(int): Optional number of sub-counter documents to split the capacity across
+            (for sets too busy for one document); None or 1 keeps a single counter
+    
+    Returns:
+        tuple:
+            - bool: Indicates success
+            - str: Success or error message
+    """
+    db = client[config.mongo_database]
+    hw_col = db[config.mongo_collection_hardware]
+
+    # Every shard gets at least one unit
+    shards = min(shards or 1, initCapacity)
+    hw_set = {
+        'hwSetName': hwSetName,
+        'capacity': initCapacity,
+        'version': 0
+    }
+    if shards > 1:
+        hw_set['shards'] = shards
+    else:
+        hw_set['availability'] = initCapacity
+
+    # The unique index on hwSetName rejects duplicates atomically (no find-then-insert race)
+    try:
+        await hw_col.insert_one(hw_set)
+    except DuplicateKeyError:
+        return False, f"{hwSetName} set already exists"
+    if shards > 1:
+        await _shardCollection(client).insert_many([
+            {'hwSetName': hwSetName, 'shard': i, 'capacity': capacity, 'availability': capacity, 'version': 0}
+            for i, capacity in enumerate(splitCapacity(initCapacity, shards))
+        ])
+        _shardCounts[hwSetName] = shards
+        hw_set['availability'] = initCapacity
+    hardware_cache.put(hw_set)
+    report_cache.invalidateUtilization()
+    return True, "Hardware set created successfully!"
+
+# Function to split an existing hardware set's availability across sub-counters
+@timed('shardHardwareSet')
+async def shardHardwareSet(client, hwSetName, shards):
+    """
+    Move a single-counter hardware set onto `shards` sub-counter documents.
+    The shards are created empty, the set's availability is claimed in one update
+    that also marks it sharded, and the claimed units are then spread over the
+    shards. Check-outs arriving in between see fewer units than there are.
+    Args:
+        client: An AsyncMongoClient instance
+        hwSetName(str): The hardware set name
+        shards(int): Number of sub-counters (capped at the set's capacity)
+
+    Returns:
+        tuple:
+            - str: CHECKOUT_OK, HW_NOT_FOUND or ALREADY_SHARDED
+            - int: The shard count the set ended up with (0 if none)
+    """
+    hw_col = client[config.mongo_database][config.mongo_collection_hardware]
+    hw_set = await hw_col.find_one({'hwSetName': hwSetName})
+    if hw_set is None:
+        return HW_NOT_FOUND, 0
+    if hw_set.get('shards'):
+        return ALREADY_SHARDED, hw_set['shards']
+
+    shards = min(shards, hw_set['capacity'])
+    try:
+        await _shardCollection(client).insert_many([
+            {'hwSetName': hwSetName, 'shard': i, 'capacity': capacity, 'availability': 0, 'version': 0}
+            for i, capacity in enumerate(splitCapacity(hw_set['capacity'], shards))
+        ])
+    except BulkWriteError:
+        # The unique (hwSetName, shard) index: another request is sharding this set
+        return ALREADY_SHARDED, await _shardsOf(client, hwSetName)
+    claimed = await hw_col.find_one_and_update(
+        {'hwSetName': hwSetName, 'availability': {'$exists': True}},
+        {'$set': {'shards': shards}, '$unset': {'availability': ''}, '$inc': {'version': 1}}
+    )
+    if claimed is None:
+        await _shardCollection(client).delete_many({'hwSetName': hwSetName})
+        return ALREADY_SHARDED, await _shardsOf(client, hwSetName)
+    _shardCounts[hwSetName] = shards
+    if claimed['availability'] and not await _shardedInc(client, hwSetName, shards, claimed['availability']):
+        print(f"⚠ Could not move {claimed['availability']} units of {hwSetName} onto its shards")
+    hardware_cache.invalidate(hwSetName)
+    report_cache.invalidateUtilization()
+    announceAvailability(hwSetName)
+    return CHECKOUT_OK, shards
+
+def _fromPrimary(routed, operation):
+    """Whether a read came from the primary. Reads routed elsewhere don't fill hardware_cache,
+    which check-out validation also reads, or report_cache, whose invalidations they may predate"""
+    return not routed or read_preference_of(operation) == 'primary'
+
+# Function to query a hardware set by its name
+@timed('queryHardwareSet')
+async def queryHardwareSet(client, hwSetName, session=None, readOnly=False):
+    """
+    Return a hardware data set, including hwSetName.
+    Served from the in-process cache when possible (see hardware_cache).
+    A sharded set's availability is the sum of its shards.
+    Args:
+        client: An AsyncMongoClient instance
+        hwSetName(str): The Unique hardware name
+        session: Optional AsyncClientSession (used when running inside a transaction)
+        readOnly(bool): Read with the read-only routing (for lookups that feed no write);
+            validation reads keep the default and stay on the primary
+    
+    Returns:
+        tuple:
+            - bool: Indicate whether the hardware exists
+            - dict or str: A hardware data set
+    """
+    # Transactions read their own snapshot, never the cache
+    if session is None and hardware_cache.enabled:
+        hw_set = hardware_cache.get(hwSetName)
+        if hw_set is not None:
+            return True, hw_set
+
+    routed = readOnly and session is None
+    db = routed_database(client, 'queryHardwareSet') if routed else None
+    hw_set = await _loadHardwareSet(client, hwSetName, session=session, db=db)
+    if not hw_set:
+        return False, "Hardware set does not exist"
+
+    if session is None and _fromPrimary(routed, 'queryHardwareSet'):
+        hardware_cache.put(hw_set)
+    return True, hw_set
+
+# Function to query several hardware sets by name
+@timed('queryHardwareSets')
+async def queryHardwareSets(client, hwSetNames, readOnly=False):
+    """
+    Return several hardware data sets: cached ones from the in-process cache,
+    the rest with one $in query (which also refills the cache).
+    Args:
+        client: An AsyncMongoClient instance
+        hwSetNames(list): Hardware set names
+        readOnly(bool): Read with the read-only routing (see queryHardwareSet)
+
+    Returns:
+        dict: hwSetName -> hardware data set, for the names that exist
+    """
+    found, missing = {}, []
+    for hwSetName in hwSetNames:
+        hw_set = hardware_cache.get(hwSetName) if hardware_cache.enabled else None
+        if hw_set is None:
+            missing.append(hwSetName)
+        else:
+            found[hwSetName] = hw_set
+    if missing:
+        db = routed_database(client, 'queryHardwareSets') if readOnly else None
+        loaded = await _findHardwareSets(client, missing, db=db)
+        if _fromPrimary(readOnly, 'queryHardwareSets'):
+            for hw_set in loaded.values():
+                hardware_cache.put(hw_set)
+        found.update(loaded)
+    return found
+
+# Function to update the availability of a hardware set
+@timed('updateAvailability')
+async def updateAvailability(client, hwSetName, delta, session=None):
+    """
+    Update the availability of an existing hardware set.
+    The bounds check and the increment happen in one conditional update, so
+    concurrent callers can never push availability below 0 or above capacity.
+    On a sharded set the same holds for every shard (see _shardedInc).
+    Args:
+        client: An AsyncMongoClient instance
+        hwSetName(str): The hardware set name
+        delta(int): The change in availability (positive for check-in, negative for check-out)
+        session: Optional AsyncClientSession (used when running inside a transaction)
+    
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    return await _incAvailability(client, hwSetName, delta, session=session)
+
+# Function to request space from a hardware set
+@timed('requestSpace')
+async def requestSpace(client, hwSetName, amount, session=None):
+    """
+    Request a certain amount of hardware and update availability.
+    A single guarded $inc: it only matches when enough units are available.
+    Args:
+        client: An AsyncMongoClient instance
+        hwSetName(str): The hardware set name
+        amount(int): The amount to request
+        session: Optional AsyncClientSession (used when running inside a transaction)
+    
+    Returns:
+        bool: True if successful, False otherwise (missing set or not enough units)
+    """
+    return await _incAvailability(client, hwSetName, -amount, session=session)
+
+# Function to get all hardware set names
+@timed('getAllHwSetNames')
+async def getAllHwSetNames(client):
+    """
+    Get and return a list of all hardware set names.
+    Args:
+        client: An AsyncMongoClient instance
+    
+    Returns:
+        list: List of hardware set names
+    """
+    db = routed_database(client, 'getAllHwSetNames')
+    hw_col = db[config.mongo_collection_hardware]
+    
+    hardware_sets = hw_col.find({}, {"hwSetName": 1})
+    return [hw['hwSetName'] async for hw in hardware_sets]
+
+def _namesFilter(prefix=None, after=None):
+    """hwSetName filter for listing; an anchored prefix regex can still use the hwSetName index"""
+    name_filter = {}
+    if prefix:
+        name_filter['$regex'] = '^' + re.escape(prefix)
+    if after is not None:
+        name_filter['$gt'] = after
+    return {'hwSetName': name_filter} if name_filter else {}
+
+# Function to get one page of hardware set names
+@timed('getHwSetNamesPage')
+async def getHwSetNamesPage(client, limit, after=None, prefix=None):
+    """
+    Get one page of hardware set names in name order (keyset pagination on hwSetName).
+    Args:
+        client: An AsyncMongoClient instance
+        limit(int): Maximum number of names to return
+        after(str): Cursor from the previous page (the last name it returned), or None
+        prefix(str): Only return names starting with this prefix, or None
+    
+    Returns:
+        tuple:
+            - list: Hardware set names
+            - str or None: Cursor for the next page, None on the last page
+    """
+    db = routed_database(client, 'getHwSetNamesPage')
+    hw_col = db[config.mongo_collection_hardware]
+
+    # Fetch one extra name to learn whether another page exists
+    cursor = hw_col.find(_namesFilter(prefix, after), {'hwSetName': 1, '_id': 0}).sort('hwSetName', ASCENDING).limit(limit + 1)
+    names = [hw['hwSetName'] async for hw in cursor]
+    if len(names) > limit:
+        return names[:limit], names[limit - 1]
+    return names, None
+
+# Function to stream all hardware set names
+async def streamHwSetNames(client, prefix=None, batch_size=500):
+    """
+    Yield hardware set names in name order straight from the cursor.
+    Only one batch of batch_size documents is held in memory at a time.
+    Args:
+        client: An AsyncMongoClient instance
+        prefix(str): Only yield names starting with this prefix, or None
+        batch_size(int): Documents fetched per getMore round-trip
+    
+    Yields:
+        str: Hardware set names
+    """
+    db = routed_database(client, 'streamHwSetNames')
+    hw_col = db[config.mongo_collection_hardware]
+
+    cursor = hw_col.find(_namesFilter(prefix), {'hwSetName': 1, '_id': 0}, batch_size=batch_size).sort('hwSetName', ASCENDING)
+    try:
+        async for hw in cursor:
+            yield hw['hwSetName']
+    finally:
+        # Client went away mid-stream: release the server-side cursor
+        await cursor.close()
+
+# Function to get project's checkout quantity for a specific hardware set
+@timed('getProjectCheckout')
+async def getProjectCheckout(client, projectId, hwSetName, session=None):
+    """
+    Get the quantity of hardware checked out by a project.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+        hwSetName(str): The hardware set name
+        session: Optional AsyncClientSession (used when running inside a transaction)
+    
+    Returns:
+        int: The quantity checked out (0 if not found)
+    """
+    db = client[config.mongo_database]
+    checkout_col = db[config.mongo_collection_checkouts]
+    
+    checkout_record = await checkout_col.find_one({
+        "projectId": projectId,
+        "hwSetName": hwSetName
+    }, session=session)
+    
+    if checkout_record:
+        return checkout_record.get('quantity', 0)
+    return 0
+
+def leaseExpiry(leaseSeconds):
+    """Expiry time of a lease starting now, or None for no lease"""
+    if not leaseSeconds:
+        return None
+    return datetime.now(timezone.utc) + timedelta(seconds=leaseSeconds)
+
+def checkoutUpdate(qty, expiresAt=None, waitId=None):
+    """Upsert update adding qty to a checkout record; a lease covers the whole holding.
+    waitId marks the units as a waitlist grant's until the grant is finished (see _finishGrant)"""
+    update = {"$inc": {"quantity": qty}}
+    if expiresAt is not None:
+        update["$max"] = {"expiresAt": expiresAt}
+    if waitId is not None:
+        update["$addToSet"] = {"grants": waitId}
+    return update
+
+# Function to update project's checkout record
+@timed('updateProjectCheckout')
+async def updateProjectCheckout(client, projectId, hwSetName, qty, session=None, expiresAt=None, waitId=None):
+    """
+    Update or create a project's checkout record.
+    Check-outs are an upserted $inc; check-ins are a $inc guarded by the quantity
+    currently held, so the record can never go negative.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+        hwSetName(str): The hardware set name
+        qty(int): The quantity to add (can be negative for check-in)
+        session: Optional AsyncClientSession (used when running inside a transaction)
+        expiresAt(datetime): Lease expiry for a check-out; extends (never shortens) the holding's lease
+        waitId(str): The waitlist entry a check-out grants, recorded with the units (see _grantHead)
+    
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    db = client[config.mongo_database]
+    checkout_col = db[config.mongo_collection_checkouts]
+    record_filter = {"projectId": projectId, "hwSetName": hwSetName}
+    
+    if qty > 0:
+        # Create the record on first checkout, otherwise add to it; the unique
+        # (projectId, hwSetName) index makes concurrent first upserts converge on one record
+        await checkout_col.update_one(record_filter, checkoutUpdate(qty, expiresAt, waitId), upsert=True, session=session)
+        return True
+    
+    updated = await checkout_col.find_one_and_update(
+        {**record_filter, "quantity": {"$gte": -qty}},
+        {"$inc": {"quantity": qty}},
+        projection={"quantity": 1},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    if not updated:
+        return False  # Cannot check in more than checked out
+    
+    if updated.get('quantity', 0) == 0:
+        # Remove record once nothing is checked out; matching on 0 keeps a concurrent checkout intact
+        await checkout_col.delete_one({**record_filter, "quantity": 0}, session=session)
+    
+    return True
+
+def holdingRecord(hwSetName, quantity, capacity, expiresAt=None):
+    """One line of a project's holdings; expiresAt is an ISO 8601 string for leased holdings, else None"""
+    return {
+        'hwSetName': hwSetName,
+        'quantity': quantity,
+        'capacity': capacity,
+        'expiresAt': utc(expiresAt).isoformat() if expiresAt is not None else None
+    }
+
+def holdingsReport(projectId, holdings):
+    """
+    Build the /projects/{projectId}/holdings response.
+    Args:
+        projectId(str): The project ID
+        holdings(list): holdingRecord dicts in name order
+
+    Returns:
+        dict: projectId, holdings and the total quantity held
+    """
+    return {
+        'projectId': projectId,
+        'holdings': holdings,
+        'totalQuantity': sum(holding['quantity'] for holding in holdings)
+    }
+
+def utilizationRecord(hwSetName, capacity, availability, checkedOut, projects):
+    """One hardware set's line of the utilization report"""
+    return {
+        'hwSetName': hwSetName,
+        'capacity': capacity,
+        'availability': availability,
+        'checkedOut': checkedOut,
+        'projects': projects,
+        'utilization': round(checkedOut / capacity, 4) if capacity else 0.0
+    }
+
+def utilizationReport(records):
+    """
+    Build the /utilization response.
+    Args:
+        records(list): utilizationRecord dicts in name order
+
+    Returns:
+        dict: hardwareSets plus fleet-wide totals
+    """
+    capacity = sum(record['capacity'] for record in records)
+    checkedOut = sum(record['checkedOut'] for record in records)
+    return {
+        'hardwareSets': records,
+        'totals': {
+            'hardwareSets': len(records),
+            'capacity': capacity,
+            'availability': sum(record['availability'] for record in records),
+            'checkedOut': checkedOut,
+            'utilization': round(checkedOut / capacity, 4) if capacity else 0.0
+        }
+    }
+
+def _holdingsPipeline(projectId):
+    return [
+        # Served by the (projectId, hwSetName) index, which also yields name order
+        {'$match': {'projectId': projectId, 'quantity': {'$gt': 0}}},
+        {'$sort': {'hwSetName': 1}},
+        # One unique-index lookup per holding
+        {'$lookup': {
+            'from': config.mongo_collection_hardware,
+            'localField': 'hwSetName',
+            'foreignField': 'hwSetName',
+            'as': 'hardware'
+        }},
+        {'$project': {
+            '_id': 0,
+            'hwSetName': 1,
+            'quantity': 1,
+            'expiresAt': 1,
+            'capacity': {'$arrayElemAt': ['$hardware.capacity', 0]}
+        }}
+    ]
+
+def _utilizationPipeline():
+    return [
+        # Walks the unique hwSetName index, so results stream in name order without a blocking sort
+        {'$sort': {'hwSetName': 1}},
+        # Per-set totals from the (hwSetName, projectId) index. Grouping inside the lookup joins
+        # one small document per set instead of every checkout record for it
+        {'$lookup': {
+            'from': config.mongo_collection_checkouts,
+            'let': {'name': '$hwSetName'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$hwSetName', '$$name']}, 'quantity': {'$gt': 0}}},
+                {'$group': {'_id': None, 'checkedOut': {'$sum': '$quantity'}, 'projects': {'$sum': 1}}}
+            ],
+            'as': 'usage'
+        }},
+        # Sharded sets keep their availability on the shard documents; for the others this is
+        # one probe of the (hwSetName, shard) index that finds nothing
+        {'$lookup': {
+            'from': config.mongo_collection_hw_shards,
+            'localField': 'hwSetName',
+            'foreignField': 'hwSetName',
+            'as': 'shardCounters'
+        }},
+        {'$project': {
+            '_id': 0,
+            'hwSetName': 1,
+            'capacity': 1,
+            'availability': {'$ifNull': ['$availability', {'$sum': '$shardCounters.availability'}]},
+            'checkedOut': {'$ifNull': [{'$arrayElemAt': ['$usage.checkedOut', 0]}, 0]},
+            'projects': {'$ifNull': [{'$arrayElemAt': ['$usage.projects', 0]}, 0]}
+        }}
+    ]
+
+async def _streamAggregate(collection, pipeline, batch_size):
+    cursor = await collection.aggregate(pipeline, batchSize=batch_size)
+    try:
+        async for document in cursor:
+            yield document
+    finally:
+        # Client went away mid-stream: release the server-side cursor
+        await cursor.close()
+
+# Function to stream a project's holdings
+async def streamProjectHoldings(client, projectId, batch_size=500):
+    """
+    Yield every hardware set a project holds, in name order, from one aggregation
+    over the checkouts collection joined with the hardware collection.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+        batch_size(int): Documents fetched per getMore round-trip
+
+    Yields:
+        dict: See holdingRecord
+    """
+    checkout_col = routed_database(client, 'streamProjectHoldings')[config.mongo_collection_checkouts]
+    async for holding in _streamAggregate(checkout_col, _holdingsPipeline(projectId), batch_size):
+        yield holdingRecord(holding['hwSetName'], holding['quantity'], holding.get('capacity'), holding.get('expiresAt'))
+
+# Function to get a project's holdings
+@timed('getProjectHoldings')
+async def getProjectHoldings(client, projectId):
+    """
+    Get everything a project holds with one aggregation instead of one
+    getProjectCheckout per hardware set. Served from report_cache when possible.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+
+    Returns:
+        dict: See holdingsReport
+    """
+    key = holdings_key(projectId)
+    report = report_cache.get(key) if report_cache.enabled else None
+    if report is None:
+        version = report_cache.version
+        report = holdingsReport(projectId, [holding async for holding in streamProjectHoldings(client, projectId)])
+        if _fromPrimary(True, 'streamProjectHoldings'):
+            report_cache.put(key, report, version)
+    return report
+
+# Function to stream hardware utilization
+async def streamUtilization(client, batch_size=500):
+    """
+    Yield capacity, availability, units checked out and the number of holding
+    projects for every hardware set, in name order. One aggregation over the
+    hardware collection, joined with per-set checkout totals.
+    Args:
+        client: An AsyncMongoClient instance
+        batch_size(int): Documents fetched per getMore round-trip
+
+    Yields:
+        dict: See utilizationRecord
+    """
+    hw_col = routed_database(client, 'streamUtilization')[config.mongo_collection_hardware]
+    async for usage in _streamAggregate(hw_col, _utilizationPipeline(), batch_size):
+        yield utilizationRecord(
+            usage['hwSetName'], usage['capacity'], usage['availability'], usage['checkedOut'], usage['projects']
+        )
+
+# Function to get hardware utilization for the whole fleet
+@timed('getUtilization')
+async def getUtilization(client):
+    """
+    Get the utilization of every hardware set plus fleet totals.
+    Served from report_cache when possible.
+    Args:
+        client: An AsyncMongoClient instance
+
+    Returns:
+        dict: See utilizationReport
+    """
+    report = report_cache.get(UTILIZATION) if report_cache.enabled else None
+    if report is None:
+        version = report_cache.version
+        report = utilizationReport([record async for record in streamUtilization(client)])
+        if _fromPrimary(True, 'streamUtilization'):
+            report_cache.put(UTILIZATION, report, version)
+    return report
+
+# Outcomes of checkOutHardware / checkInHardware (mapped to HTTP responses by the routes)
+CHECKOUT_OK = "ok"
+HW_NOT_FOUND = "not_found"
+NOT_ENOUGH_AVAILABLE = "not_enough_available"
+MORE_THAN_CHECKED_OUT = "more_than_checked_out"
+EXCEEDS_CAPACITY = "exceeds_capacity"
+RECORD_UPDATE_FAILED = "record_update_failed"
+BATCH_NOT_APPLIED = "batch_not_applied"
+BATCH_CONFLICT = "batch_conflict"
+IDEMPOTENCY_IN_PROGRESS = "idempotency_in_progress"
+IDEMPOTENCY_KEY_REUSED = "idempotency_key_reused"
+# Outcomes of renewLease
+NO_HOLDING = "no_holding"
+NOT_LEASED = "not_leased"
+LEASE_EXPIRED = "lease_expired"
+# Outcomes of cancelWait
+NO_WAIT_ENTRY = "no_wait_entry"
+WAIT_FINISHED = "wait_finished"
+# Outcome of shardHardwareSet
+ALREADY_SHARDED = "already_sharded"
+
+class _AbortTransaction(Exception):
+    """Raised inside a transaction callback to abort it with an outcome"""
+    def __init__(self, outcome):
+        super().__init__(outcome)
+        self.outcome = outcome
+
+# Function to check whether the deployment supports multi-document transactions
+async def supportsTransactions(client):
+    """
+    Transactions need a replica set or a sharded cluster; a standalone server rejects them.
+    Args:
+        client: An AsyncMongoClient instance
+    
+    Returns:
+        bool: True if the connected deployment supports transactions
+    """
+    hello = await client.admin.command('hello')
+    return bool(hello.get('setName')) or hello.get('msg') == 'isdbgrid'
+
+async def _failureOutcome(client, hwSetName, outcome, session=None):
+    """A guarded write matched nothing: report HW_NOT_FOUND if the set is missing, else outcome"""
+    hw_exists, _ = await queryHardwareSet(client, hwSetName, session=session)
+    return outcome if hw_exists else HW_NOT_FOUND
+
+async def _checkOutSteps(client, projectId, hwSetName, qty, session=None, expiresAt=None, waitId=None):
+    if not await requestSpace(client, hwSetName, qty, session=session):
+        return await _failureOutcome(client, hwSetName, NOT_ENOUGH_AVAILABLE, session=session)
+    if not await updateProjectCheckout(client, projectId, hwSetName, qty, session=session, expiresAt=expiresAt, waitId=waitId):
+        raise _AbortTransaction(RECORD_UPDATE_FAILED)
+    return CHECKOUT_OK
+
+async def _checkInSteps(client, projectId, hwSetName, qty, session=None):
+    if not await updateProjectCheckout(client, projectId, hwSetName, -qty, session=session):
+        return await _failureOutcome(client, hwSetName, MORE_THAN_CHECKED_OUT, session=session)
+    if not await updateAvailability(client, hwSetName, qty, session=session):
+        raise _AbortTransaction(await _failureOutcome(client, hwSetName, EXCEEDS_CAPACITY, session=session))
+    return CHECKOUT_OK
+
+async def _runInTransaction(client, steps):
+    """
+    Run steps(session) in one transaction. with_transaction retries the whole
+    callback on TransientTransactionError and the commit on UnknownTransactionCommitResult.
+    Availability writes made with the session are announced once it commits.
+    """
+    async with client.start_session() as session:
+        pending = _pendingAnnouncements[session] = set()
+
+        async def attempt(session):
+            # A retried callback starts over: the aborted attempt's writes are gone
+            pending.clear()
+            return await steps(session)
+        try:
+            result = await session.with_transaction(attempt)
+        except _AbortTransaction as abort:
+            count_rollback('transaction')
+            return abort.outcome
+        finally:
+            del _pendingAnnouncements[session]
+        # Committed: listeners re-reading now see the writes
+        for hwSetName in pending:
+            announceAvailability(hwSetName)
+        return result
+
+def idempotentReplay(stored_fingerprint, stored_outcome, fingerprint):
+    """Outcome to return for a request whose Idempotency-Key was seen before"""
+    if stored_fingerprint != fingerprint:
+        return IDEMPOTENCY_KEY_REUSED
+    if stored_outcome is None:
+        return IDEMPOTENCY_IN_PROGRESS  # The first request has claimed the key but not finished
+    return stored_outcome
+
+async def _recordIdempotencyKey(client, key, fingerprint, outcome, session=None):
+    """Insert the key record; the unique _id raises DuplicateKeyError if the key is taken"""
+    await client[config.mongo_database][config.mongo_collection_idempotency].insert_one({
+        '_id': key,
+        'fingerprint': fingerprint,
+        'outcome': outcome,
+        'createdAt': datetime.now(timezone.utc)  # TTL index field
+    }, session=session)
+
+async def _storedOutcome(client, key, fingerprint):
+    record = await client[config.mongo_database][config.mongo_collection_idempotency].find_one({'_id': key})
+    if record is None:
+        # Released by a failed first attempt (or expired) since our insert failed
+        return IDEMPOTENCY_IN_PROGRESS
+    return idempotentReplay(record['fingerprint'], record.get('outcome'), fingerprint)
+
+async def _runCheckout(client, hwSetName, steps, compensate, entry, use_transaction, idempotency_key, fingerprint):
+    """
+    Run check-out/check-in steps(session), optionally under an Idempotency-Key,
+    and append the ledger entry if it succeeds.
+    A key seen before returns the stored outcome without running anything. With
+    a transaction the key record and the ledger entry are inserted by the same
+    transaction as the writes; otherwise the key is claimed before the writes and
+    completed after, and the entry is appended after the writes.
+    """
+    if idempotency_key is not None:
+        cached = idempotency_cache.get(idempotency_key)
+        if cached is not None:
+            return idempotentReplay(*cached, fingerprint)
+
+    if use_transaction:
+        recorded = False
+
+        async def keyed_steps(session):
+            nonlocal recorded
+            recorded = False
+            outcome = await steps(session)
+            if outcome == CHECKOUT_OK:
+                await appendLedger(client, [entry], session=session)
+            if idempotency_key is not None:
+                await _recordIdempotencyKey(client, idempotency_key, fingerprint, outcome, session=session)
+                recorded = True
+            return outcome
+
+        try:
+            outcome = await _runInTransaction(client, keyed_steps)
+        except DuplicateKeyError:
+            # Another request with this key committed first; ours was rolled back
+            return await _storedOutcome(client, idempotency_key, fingerprint)
+        finally:
+            # Drop anything cached while the transaction was in flight
+            hardware_cache.invalidate(hwSetName)
+            report_cache.invalidateProject(entry['projectId'])
+        if idempotency_key is not None and recorded:
+            idempotency_cache.put(idempotency_key, fingerprint, outcome)
+        return outcome
+
+    if idempotency_key is not None:
+        try:
+            await _recordIdempotencyKey(client, idempotency_key, fingerprint, None)
+        except DuplicateKeyError:
+            return await _storedOutcome(client, idempotency_key, fingerprint)
+    try:
+        try:
+            outcome = await steps(None)
+        except _AbortTransaction as abort:
+            count_rollback('compensating')
+            await compensate()
+            outcome = abort.outcome
+        finally:
+            report_cache.invalidateProject(entry['projectId'])
+        if outcome == CHECKOUT_OK:
+            await appendLedger(client, [entry])
+    except BaseException:
+        if idempotency_key is not None:
+            # Nothing to replay; let a retry run the request again
+            await client[config.mongo_database][config.mongo_collection_idempotency].delete_one(
+                {'_id': idempotency_key, 'outcome': None}
+            )
+        raise
+    if idempotency_key is not None:
+        await client[config.mongo_database][config.mongo_collection_idempotency].update_one(
+            {'_id': idempotency_key}, {'$set': {'outcome': outcome}}
+        )
+        idempotency_cache.put(idempotency_key, fingerprint, outcome)
+    return outcome
+
+# Function to check out hardware for a project
+@timed('checkOutHardware')
+async def checkOutHardware(client, projectId, hwSetName, qty, use_transaction=False, idempotency_key=None, userId=None,
+                           leaseSeconds=None):
+    """
+    Take units from a hardware set and add them to the project's checkout record.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+        hwSetName(str): The hardware set name
+        qty(int): The quantity to check out
+        use_transaction(bool): Run both writes in one transaction (replica set only);
+            otherwise a failed record update is compensated by returning the units
+        idempotency_key(str): Optional Idempotency-Key; a repeated key returns the first outcome
+        userId(str): The requesting user, recorded in the ledger
+        leaseSeconds(int): Optional lease; the holding is returned automatically once it expires
+    
+    Returns:
+        str: CHECKOUT_OK or one of the failure outcomes
+    """
+    expiresAt = leaseExpiry(leaseSeconds)
+    return await _runCheckout(
+        client, hwSetName,
+        lambda session: _checkOutSteps(client, projectId, hwSetName, qty, session=session, expiresAt=expiresAt),
+        # Compensate: give the reserved units back
+        lambda: updateAvailability(client, hwSetName, qty),
+        ledgerEntry(projectId, hwSetName, qty, userId, 'check_out'),
+        use_transaction, idempotency_key,
+        request_fingerprint('check_out', projectId, hwSetName, qty, *([leaseSeconds] if leaseSeconds else []))
+        if idempotency_key else None
+    )
+
+# Function to check in hardware for a project
+@timed('checkInHardware')
+async def checkInHardware(client, projectId, hwSetName, qty, use_transaction=False, idempotency_key=None, userId=None):
+    """
+    Remove units from the project's checkout record and return them to the hardware set.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+        hwSetName(str): The hardware set name
+        qty(int): The quantity to check in
+        use_transaction(bool): Run both writes in one transaction (replica set only);
+            otherwise a failed availability update is compensated by restoring the record
+        idempotency_key(str): Optional Idempotency-Key; a repeated key returns the first outcome
+        userId(str): The requesting user, recorded in the ledger
+    
+    Returns:
+        str: CHECKOUT_OK or one of the failure outcomes
+    """
+    return await _runCheckout(
+        client, hwSetName,
+        lambda session: _checkInSteps(client, projectId, hwSetName, qty, session=session),
+        # Compensate: restore the project's checkout record
+        lambda: updateProjectCheckout(client, projectId, hwSetName, qty),
+        ledgerEntry(projectId, hwSetName, -qty, userId, 'check_in'),
+        use_transaction, idempotency_key,
+        request_fingerprint('check_in', projectId, hwSetName, qty) if idempotency_key else None
+    )
+
+def validateCheckOut(hw_set, qty):
+    """Outcome of checking out qty units of hw_set (None when the set does not exist)"""
+    if hw_set is None:
+        return HW_NOT_FOUND
+    if hw_set.get('availability', 0) < qty:
+        return NOT_ENOUGH_AVAILABLE
+    return CHECKOUT_OK
+
+def validateCheckIn(hw_set, held, qty):
+    """Outcome of checking in qty units of hw_set when the project holds `held` of them"""
+    if hw_set is None:
+        return HW_NOT_FOUND
+    if held < qty:
+        return MORE_THAN_CHECKED_OUT
+    if hw_set.get('availability', 0) + qty > hw_set.get('capacity', 0):
+        return EXCEEDS_CAPACITY
+    return CHECKOUT_OK
+
+def notApplied(outcomes):
+    """All-or-nothing batch with a failed item: every admitted item is reported as not applied"""
+    return [BATCH_NOT_APPLIED if outcome == CHECKOUT_OK else outcome for outcome in outcomes]
+
+async def _findHardwareSets(client, names, session=None, db=None):
+    """One $in query for every hardware set in a batch (plus one over the shards of sharded ones)"""
+    if db is None:
+        db = client[config.mongo_database]
+    hw_sets = [hw_set async for hw_set in db[config.mongo_collection_hardware].find({'hwSetName': {'$in': names}}, session=session)]
+    await _withShardTotals(client, hw_sets, session=session, db=db)
+    return {hw_set['hwSetName']: hw_set for hw_set in hw_sets}
+
+async def _findHoldings(client, projectId, names, session=None):
+    """One $in query for the project's checkout records in a batch"""
+    checkout_col = client[config.mongo_database][config.mongo_collection_checkouts]
+    cursor = checkout_col.find({'projectId': projectId, 'hwSetName': {'$in': names}}, session=session)
+    return {record['hwSetName']: record.get('quantity', 0) async for record in cursor}
+
+async def _checkOutBatchSteps(client, projectId, items, atomic, session, expiresAt=None):
+    db = client[config.mongo_database]
+    hw_sets = await _findHardwareSets(client, [name for name, _ in items], session=session)
+    outcomes = [validateCheckOut(hw_sets.get(name), qty) for name, qty in items]
+    admitted = [item for item, outcome in zip(items, outcomes) if outcome == CHECKOUT_OK]
+    if atomic and len(admitted) < len(items):
+        return notApplied(outcomes)
+    if not admitted:
+        return outcomes
+
+    if not await _incAvailabilities(client, [(name, -qty) for name, qty in admitted], session=session):
+        # Only possible if the snapshot read went stale; abort rather than guess which item lost
+        raise _AbortTransaction([BATCH_CONFLICT if outcome == CHECKOUT_OK else outcome for outcome in outcomes])
+
+    await db[config.mongo_collection_checkouts].bulk_write([
+        UpdateOne({'projectId': projectId, 'hwSetName': name}, checkoutUpdate(qty, expiresAt), upsert=True)
+        for name, qty in admitted
+    ], ordered=False, session=session)
+    return outcomes
+
+async def _checkInBatchSteps(client, projectId, items, atomic, session):
+    db = client[config.mongo_database]
+    names = [name for name, _ in items]
+    hw_sets = await _findHardwareSets(client, names, session=session)
+    holdings = await _findHoldings(client, projectId, names, session=session)
+    outcomes = [validateCheckIn(hw_sets.get(name), holdings.get(name, 0), qty) for name, qty in items]
+    admitted = [item for item, outcome in zip(items, outcomes) if outcome == CHECKOUT_OK]
+    if atomic and len(admitted) < len(items):
+        return notApplied(outcomes)
+    if not admitted:
+        return outcomes
+
+    conflict = [BATCH_CONFLICT if outcome == CHECKOUT_OK else outcome for outcome in outcomes]
+    record_ops = []
+    for name, qty in admitted:
+        record_filter = {'projectId': projectId, 'hwSetName': name}
+        record_ops.append(UpdateOne({**record_filter, 'quantity': {'$gte': qty}}, {'$inc': {'quantity': -qty}}))
+        record_ops.append(DeleteOne({**record_filter, 'quantity': 0}))
+    result = await db[config.mongo_collection_checkouts].bulk_write(record_ops, ordered=True, session=session)
+    if result.modified_count != len(admitted):
+        raise _AbortTransaction(conflict)
+
+    if not await _incAvailabilities(client, admitted, session=session):
+        raise _AbortTransaction(conflict)
+    return outcomes
+
+async def _checkOutBatchCompensating(client, projectId, items, atomic, expiresAt=None):
+    """
+    Standalone fallback. A bulk write can't say which guarded update lost a race,
+    so the hardware side runs as concurrent single-document guarded writes
+    (one round-trip of wall time); the checkout records are one bulk upsert.
+    """
+    hw_sets = await _findHardwareSets(client, [name for name, _ in items])
+    outcomes = [validateCheckOut(hw_sets.get(name), qty) for name, qty in items]
+    if atomic and any(outcome != CHECKOUT_OK for outcome in outcomes):
+        return notApplied(outcomes)
+
+    admitted = [i for i, outcome in enumerate(outcomes) if outcome == CHECKOUT_OK]
+    granted = await asyncio.gather(*(requestSpace(client, *items[i]) for i in admitted))
+    for i, ok in zip(admitted, granted):
+        if not ok:
+            outcomes[i] = NOT_ENOUGH_AVAILABLE  # Lost a race since validation
+    applied = [i for i, ok in zip(admitted, granted) if ok]
+
+    if atomic and len(applied) < len(items):
+        # Give back what was taken
+        count_rollback('compensating')
+        await asyncio.gather(*(updateAvailability(client, items[i][0], items[i][1]) for i in applied))
+        return notApplied(outcomes)
+    if applied:
+        await client[config.mongo_database][config.mongo_collection_checkouts].bulk_write([
+            UpdateOne({'projectId': projectId, 'hwSetName': items[i][0]}, checkoutUpdate(items[i][1], expiresAt), upsert=True)
+            for i in applied
+        ], ordered=False)
+    return outcomes
+
+async def _checkInBatchCompensating(client, projectId, items, atomic):
+    """Standalone fallback: concurrent single-document guarded writes with compensation"""
+    names = [name for name, _ in items]
+    hw_sets = await _findHardwareSets(client, names)
+    holdings = await _findHoldings(client, projectId, names)
+    outcomes = [validateCheckIn(hw_sets.get(name), holdings.get(name, 0), qty) for name, qty in items]
+    if atomic and any(outcome != CHECKOUT_OK for outcome in outcomes):
+        return notApplied(outcomes)
+
+    admitted = [i for i, outcome in enumerate(outcomes) if outcome == CHECKOUT_OK]
+    released = await asyncio.gather(*(
+        updateProjectCheckout(client, projectId, items[i][0], -items[i][1]) for i in admitted
+    ))
+    for i, ok in zip(admitted, released):
+        if not ok:
+            outcomes[i] = MORE_THAN_CHECKED_OUT
+    released = [i for i, ok in zip(admitted, released) if ok]
+
+    returned = await asyncio.gather(*(updateAvailability(client, items[i][0], items[i][1]) for i in released))
+    for i, ok in zip(released, returned):
+        if not ok:
+            outcomes[i] = EXCEEDS_CAPACITY
+    applied = [i for i, ok in zip(released, returned) if ok]
+
+    if atomic and len(applied) < len(items):
+        # Undo every item: take the units back and restore all released records
+        count_rollback('compensating')
+        await asyncio.gather(*(updateAvailability(client, items[i][0], -items[i][1]) for i in applied))
+        await asyncio.gather(*(updateProjectCheckout(client, projectId, items[i][0], items[i][1]) for i in released))
+        return notApplied(outcomes)
+    # Restore the records of items whose availability update failed
+    if len(applied) < len(released):
+        count_rollback('compensating')
+    await asyncio.gather(*(
+        updateProjectCheckout(client, projectId, items[i][0], items[i][1]) for i in released if i not in applied
+    ))
+    return outcomes
+
+def _batchLedger(projectId, items, outcomes, userId, op):
+    """Ledger entries for the applied items of a batch"""
+    sign = 1 if op == 'check_out' else -1
+    return [
+        ledgerEntry(projectId, name, sign * qty, userId, op)
+        for (name, qty), outcome in zip(items, outcomes) if outcome == CHECKOUT_OK
+    ]
+
+# Function to check out several hardware sets for a project at once
+@timed('checkOutHardwareBatch')
+async def checkOutHardwareBatch(client, projectId, items, atomic=True, use_transaction=False, userId=None,
+                                leaseSeconds=None):
+    """
+    Check out several hardware sets for one project.
+    Availability is validated with one $in query. With transactions, all writes are
+    two bulk operations (hardware, checkouts) inside one transaction.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+        items(list): (hwSetName, qty) tuples with distinct hardware set names
+        atomic(bool): All-or-nothing when True, best-effort per item when False
+        use_transaction(bool): Run the batch in one transaction (replica set only)
+        userId(str): The requesting user, recorded in the ledger
+        leaseSeconds(int): Optional lease applied to every item's holding
+    
+    Returns:
+        list: One outcome per item (CHECKOUT_OK or a failure outcome), in item order
+    """
+    expiresAt = leaseExpiry(leaseSeconds)
+    entries = lambda outcomes: _batchLedger(projectId, items, outcomes, userId, 'check_out')
+    if not use_transaction:
+        outcomes = await _checkOutBatchCompensating(client, projectId, items, atomic, expiresAt)
+        report_cache.invalidateProject(projectId)
+        await appendLedger(client, entries(outcomes))
+        return outcomes
+
+    async def steps(session):
+        outcomes = await _checkOutBatchSteps(client, projectId, items, atomic, session, expiresAt)
+        await appendLedger(client, entries(outcomes), session=session)
+        return outcomes
+
+    outcomes = await _runInTransaction(client, steps)
+    for name, _ in items:
+        hardware_cache.invalidate(name)
+    report_cache.invalidateProject(projectId)
+    return outcomes
+
+# Function to check in several hardware sets for a project at once
+@timed('checkInHardwareBatch')
+async def checkInHardwareBatch(client, projectId, items, atomic=True, use_transaction=False, userId=None):
+    """
+    Check in several hardware sets for one project.
+    Hardware sets and the project's records are validated with one $in query each. With
+    transactions, all writes are two bulk operations inside one transaction.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+        items(list): (hwSetName, qty) tuples with distinct hardware set names
+        atomic(bool): All-or-nothing when True, best-effort per item when False
+        use_transaction(bool): Run the batch in one transaction (replica set only)
+        userId(str): The requesting user, recorded in the ledger
+    
+    Returns:
+        list: One outcome per item (CHECKOUT_OK or a failure outcome), in item order
+    """
+    entries = lambda outcomes: _batchLedger(projectId, items, outcomes, userId, 'check_in')
+    if not use_transaction:
+        outcomes = await _checkInBatchCompensating(client, projectId, items, atomic)
+        report_cache.invalidateProject(projectId)
+        await appendLedger(client, entries(outcomes))
+        return outcomes
+
+    async def steps(session):
+        outcomes = await _checkInBatchSteps(client, projectId, items, atomic, session)
+        await appendLedger(client, entries(outcomes), session=session)
+        return outcomes
+
+    outcomes = await _runInTransaction(client, steps)
+    for name, _ in items:
+        hardware_cache.invalidate(name)
+    report_cache.invalidateProject(projectId)
+    return outcomes
+
+# Times a combined batch is re-read and retried after another writer moved availability under it
+COMBINE_ATTEMPTS = 3
+
+def _admitCombined(hw_set, holdings, ops):
+    """
+    Admit ops one after another against a running copy of the set's availability
+    and the projects' holdings, as if they had been separate requests.
+    Returns (outcome per op, net quantity per project, latest lease expiry per project).
+    """
+    state = dict(hw_set)
+    held = dict(holdings)
+    outcomes, net, leases = [], Counter(), {}
+    for projectId, qty, _, leaseSeconds in ops:
+        if qty > 0:
+            outcome = validateCheckOut(state, qty)
+        else:
+            outcome = validateCheckIn(state, held.get(projectId, 0), -qty)
+        if outcome == CHECKOUT_OK:
+            state['availability'] -= qty
+            held[projectId] = held.get(projectId, 0) + qty
+            net[projectId] += qty
+            expiresAt = leaseExpiry(leaseSeconds) if qty > 0 else None
+            if expiresAt is not None:
+                leases[projectId] = max(expiresAt, leases.get(projectId, expiresAt))
+        outcomes.append(outcome)
+    return outcomes, net, leases
+
+async def _writeCombinedRecords(client, hwSetName, net, leases, session=None):
+    """One bulk upsert for the projects that gained units; guarded decrements for those that returned units.
+    Returns the projects whose decrement found less held than expected"""
+    adds = [
+        UpdateOne({'projectId': projectId, 'hwSetName': hwSetName}, checkoutUpdate(qty, leases.get(projectId)), upsert=True)
+        for projectId, qty in net.items() if qty > 0
+    ]
+    if adds:
+        await client[config.mongo_database][config.mongo_collection_checkouts].bulk_write(adds, ordered=False, session=session)
+    removes = [(projectId, qty) for projectId, qty in net.items() if qty < 0]
+    if session is not None:
+        # Operations on one session can't overlap
+        released = [await updateProjectCheckout(client, projectId, hwSetName, qty, session=session) for projectId, qty in removes]
+    else:
+        released = await asyncio.gather(*(updateProjectCheckout(client, projectId, hwSetName, qty) for projectId, qty in removes))
+    return {projectId for (projectId, _), ok in zip(removes, released) if not ok}
+
+async def _combinedSteps(client, hwSetName, ops, session=None):
+    """
+    Read the set and the returning projects' holdings once, admit every op, then write
+    the net change. Raises _AbortTransaction(None) if availability moved too far since
+    the read. Returns one outcome per op; None marks ops of a project whose record
+    changed under the batch (their writes are undone, to be rerun on their own).
+    """
+    hw_set = await _loadHardwareSet(client, hwSetName, session=session)
+    if hw_set is None:
+        return [HW_NOT_FOUND] * len(ops)
+    returning = list({projectId for projectId, qty, _, _ in ops if qty < 0})
+    holdings = {}
+    if returning:
+        cursor = client[config.mongo_database][config.mongo_collection_checkouts].find(
+            {'hwSetName': hwSetName, 'projectId': {'$in': returning}}, session=session
+        )
+        holdings = {record['projectId']: record.get('quantity', 0) async for record in cursor}
+
+    outcomes, net, leases = _admitCombined(hw_set, holdings, ops)
+    taken = sum(net.values())
+    # One guarded $inc for the whole batch: it only has to keep 0 <= availability <= capacity
+    if taken and not await updateAvailability(client, hwSetName, -taken, session=session):
+        raise _AbortTransaction(None)
+    lost = await _writeCombinedRecords(client, hwSetName, net, leases, session=session)
+    if lost:
+        if session is not None:
+            raise _AbortTransaction(None)
+        # Take back the units those projects were going to return
+        count_rollback('compensating')
+        if not await updateAvailability(client, hwSetName, sum(net[projectId] for projectId in lost)):
+            print(f"⚠ Could not take back {-sum(net[projectId] for projectId in lost)} units of {hwSetName}")
+        outcomes = [
+            None if projectId in lost and outcome == CHECKOUT_OK else outcome
+            for (projectId, _, _, _), outcome in zip(ops, outcomes)
+        ]
+
+    await appendLedger(client, [
+        ledgerEntry(projectId, hwSetName, qty, userId, 'check_out' if qty > 0 else 'check_in')
+        for (projectId, qty, userId, _), outcome in zip(ops, outcomes) if outcome == CHECKOUT_OK
+    ], session=session)
+    return outcomes
+
+# Function to apply concurrent check-outs/check-ins of one hardware set together
+@timed('applyCombined')
+async def applyCombined(client, hwSetName, ops, use_transaction=False):
+    """
+    Apply check-outs and check-ins of one hardware set gathered by write_combiner
+    with one guarded $inc of its availability and one bulk write to the checkout
+    records, instead of one contended update of the set per request. Each op is
+    admitted or rejected in order, exactly as checkOutHardware/checkInHardware
+    would have done one after another.
+    If a writer outside the batch moves availability too far between the read and
+    the $inc, the batch is re-read and retried; after COMBINE_ATTEMPTS (or on any
+    conflict inside a transaction) the ops run one by one through
+    checkOutHardware/checkInHardware.
+    Args:
+        client: An AsyncMongoClient instance
+        hwSetName(str): The hardware set name
+        ops(list): (projectId, qty, userId, leaseSeconds) tuples; qty is negative for a check-in
+        use_transaction(bool): Apply the batch in one transaction (replica set only)
+
+    Returns:
+        list: One outcome per op, in op order
+    """
+    outcomes = None
+    try:
+        for _ in range(1 if use_transaction else COMBINE_ATTEMPTS):
+            if use_transaction:
+                outcomes = await _runInTransaction(client, lambda session: _combinedSteps(client, hwSetName, ops, session=session))
+                hardware_cache.invalidate(hwSetName)
+            else:
+                try:
+                    outcomes = await _combinedSteps(client, hwSetName, ops)
+                except _AbortTransaction:
+                    continue
+            break
+    finally:
+        for projectId in {op[0] for op in ops}:
+            report_cache.invalidateProject(projectId)
+
+    outcomes = outcomes or [None] * len(ops)
+    for i, (projectId, qty, userId, leaseSeconds) in enumerate(ops):
+        if outcomes[i] is not None:
+            continue
+        if qty > 0:
+            outcomes[i] = await checkOutHardware(
+                client, projectId, hwSetName, qty, use_transaction=use_transaction, userId=userId, leaseSeconds=leaseSeconds
+            )
+        else:
+            outcomes[i] = await checkInHardware(client, projectId, hwSetName, -qty, use_transaction=use_transaction, userId=userId)
+    return outcomes
+
+# Function to renew a leased holding
+@timed('renewLease')
+async def renewLease(client, projectId, hwSetName, leaseSeconds):
+    """
+    Move a leased holding's expiry to leaseSeconds from now.
+    A lease that is already overdue can't be renewed, even if the sweeper hasn't returned it yet.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+        hwSetName(str): The hardware set name
+        leaseSeconds(int): New lease length
+
+    Returns:
+        tuple:
+            - str: CHECKOUT_OK, NO_HOLDING, NOT_LEASED or LEASE_EXPIRED
+            - datetime or None: The new expiry
+    """
+    checkout_col = client[config.mongo_database][config.mongo_collection_checkouts]
+    record_filter = {'projectId': projectId, 'hwSetName': hwSetName}
+    now = datetime.now(timezone.utc)
+    expiresAt = now + timedelta(seconds=leaseSeconds)
+    renewed = await checkout_col.find_one_and_update(
+        {**record_filter, 'expiresAt': {'$gt': now}},
+        {'$set': {'expiresAt': expiresAt}},
+        projection={'_id': 1}
+    )
+    if renewed is not None:
+        report_cache.invalidateProject(projectId)
+        return CHECKOUT_OK, expiresAt
+
+    record = await checkout_col.find_one(record_filter, {'expiresAt': 1})
+    if record is None:
+        return NO_HOLDING, None
+    if record.get('expiresAt') is None:
+        return NOT_LEASED, None
+    return LEASE_EXPIRED, None
+
+async def _deleteOverdue(client, now, batch_size, session=None):
+    """Claim up to batch_size overdue checkout records by deleting them. Returns (records found, records deleted)"""
+    checkout_col = client[config.mongo_database][config.mongo_collection_checkouts]
+    overdue = {'expiresAt': {'$lte': now}}
+    cursor = checkout_col.find(overdue, session=session).sort('expiresAt', ASCENDING).limit(batch_size)
+    found = [record async for record in cursor]
+    if not found:
+        return 0, []
+    if session is not None:
+        # The transaction's snapshot is what gets deleted; a concurrent change to any record is a write conflict
+        await checkout_col.delete_many({'_id': {'$in': [record['_id'] for record in found]}}, session=session)
+        return len(found), found
+    # find_one_and_delete returns each record as it was deleted, so a check-out or renewal that
+    # landed after the find is either included in the quantity returned or keeps the record
+    deleted = await asyncio.gather(*(
+        checkout_col.find_one_and_delete({'_id': record['_id'], **overdue}) for record in found
+    ))
+    return len(found), [record for record in deleted if record is not None]
+
+async def _restoreExpired(client, records, session=None):
+    """
+    Put back deleted checkout records whose units could not be returned. A record
+    is re-created with its overdue expiresAt, so the next sweep tries again; if the
+    project checked the set out again meanwhile, the units join that holding instead.
+    Returns:
+        bool: True if every record was put back
+    """
+    checkout_col = client[config.mongo_database][config.mongo_collection_checkouts]
+    try:
+        await checkout_col.bulk_write([
+            UpdateOne(
+                {'projectId': record['projectId'], 'hwSetName': record['hwSetName']},
+                {'$inc': {'quantity': record.get('quantity', 0)}, '$setOnInsert': {'expiresAt': record['expiresAt']}},
+                upsert=True
+            ) for record in records
+        ], ordered=False, session=session)
+        return True
+    except Exception as e:
+        print(f"⚠ Could not restore {len(records)} expired checkout records: {e}")
+        return False
+
+async def _expireLeaseBatch(client, now, batch_size, session=None):
+    """
+    Delete one batch of overdue holdings and return their units, one hardware set at a time.
+    When a set's units can't be returned, its records are put back and get no ledger entry.
+    Returns:
+        tuple: (records found, records expired, units returned, whether any set failed)
+    """
+    found, deleted = await _deleteOverdue(client, now, batch_size, session=session)
+    by_set = {}
+    for record in deleted:
+        by_set.setdefault(record['hwSetName'], []).append(record)
+    expired = []
+    failed = False
+    for hwSetName, records in by_set.items():
+        qty = sum(record.get('quantity', 0) for record in records)
+        try:
+            returned = not qty or await updateAvailability(client, hwSetName, qty, session=session)
+        except Exception as e:
+            if session is not None:
+                # Aborts the transaction, deletes included
+                raise
+            print(f"⚠ Returning {qty} expired units to {hwSetName} failed: {e}")
+            returned = False
+        if returned:
+            expired.extend(records)
+            continue
+        # Availability and the checkout records already disagreed, or the write failed
+        print(f"⚠ Could not return {qty} expired units to {hwSetName}; restoring its checkout records")
+        failed = True
+        restored = await _restoreExpired(client, records, session=session)
+        count_lease_return_failure('restored' if restored else 'lost', len(records))
+        if session is not None and not restored:
+            raise RuntimeError(f"could not restore expired checkout records of {hwSetName}")
+    await appendLedger(client, [
+        ledgerEntry(record['projectId'], record['hwSetName'], -record.get('quantity', 0), None, 'expire')
+        for record in expired
+    ], session=session)
+    return found, expired, sum(record.get('quantity', 0) for record in expired), failed
+
+# Function to return the units of expired leases
+@timed('expireLeases')
+async def expireLeases(client, use_transaction=False, batch_size=500):
+    """
+    Return every overdue leased holding to its hardware set, batch_size records at a time.
+    Records are found through the expiresAt index, so the cost grows with the number
+    of overdue leases, not with the number of checkout records. With transactions,
+    each batch's deletes, availability updates and ledger entries commit together.
+    Args:
+        client: An AsyncMongoClient instance
+        use_transaction(bool): Run each batch in one transaction (replica set only)
+        batch_size(int): Records per batch
+
+    Returns:
+        dict: expired (records), units returned and the hwSetNames they went back to
+    """
+    now = datetime.now(timezone.utc)
+    summary = {'expired': 0, 'units': 0, 'hwSetNames': set()}
+    while True:
+        if use_transaction:
+            found, expired, units, failed = await _runInTransaction(
+                client, lambda session: _expireLeaseBatch(client, now, batch_size, session=session)
+            )
+        else:
+            found, expired, units, failed = await _expireLeaseBatch(client, now, batch_size)
+        for projectId in {record['projectId'] for record in expired}:
+            report_cache.invalidateProject(projectId)
+        summary['expired'] += len(expired)
+        summary['units'] += units
+        summary['hwSetNames'].update(record['hwSetName'] for record in expired)
+        # Restored records are overdue again, so a failed batch ends the sweep instead of looping on them
+        if found < batch_size or failed:
+            summary['hwSetNames'] = sorted(summary['hwSetNames'])
+            return summary
+
+# Waitlist entry states: waiting -> granting -> granted, or waiting -> cancelled / expired
+WAIT_WAITING = "waiting"
+WAIT_GRANTING = "granting"
+WAIT_GRANTED = "granted"
+WAIT_CANCELLED = "cancelled"
+WAIT_EXPIRED = "expired"
+
+# Queue order: higher priority first, then first come first served
+WAITLIST_ORDER = [('priority', DESCENDING), ('_id', ASCENDING)]
+
+def publicWaitEntry(entry, position=None):
+    """
+    JSON-friendly waitlist entry.
+    Args:
+        entry(dict): The stored entry
+        position(int): Entries ahead of it in the queue (waiting entries only)
+    """
+    return {
+        'waitId': str(entry['_id']),
+        'projectId': entry['projectId'],
+        'hwSetName': entry['hwSetName'],
+        'qty': entry['qty'],
+        'priority': entry['priority'],
+        'status': entry['status'],
+        'position': position,
+        'createdAt': utc(entry['createdAt']).isoformat(),
+        'giveUpAt': utc(entry['giveUpAt']).isoformat(),
+        'grantedAt': utc(entry['grantedAt']).isoformat() if entry.get('grantedAt') else None
+    }
+
+def _waitlistCollection(client):
+    return client[config.mongo_database][config.mongo_collection_waitlist]
+
+async def _withPosition(client, entry):
+    if entry['status'] != WAIT_WAITING:
+        return publicWaitEntry(entry)
+    ahead = await _waitlistCollection(client).count_documents({
+        'hwSetName': entry['hwSetName'],
+        'status': WAIT_WAITING,
+        '$or': [
+            {'priority': {'$gt': entry['priority']}},
+            {'priority': entry['priority'], '_id': {'$lt': entry['_id']}}
+        ]
+    })
+    return publicWaitEntry(entry, ahead)
+
+# Function to add a check-out to a hardware set's waitlist
+@timed('enqueueCheckout')
+async def enqueueCheckout(client, projectId, hwSetName, qty, userId=None, priority=0, leaseSeconds=None,
+                          idempotency_key=None):
+    """
+    Queue a check-out until enough units are available. Entries are granted in
+    priority order, then in arrival order, by drainWaitlist.
+    Args:
+        client: An AsyncMongoClient instance
+        projectId(str): The project ID
+        hwSetName(str): The hardware set name
+        qty(int): The quantity to check out
+        userId(str): The requesting user, recorded in the ledger when granted
+        priority(int): Higher is served first
+        leaseSeconds(int): Optional lease, starting when the entry is granted
+        idempotency_key(str): Optional Idempotency-Key; a repeated key returns the existing entry
+
+    Returns:
+        tuple:
+            - str: CHECKOUT_OK, HW_NOT_FOUND, EXCEEDS_CAPACITY or an idempotency outcome
+            - dict or None: The public entry
+    """
+    hw_exists, hw_set = await queryHardwareSet(client, hwSetName)
+    if not hw_exists:
+        return HW_NOT_FOUND, None
+    if qty > hw_set['capacity']:
+        # Could never be granted
+        return EXCEEDS_CAPACITY, None
+
+    now = datetime.now(timezone.utc)
+    entry = {
+        '_id': ObjectId(),
+        'hwSetName': hwSetName,
+        'projectId': projectId,
+        'userId': userId,
+        'qty': qty,
+        'priority': priority,
+        'leaseSeconds': leaseSeconds,
+        'status': WAIT_WAITING,
+        'createdAt': now,
+        'giveUpAt': now + timedelta(seconds=config.waitlist_max_wait_seconds)
+    }
+    if idempotency_key is not None:
+        entry['idempotencyKey'] = idempotency_key
+        entry['fingerprint'] = request_fingerprint('waitlist', projectId, hwSetName, qty, priority, leaseSeconds)
+    waitlist_col = _waitlistCollection(client)
+    try:
+        await waitlist_col.insert_one(entry)
+    except DuplicateKeyError:
+        existing = await waitlist_col.find_one({'idempotencyKey': idempotency_key})
+        if existing is None:
+            return IDEMPOTENCY_IN_PROGRESS, None
+        if existing['fingerprint'] != entry['fingerprint']:
+            return IDEMPOTENCY_KEY_REUSED, None
+        entry = existing
+    return CHECKOUT_OK, await _withPosition(client, entry)
+
+async def _grantHead(client, hwSetName, now, session=None):
+    """
+    Grant the head of a set's waitlist if it fits.
+    The head blocks the queue: a smaller request behind it is not served first.
+    Returns:
+        tuple: (granted entry or None, whether to look at the next head)
+    """
+    waitlist_col = _waitlistCollection(client)
+    head = await waitlist_col.find_one({'hwSetName': hwSetName, 'status': WAIT_WAITING}, sort=WAITLIST_ORDER, session=session)
+    if head is None:
+        return None, False
+    if utc(head['giveUpAt']) <= now:
+        await waitlist_col.update_one(
+            {'_id': head['_id'], 'status': WAIT_WAITING},
+            {'$set': {'status': WAIT_EXPIRED, 'finishedAt': now}}, session=session
+        )
+        return None, True
+    # Read the database, not the hardware cache: a stale low availability would stall the queue
+    hw_set = await _loadHardwareSet(client, hwSetName, session=session)
+    if hw_set is None or hw_set['availability'] < head['qty']:
+        return None, False
+    claimed = await waitlist_col.find_one_and_update(
+        {'_id': head['_id'], 'status': WAIT_WAITING},
+        {'$set': {'status': WAIT_GRANTING, 'grantingAt': now}}, session=session
+    )
+    if claimed is None:
+        # Another worker is granting it
+        return None, True
+
+    release = lambda: waitlist_col.update_one(
+        {'_id': head['_id'], 'status': WAIT_GRANTING}, {'$set': {'status': WAIT_WAITING}, '$unset': {'grantingAt': ''}}
+    )
+    try:
+        # Without a transaction the checkout record carries the waitId, so _settleStaleGrants
+        # can tell whether the units were taken if this grant never finishes
+        outcome = await _checkOutSteps(
+            client, head['projectId'], hwSetName, head['qty'], session=session,
+            expiresAt=leaseExpiry(head.get('leaseSeconds')), waitId=str(head['_id']) if session is None else None
+        )
+    except _AbortTransaction:
+        if session is not None:
+            raise
+        count_rollback('compensating')
+        await updateAvailability(client, hwSetName, head['qty'])
+        outcome = RECORD_UPDATE_FAILED
+    except BaseException:
+        if session is None:
+            await release()
+        raise
+    if outcome != CHECKOUT_OK:
+        if session is not None:
+            # Roll the claim back with everything else
+            raise _AbortTransaction(None)
+        await release()
+        return None, False
+
+    await _finishGrant(client, head, now, session=session)
+    return head, True
+
+async def _finishGrant(client, entry, now, session=None):
+    """
+    Mark a claimed entry whose units were taken as granted, add its ledger entry
+    and clear its waitId from the checkout record. Only the call that moves the
+    entry to granted adds the ledger entry.
+    Returns:
+        bool: True if this call finished the grant
+    """
+    entry.update(status=WAIT_GRANTED, grantedAt=now)
+    finished = await _waitlistCollection(client).update_one(
+        # A settled claim may have been put back to waiting; the units are this grant's either way
+        {'_id': entry['_id'], 'status': {'$in': [WAIT_GRANTING, WAIT_WAITING]}},
+        {'$set': {'status': WAIT_GRANTED, 'grantedAt': now, 'finishedAt': now}, '$unset': {'grantingAt': ''}},
+        session=session
+    )
+    if finished.modified_count:
+        await appendLedger(client, [
+            ledgerEntry(entry['projectId'], entry['hwSetName'], entry['qty'], entry.get('userId'), 'check_out')
+        ], session=session)
+    if session is None:
+        await client[config.mongo_database][config.mongo_collection_checkouts].update_one(
+            {'projectId': entry['projectId'], 'hwSetName': entry['hwSetName']}, {'$pull': {'grants': str(entry['_id'])}}
+        )
+    return bool(finished.modified_count)
+
+# A claim older than this is from a grant that will never finish (a crashed worker, or a failed final write)
+GRANT_CLAIM_TIMEOUT = timedelta(seconds=60)
+
+async def _settleStaleGrants(client, now, hwSetName=None):
+    """
+    Finish or release entries left in granting. If the project's checkout record
+    carries the entry's waitId, the units were taken: the grant is finished.
+    Otherwise the entry goes back to waiting, in its old place in the queue.
+    Transactional grants never leave a claim behind, so only the path without
+    transactions needs this.
+    Returns:
+        int: Entries settled
+    """
+    waitlist_col = _waitlistCollection(client)
+    checkout_col = client[config.mongo_database][config.mongo_collection_checkouts]
+    stale = {
+        'status': WAIT_GRANTING,
+        # Claims made before grantingAt was recorded count as stale
+        '$or': [{'grantingAt': {'$lte': now - GRANT_CLAIM_TIMEOUT}}, {'grantingAt': {'$exists': False}}]
+    }
+    if hwSetName is not None:
+        stale['hwSetName'] = hwSetName
+    settled = 0
+    async for entry in waitlist_col.find(stale):
+        taken = await checkout_col.find_one(
+            {'projectId': entry['projectId'], 'hwSetName': entry['hwSetName'], 'grants': str(entry['_id'])}, {'_id': 1}
+        )
+        if taken is not None:
+            settled += await _finishGrant(client, entry, now)
+            continue
+        released = await waitlist_col.update_one(
+            {'_id': entry['_id'], 'status': WAIT_GRANTING, 'grantingAt': entry.get('grantingAt')},
+            {'$set': {'status': WAIT_WAITING}, '$unset': {'grantingAt': ''}}
+        )
+        settled += released.modified_count
+    if settled:
+        print(f"⚠ Settled {settled} waitlist grants that never finished")
+    return settled
+
+# Function to grant waiting check-outs that now fit
+@timed('drainWaitlist')
+async def drainWaitlist(client, hwSetName, use_transaction=False, limit=100):
+    """
+    Grant a hardware set's waiting check-outs in queue order until the head no
+    longer fits. Entries past their giveUpAt are expired on the way. Called after
+    check-ins and lease expiry, and periodically.
+    Args:
+        client: An AsyncMongoClient instance
+        hwSetName(str): The hardware set name
+        use_transaction(bool): Claim, check out and record each grant in one transaction (replica set only)
+        limit(int): Most queue heads looked at in one call
+
+    Returns:
+        list: Public entries granted by this call
+    """
+    now = datetime.now(timezone.utc)
+    granted = []
+    if not use_transaction:
+        await _settleStaleGrants(client, now, hwSetName)
+    for _ in range(limit):
+        if use_transaction:
+            result = await _runInTransaction(client, lambda session: _grantHead(client, hwSetName, now, session=session))
+            entry, more = result or (None, False)
+            hardware_cache.invalidate(hwSetName)
+        else:
+            entry, more = await _grantHead(client, hwSetName, now)
+        if entry is not None:
+            report_cache.invalidateProject(entry['projectId'])
+            granted.append(publicWaitEntry(entry))
+        if not more:
+            break
+    return granted
+
+# Function to list hardware sets with waiting check-outs
+async def getWaitlistedHwSets(client):
+    """
+    Returns:
+        list: Names of hardware sets whose waitlist is not empty
+    """
+    return await _waitlistCollection(client).distinct('hwSetName', {'status': WAIT_WAITING})
+
+# Function to expire waitlist entries that waited too long
+async def expireWaits(client):
+    """
+    Mark every waiting entry past its giveUpAt as expired, after settling
+    grants that never finished (see _settleStaleGrants).
+    Returns:
+        int: Entries expired
+    """
+    now = datetime.now(timezone.utc)
+    await _settleStaleGrants(client, now)
+    result = await _waitlistCollection(client).update_many(
+        {'status': WAIT_WAITING, 'giveUpAt': {'$lte': now}},
+        {'$set': {'status': WAIT_EXPIRED, 'finishedAt': now}}
+    )
+    return result.modified_count
+
+# Function to get a waitlist entry
+@timed('getWaitlistEntry')
+async def getWaitlistEntry(client, waitId):
+    """
+    Args:
+        client: An AsyncMongoClient instance
+        waitId(str): The entry's waitId
+
+    Returns:
+        dict or None: The public entry (with its queue position while waiting)
+    """
+    if not ObjectId.is_valid(waitId):
+        return None
+    entry = await _waitlistCollection(client).find_one({'_id': ObjectId(waitId)})
+    return await _withPosition(client, entry) if entry is not None else None
+
+# Function to find which of several waitlist entries are finished
+async def getFinishedWaits(client, waitIds):
+    """
+    One query for every entry a worker has clients waiting on.
+    Args:
+        client: An AsyncMongoClient instance
+        waitIds(list): waitIds to look at
+
+    Returns:
+        list: Public entries that are granted, cancelled or expired
+    """
+    ids = [ObjectId(waitId) for waitId in waitIds if ObjectId.is_valid(waitId)]
+    cursor = _waitlistCollection(client).find({
+        '_id': {'$in': ids},
+        'status': {'$nin': [WAIT_WAITING, WAIT_GRANTING]}
+    })
+    return [publicWaitEntry(entry) async for entry in cursor]
+
+# Function to cancel a waiting check-out
+@timed('cancelWait')
+async def cancelWait(client, waitId):
+    """
+    Args:
+        client: An AsyncMongoClient instance
+        waitId(str): The entry's waitId
+
+    Returns:
+        str: CHECKOUT_OK, NO_WAIT_ENTRY or WAIT_FINISHED
+    """
+    if not ObjectId.is_valid(waitId):
+        return NO_WAIT_ENTRY
+    waitlist_col = _waitlistCollection(client)
+    cancelled = await waitlist_col.find_one_and_update(
+        {'_id': ObjectId(waitId), 'status': WAIT_WAITING},
+        {'$set': {'status': WAIT_CANCELLED, 'finishedAt': datetime.now(timezone.utc)}}
+    )
+    if cancelled is not None:
+        return CHECKOUT_OK
+    if await waitlist_col.find_one({'_id': ObjectId(waitId)}, {'_id': 1}) is None:
+        return NO_WAIT_ENTRY
+    return WAIT_FINISHED
+
+# At most this many duplicate/error records are listed in an import summary (all are counted)
+IMPORT_REPORT_LIMIT = 100
+
+def _intField(record, field, default=None):
+    value = record.get(field, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be an integer")
+
+def _timestampField(record, field):
+    value = record.get(field)
+    if value is None:
+        return None
+    try:
+        return utc(datetime.fromisoformat(value))
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be an ISO 8601 timestamp")
+
+def parseImportRecord(record):
+    """
+    Validate one import record and turn it into (record type, document).
+    Records without a type (or with type "hardware") are hardware sets; type
+    "checkout" restores a project checkout record from an export, including
+    the lease expiry (expiresAt) of a leased holding.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("not a valid record")
+    record_type = record.get('type', 'hardware')
+    if record_type == 'hardware':
+        hwSetName = record.get('hwSetName')
+        if not isinstance(hwSetName, str) or not hwSetName:
+            raise ValueError("hwSetName is required")
+        capacity = _intField(record, 'capacity')
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        availability = _intField(record, 'availability', capacity)
+        if not 0 <= availability <= capacity:
+            raise ValueError("availability must be between 0 and capacity")
+        return 'hardware', {'hwSetName': hwSetName, 'capacity': capacity, 'availability': availability}
+    if record_type == 'checkout':
+        projectId, hwSetName = record.get('projectId'), record.get('hwSetName')
+        if not projectId or not hwSetName:
+            raise ValueError("projectId and hwSetName are required")
+        quantity = _intField(record, 'quantity')
+        if quantity <= 0:
+            raise ValueError("quantity must be positive")
+        document = {'projectId': projectId, 'hwSetName': hwSetName, 'quantity': quantity}
+        expiresAt = _timestampField(record, 'expiresAt')
+        if expiresAt is not None:
+            document['expiresAt'] = expiresAt
+        return 'checkout', document
+    raise ValueError(f"unknown record type {record_type!r}")
+
+# Collection attribute on config for each import record type
+IMPORT_COLLECTIONS = {
+    'hardware': 'mongo_collection_hardware',
+    'checkout': 'mongo_collection_checkouts'
+}
+
+async def _insertBatch(client, record_type, batch, summary):
+    """Unordered insert_many: duplicates are reported and the rest of the batch still goes in"""
+    collection = client[config.mongo_database][getattr(config, IMPORT_COLLECTIONS[record_type])]
+    failed = set()
+    try:
+        result = await collection.insert_many([document for _, document in batch], ordered=False)
+        summary['inserted'] += len(result.inserted_ids)
+    except BulkWriteError as e:
+        summary['inserted'] += e.details.get('nInserted', 0)
+        for error in e.details.get('writeErrors', []):
+            failed.add(error['index'])
+            line, document = batch[error['index']]
+            if error.get('code') == 11000:
+                reportImportDuplicate(summary, line, document)
+            else:
+                reportImportError(summary, line, error.get('errmsg', 'write error'))
+    report_cache.clear()
+    if record_type == 'checkout':
+        # Restored holdings open with an "import" entry so the ledger replays to the same balances
+        await appendLedger(client, [
+            ledgerEntry(document['projectId'], document['hwSetName'], document['quantity'], None, 'import')
+            for index, (_, document) in enumerate(batch) if index not in failed
+        ])
+
+def newImportSummary():
+    return {'inserted': 0, 'duplicates': 0, 'errors': 0, 'duplicateRecords': [], 'errorRecords': []}
+
+def reportImportDuplicate(summary, line, document):
+    summary['duplicates'] += 1
+    if len(summary['duplicateRecords']) < IMPORT_REPORT_LIMIT:
+        summary['duplicateRecords'].append({'line': line, 'hwSetName': document['hwSetName']})
+
+def reportImportError(summary, line, message):
+    summary['errors'] += 1
+    if len(summary['errorRecords']) < IMPORT_REPORT_LIMIT:
+        summary['errorRecords'].append({'line': line, 'error': message})
+
+# Function to bulk import hardware sets (and exported checkout records)
+@timed('importRecords')
+async def importRecords(client, records, batch_size=1000):
+    """
+    Insert records in unordered insert_many batches. Duplicates (unique index
+    violations) and invalid records are counted and reported without aborting.
+    Args:
+        client: An AsyncMongoClient instance
+        records: Async iterable of (line number, dict) pairs, e.g. from bulk_io parsers
+        batch_size(int): Documents per insert_many call
+    
+    Returns:
+        dict: inserted, duplicates and errors counts plus the first offending records
+    """
+    summary = newImportSummary()
+    batches = {}
+    async for line, record in records:
+        try:
+            record_type, document = parseImportRecord(record)
+        except ValueError as e:
+            reportImportError(summary, line, str(e))
+            continue
+        batch = batches.setdefault(record_type, [])
+        batch.append((line, document))
+        if len(batch) >= batch_size:
+            await _insertBatch(client, record_type, batch, summary)
+            batches[record_type] = []
+    for record_type, batch in batches.items():
+        if batch:
+            await _insertBatch(client, record_type, batch, summary)
+    return summary
+
+# Function to stream hardware and checkout state
+async def exportState(client, include=('hardware', 'checkout'), batch_size=1000):
+    """
+    Yield every hardware set and/or checkout record as a typed dict, straight from the cursors.
+    The output can be fed back to importRecords.
+    Args:
+        client: An AsyncMongoClient instance
+        include(tuple): Record types to export ("hardware", "checkout")
+        batch_size(int): Documents fetched per getMore round-trip
+    
+    Yields:
+        dict: {"type": "hardware", hwSetName, capacity, availability} or
+              {"type": "checkout", projectId, hwSetName, quantity[, expiresAt]}, with
+              expiresAt as an ISO 8601 string on leased holdings
+    """
+    db = routed_database(client, 'exportState')
+    sources = [
+        ('hardware', config.mongo_collection_hardware, {'_id': 0, 'hwSetName': 1, 'capacity': 1, 'availability': 1, 'shards': 1}, 'hwSetName'),
+        ('checkout', config.mongo_collection_checkouts, {'_id': 0, 'projectId': 1, 'hwSetName': 1, 'quantity': 1, 'expiresAt': 1}, 'projectId')
+    ]
+    for record_type, collection_name, projection, sort_key in sources:
+        if record_type not in include:
+            continue
+        cursor = db[collection_name].find({}, projection, batch_size=batch_size).sort(sort_key, ASCENDING)
+        try:
+            async for document in cursor:
+                if document.get('shards'):
+                    # Exported as a single counter, like any other set
+                    await _withShardTotals(client, [document], db=db)
+                document.pop('shards', None)
+                if document.get('expiresAt') is not None:
+                    document['expiresAt'] = utc(document['expiresAt']).isoformat()
+                yield {'type': record_type, **document}
+        finally:
+            await cursor.close()
@@ -0,0 +1,207 @@
+# Change-stream watcher keeping an in-memory snapshot of every hardware set
+import asyncio
+import time
+from pymongo.errors import OperationFailure, PyMongoError
+from config import config
+
+# Server error codes meaning the stored resume token can no longer be used
+RESUME_FAILURE_CODES = {
+    260,  # InvalidResumeToken
+    280,  # ChangeStreamFatalError
+    286   # ChangeStreamHistoryLost
+}
+
+class HardwareWatcher:
+    """
+    Keeps `snapshot` (hwSetName -> hardware set document) current by following a
+    change stream over the hardware and checkouts collections.
+
+    Startup opens the stream first (from the persisted resume token if there is
+    one) and only then loads every hardware set, so no write can fall between
+    the load and the stream. Events replayed from before the load are applied
+    idempotently:
+    - inserts only add sets not already in the snapshot
+    - updates use the looked-up current document
+    - deletes only remove the document with the matching _id
+    If the token can't be resumed, the watcher starts a new stream and reloads
+    everything.
+
+    Checkout events don't change the snapshot. They are passed to listeners
+    registered with add_listener(callback), which are called as callback(change).
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.db = client[config.mongo_database]
+        self.snapshot = {}
+        self.ready = False
+        self.resume_token = None
+        self._ids = {}
+        self._listeners = []
+        self._task = None
+        self._last_persist = 0.0
+        self.events = 0
+        self.reloads = 0
+        self.resumes = 0
+        self.errors = 0
+        self.last_event_at = None
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    async def start(self):
+        """Load the persisted resume token and start following the change stream in the background"""
+        state = await self.db[config.mongo_collection_service_state].find_one({"_id": "hardware_watcher"})
+        if state:
+            self.resume_token = state.get("resumeToken")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and persist the last resume token"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._persist_token(force=True)
+        self.ready = False
+
+    async def _run(self):
+        backoff = 0.5
+        while True:
+            try:
+                await self._follow()
+                # The stream ended on a collection-level event; reopen right away
+                backoff = 0.5
+                continue
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                self.errors += 1
+                if e.code in RESUME_FAILURE_CODES:
+                    print(f"⚠ Hardware watcher cannot resume ({e.code}); reloading all hardware sets")
+                    self.resume_token = None
+                    self.ready = False
+                else:
+                    print(f"⚠ Hardware watcher error: {e}")
+            except PyMongoError as e:
+                # Network errors etc.: resume from the in-memory token after a short pause
+                self.errors += 1
+                print(f"⚠ Hardware watcher error: {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    async def _follow(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": [
+            config.mongo_collection_hardware,
+            config.mongo_collection_checkouts
+        ]}}}]
+        async with await self.db.watch(
+            pipeline,
+            full_document="updateLookup",
+            resume_after=self.resume_token,
+            max_await_time_ms=1000
+        ) as stream:
+            if self.resume_token is not None and self.ready:
+                self.resumes += 1
+            if not self.ready:
+                await self._reload()
+            while stream.alive:
+                change = await stream.try_next()
+                if change is not None:
+                    self._apply(change)
+                    if not self.ready:
+                        return
+                self.resume_token = stream.resume_token
+                await self._persist_token()
+
+    async def _reload(self):
+        """Replace the snapshot with every hardware set currently in the database"""
+        snapshot = {}
+        ids = {}
+        async for hw_set in self.db[config.mongo_collection_hardware].find({}):
+            snapshot[hw_set["hwSetName"]] = hw_set
+            ids[hw_set["_id"]] = hw_set["hwSetName"]
+        self.snapshot = snapshot
+        self._ids = ids
+        self.reloads += 1
+        self.ready = True
+        print(f"✓ Hardware watcher loaded {len(snapshot)} hardware sets")
+
+    def _apply(self, change):
+        self.events += 1
+        self.last_event_at = time.time()
+        operation = change.get("operationType")
+        collection = change.get("ns", {}).get("coll")
+
+        if operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            # Collection-level event: the stream ends; force a full reload on the next one
+            self.resume_token = None
+            self.ready = False
+            return
+
+        if collection == config.mongo_collection_hardware:
+            doc_id = change.get("documentKey", {}).get("_id")
+            document = change.get("fullDocument")
+            if operation == "insert":
+                # A replayed insert must not overwrite a newer copy loaded by _reload
+                if document["hwSetName"] not in self.snapshot:
+                    self._store(document)
+            elif operation in ("update", "replace"):
+                if document is not None:
+                    self._store(document)
+                else:
+                    # Deleted after the update; the lookup found nothing
+                    self._remove(doc_id)
+            elif operation == "delete":
+                self._remove(doc_id)
+
+        for callback in self._listeners:
+            try:
+                callback(change)
+            except Exception as e:
+                print(f"⚠ Hardware watcher listener failed: {e}")
+
+    def _store(self, document):
+        self.snapshot[document["hwSetName"]] = document
+        self._ids[document["_id"]] = document["hwSetName"]
+
+    def _remove(self, doc_id):
+        hwSetName = self._ids.pop(doc_id, None)
+        current = self.snapshot.get(hwSetName)
+        if current is not None and current["_id"] == doc_id:
+            del self.snapshot[hwSetName]
+
+    async def _persist_token(self, force=False):
+        now = time.monotonic()
+        if self.resume_token is None:
+            return
+        if not force and now - self._last_persist < config.hw_watcher_persist_seconds:
+            return
+        self._last_persist = now
+        try:
+            await self.db[config.mongo_collection_service_state].update_one(
+                {"_id": "hardware_watcher"},
+                {"$set": {"resumeToken": self.resume_token, "updatedAt": time.time()}},
+                upsert=True
+            )
+        except PyMongoError as e:
+            print(f"⚠ Could not persist hardware watcher resume token: {e}")
+
+    def stats(self):
+        """
+        Return watcher state and counters.
+        Returns:
+            dict: Readiness, snapshot size and event/reload/resume counters
+        """
+        return {
+            "ready": self.ready,
+            "hardwareSets": len(self.snapshot),
+            "events": self.events,
+            "reloads": self.reloads,
+            "resumes": self.resumes,
+            "errors": self.errors,
+            "lastEventAt": self.last_event_at
+        }
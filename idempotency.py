@@ -0,0 +1,72 @@
+# Idempotency-Key support: request fingerprints and the in-process cache of finished requests
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from config import config
+
+def request_fingerprint(operation, *fields):
+    """
+    Fingerprint of a keyed request, stored with the key so reusing a key for a
+    different request can be rejected instead of replaying the wrong response.
+    Args:
+        operation(str): "check_out" or "check_in"
+        fields: The request fields that determine the outcome
+
+    Returns:
+        str: Hex digest
+    """
+    return hashlib.sha256(json.dumps([operation, *fields]).encode()).hexdigest()
+
+class IdempotencyCache:
+    """
+    LRU of finished keyed requests: key -> (fingerprint, outcome), with a TTL
+    matching the key collection's. A retry that lands on the worker that ran the
+    original is answered without a database round-trip; misses fall through to
+    the database, which stays the source of truth.
+    Only touched from the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return (fingerprint, outcome) for a finished request, or None.
+        Args:
+            key(str): The Idempotency-Key header value
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, fingerprint, outcome):
+        """
+        Remember the outcome of a finished keyed request.
+        Args:
+            key(str): The Idempotency-Key header value
+            fingerprint(str): request_fingerprint of the request
+            outcome(str): The outcome returned for it
+        """
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, (fingerprint, outcome))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+# Global cache instance shared by the async data layer
+idempotency_cache = IdempotencyCache(config.idempotency_cache_max_entries, config.idempotency_ttl_seconds)
@@ -0,0 +1,247 @@
+# Prometheus metrics: HTTP latency, per-operation data-layer timing and check-out/check-in counters
+import time
+from functools import wraps
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# 0.5 ms (cache hits, local round-trips) up to 10 s (pool wait timeouts, large imports)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram(
+    'hardware_http_request_duration_seconds',
+    'HTTP request latency by route template and status code',
+    ['method', 'route', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+DB_OPERATION_LATENCY = Histogram(
+    'hardware_db_operation_duration_seconds',
+    'Latency of each hardware_database_async call (nested calls are timed separately)',
+    ['operation'],
+    buckets=LATENCY_BUCKETS
+)
+ROLLBACKS = Counter(
+    'hardware_rollbacks',
+    'Check-out/check-in writes undone: aborted transactions or compensating writes',
+    ['mode']
+)
+CHECKOUT_OUTCOMES = Counter(
+    'hardware_checkout_outcomes',
+    'Check-out/check-in results per item; outcome="not_enough_available" counts insufficient-availability rejections',
+    ['operation', 'outcome']
+)
+
+LEASE_RETURN_FAILURES = Counter(
+    'hardware_lease_return_failures',
+    'Expired leases whose units could not be returned: records restored for the next sweep, or lost',
+    ['resolution']
+)
+
+ROUTED_READS = Counter(
+    'hardware_db_routed_reads',
+    'Read-only data-layer calls by the read preference they were routed with',
+    ['operation', 'read_preference']
+)
+
+# Label lookups cost more than the observation itself, so resolved children are kept in plain dicts
+_request_children = {}
+_outcome_children = {}
+_routed_children = {}
+_rollback_children = {mode: ROLLBACKS.labels(mode=mode) for mode in ('transaction', 'compensating')}
+
+def timed(operation):
+    """
+    Decorator recording an async function's latency in DB_OPERATION_LATENCY.
+    Args:
+        operation(str): Value of the operation label
+    """
+    observe = DB_OPERATION_LATENCY.labels(operation=operation).observe
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def count_rollback(mode):
+    """
+    Count one undone check-out/check-in.
+    Args:
+        mode(str): "transaction" (aborted) or "compensating" (undone by a second write)
+    """
+    _rollback_children[mode].inc()
+
+def count_lease_return_failure(resolution, records=1):
+    """
+    Count expired checkout records whose units the lease sweeper could not return.
+    Args:
+        resolution(str): "restored" (put back for the next sweep) or "lost" (the ledger audit will show it)
+        records(int): Number of records
+    """
+    LEASE_RETURN_FAILURES.labels(resolution=resolution).inc(records)
+
+def count_outcomes(operation, outcomes):
+    """
+    Count check-out/check-in outcomes.
+    Args:
+        operation(str): "check_out" or "check_in"
+        outcomes(list): Outcome constants, one per item
+    """
+    for outcome in outcomes:
+        child = _outcome_children.get((operation, outcome))
+        if child is None:
+            child = _outcome_children[(operation, outcome)] = CHECKOUT_OUTCOMES.labels(operation=operation, outcome=outcome)
+        child.inc()
+
+def count_routed_read(operation, read_preference):
+    """
+    Count one read-only call routed by mongo_pool.routed_database.
+    Args:
+        operation(str): The operation name
+        read_preference(str): The read preference it was sent with
+    """
+    child = _routed_children.get((operation, read_preference))
+    if child is None:
+        child = _routed_children[(operation, read_preference)] = ROUTED_READS.labels(operation=operation, read_preference=read_preference)
+    child.inc()
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware timing every HTTP request. The route label is the matched
+    path template (e.g. /get_hw_info), or "unmatched", so label cardinality stays
+    bounded. Streaming responses are timed until the last chunk is sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            key = (scope["method"], getattr(route, "path", "unmatched"), status)
+            child = _request_children.get(key)
+            if child is None:
+                child = _request_children[key] = REQUEST_LATENCY.labels(*key)
+            child.observe(time.perf_counter() - start)
+
+class PoolCollector:
+    """Reads the connection pool counters from a PoolStatsListener at scrape time (no per-request cost)"""
+
+    def __init__(self):
+        self.listener = None
+
+    def collect(self):
+        if self.listener is None:
+            return
+        snapshot = self.listener.snapshot()
+        gauges = {
+            'openConnections': GaugeMetricFamily(
+                'hardware_mongo_pool_open_connections', 'Open pooled connections', labels=['server']),
+            'checkedOut': GaugeMetricFamily(
+                'hardware_mongo_pool_checked_out', 'Connections currently checked out', labels=['server']),
+            'waitQueue': GaugeMetricFamily(
+                'hardware_mongo_pool_wait_queue', 'Operations waiting for a connection', labels=['server'])
+        }
+        max_size = GaugeMetricFamily('hardware_mongo_pool_max_size', 'Configured maxPoolSize')
+        max_size.add_metric([], snapshot['settings']['maxPoolSize'])
+        checkouts = CounterMetricFamily(
+            'hardware_mongo_pool_checkouts', 'Successful connection check-outs', labels=['server'])
+        failures = CounterMetricFamily(
+            'hardware_mongo_pool_checkout_failures', 'Failed connection check-outs by reason', labels=['server', 'reason'])
+        wait = CounterMetricFamily(
+            'hardware_mongo_pool_checkout_wait_seconds', 'Total time spent waiting for connections', labels=['server'])
+        for server, stats in snapshot['servers'].items():
+            for field, gauge in gauges.items():
+                gauge.add_metric([server], stats[field])
+            checkouts.add_metric([server], stats['checkOuts'])
+            wait.add_metric([server], stats['totalCheckOutWaitMs'] / 1000)
+            for reason, count in stats['checkOutFailures'].items():
+                failures.add_metric([server, reason], count)
+        yield from gauges.values()
+        yield max_size
+        yield checkouts
+        yield failures
+        yield wait
+
+# Registered once; lifespan points it at the worker's PoolStatsListener
+pool_collector = PoolCollector()
+REGISTRY.register(pool_collector)
+
+class AdmissionCollector:
+    """Reads admission limits, load and rejections from an AdmissionController at scrape time"""
+
+    def __init__(self):
+        self.controller = None
+
+    def collect(self):
+        if self.controller is None:
+            return
+        stats = self.controller.stats()
+        limit = GaugeMetricFamily(
+            'hardware_admission_limit', 'Concurrent requests allowed per route', labels=['route'])
+        queue_size = GaugeMetricFamily(
+            'hardware_admission_queue_size', 'Requests allowed to wait per route', labels=['route'])
+        in_flight = GaugeMetricFamily(
+            'hardware_admission_in_flight', 'Requests currently running per route', labels=['route'])
+        waiting = GaugeMetricFamily(
+            'hardware_admission_waiting', 'Requests currently waiting per route', labels=['route'])
+        admitted = CounterMetricFamily(
+            'hardware_admission_admitted', 'Requests admitted per route', labels=['route'])
+        rejected = CounterMetricFamily(
+            'hardware_admission_rejected', 'Requests turned away per route by reason', labels=['route', 'reason'])
+        for route, counters in stats['routes'].items():
+            if counters['limit'] is not None:
+                limit.add_metric([route], counters['limit'])
+                queue_size.add_metric([route], counters['queueSize'])
+                in_flight.add_metric([route], counters['inFlight'])
+                waiting.add_metric([route], counters['waiting'])
+            admitted.add_metric([route], counters['admitted'])
+            for reason, count in counters['rejected'].items():
+                rejected.add_metric([route, reason], count)
+        yield from (limit, queue_size, in_flight, waiting, admitted, rejected)
+        worker = stats['worker']
+        if worker is not None:
+            worker_limit = GaugeMetricFamily(
+                'hardware_admission_worker_limit', 'Concurrent requests allowed across limited routes')
+            worker_limit.add_metric([], worker['limit'])
+            reserved = GaugeMetricFamily(
+                'hardware_admission_worker_read_reserved', 'Worker-wide slots only reads may use')
+            reserved.add_metric([], worker['readReserved'])
+            worker_in_flight = GaugeMetricFamily(
+                'hardware_admission_worker_in_flight', 'Requests running across limited routes')
+            worker_in_flight.add_metric([], worker['inFlight'])
+            worker_waiting = GaugeMetricFamily(
+                'hardware_admission_worker_waiting', 'Requests waiting for a worker-wide slot', labels=['priority'])
+            worker_waiting.add_metric(['read'], worker['waitingReads'])
+            worker_waiting.add_metric(['write'], worker['waitingWrites'])
+            yield from (worker_limit, reserved, worker_in_flight, worker_waiting)
+
+# Registered once; app points it at the worker's AdmissionController when admission control is on
+admission_collector = AdmissionCollector()
+REGISTRY.register(admission_collector)
+
+def render():
+    """
+    Render every metric in the Prometheus text format.
+    Returns:
+        tuple: (body bytes, content type)
+    """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -1,4 +1,5 @@
-from pydantic import BaseModel, Field
+from typing import List, Optional
+from pydantic import BaseModel, Field, field_validator
 
 # Request Models
 class CheckoutRequest(BaseModel):
@@ -6,6 +7,9 @@ class CheckoutRequest(BaseModel):
     hwSetName: str = Field(..., description="The hardware set name")
     qty: int = Field(..., gt=0, description="The quantity to check out (must be positive)")
     userId: str = Field(..., description="The user ID (accepted but not validated - API Gateway handles validation)")
+    leaseSeconds: Optional[int] = Field(None, gt=0, description="Return the holding automatically after this many seconds (defaults to LEASE_DEFAULT_SECONDS)")
+    waitlist: bool = Field(False, description="Queue the request until enough units are available instead of failing")
+    priority: int = Field(0, description="Waitlist priority; higher is served first, then first come first served")
 
 class CheckinRequest(BaseModel):
     projectId: str = Field(..., description="The project ID")
@@ -13,11 +17,58 @@ class CheckinRequest(BaseModel):
     qty: int = Field(..., gt=0, description="The quantity to check in (must be positive)")
     userId: str = Field(..., description="The user ID (accepted but not validated - API Gateway handles validation)")
 
+class BatchItem(BaseModel):
+    hwSetName: str = Field(..., description="The hardware set name")
+    qty: int = Field(..., gt=0, description="The quantity for this hardware set (must be positive)")
+
+def _distinct_hw_sets(items):
+    names = [item.hwSetName for item in items]
+    if len(names) != len(set(names)):
+        raise ValueError("Each hardware set may appear only once per batch")
+    return items
+
+class BatchCheckoutRequest(BaseModel):
+    projectId: str = Field(..., description="The project ID")
+    userId: str = Field(..., description="The user ID (accepted but not validated - API Gateway handles validation)")
+    items: List[BatchItem] = Field(..., min_length=1, description="Hardware sets and quantities to check out")
+    atomic: bool = Field(True, description="All-or-nothing when true, best-effort per item when false")
+    leaseSeconds: Optional[int] = Field(None, gt=0, description="Lease applied to every item's holding (defaults to LEASE_DEFAULT_SECONDS)")
+
+    _distinct = field_validator("items")(_distinct_hw_sets)
+
+class BatchCheckinRequest(BaseModel):
+    projectId: str = Field(..., description="The project ID")
+    userId: str = Field(..., description="The user ID (accepted but not validated - API Gateway handles validation)")
+    items: List[BatchItem] = Field(..., min_length=1, description="Hardware sets and quantities to check in")
+    atomic: bool = Field(True, description="All-or-nothing when true, best-effort per item when false")
+
+    _distinct = field_validator("items")(_distinct_hw_sets)
+
+class RenewLeaseRequest(BaseModel):
+    projectId: str = Field(..., description="The project ID")
+    hwSetName: str = Field(..., description="The hardware set name")
+    leaseSeconds: Optional[int] = Field(None, gt=0, description="New lease length from now (defaults to LEASE_DEFAULT_SECONDS)")
+
 class CreateHardwareRequest(BaseModel):
     hwSetName: str = Field(..., description="The hardware set name")
     capacity: int = Field(..., gt=0, description="The initial capacity (must be positive)")
+    shards: Optional[int] = Field(None, ge=1, description="Split availability across this many sub-counter documents (at most HW_SHARDS_MAX); for very busy sets")
+
+class ShardHardwareRequest(BaseModel):
+    hwSetName: str = Field(..., description="The hardware set name")
+    shards: int = Field(..., ge=2, description="Number of sub-counter documents (at most HW_SHARDS_MAX, capped at the set's capacity)")
 
 # Response Models
 class MessageResponse(BaseModel):
     message: str
 
+class BatchItemResult(BaseModel):
+    hwSetName: str
+    qty: int
+    success: bool
+    error: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    message: str
+    results: List[BatchItemResult]
+
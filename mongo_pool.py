@@ -0,0 +1,226 @@
+# Shared MongoDB client and connection pool monitoring
+import threading
+import time
+from pymongo import AsyncMongoClient, MongoClient, monitoring
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from config import config
+from metrics import count_routed_read
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener that keeps running counters per server address.
+    The sync driver calls these hooks from its own threads, so every update holds a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def _server(self, address):
+        key = f"{address[0]}:{address[1]}"
+        stats = self._servers.get(key)
+        if stats is None:
+            stats = {
+                "poolReady": False,
+                "openConnections": 0,
+                "checkedOut": 0,
+                "maxCheckedOut": 0,
+                "waitQueue": 0,
+                "maxWaitQueue": 0,
+                "connectionsCreated": 0,
+                "connectionsClosed": 0,
+                "checkOuts": 0,
+                "checkOutFailures": {},
+                "poolClears": 0,
+                "totalCheckOutWaitMs": 0.0
+            }
+            self._servers[key] = stats
+        return stats
+
+    def pool_created(self, event):
+        with self._lock:
+            self._server(event.address)
+
+    def pool_ready(self, event):
+        with self._lock:
+            self._server(event.address)["poolReady"] = True
+
+    def pool_cleared(self, event):
+        with self._lock:
+            stats = self._server(event.address)
+            stats["poolReady"] = False
+            stats["poolClears"] += 1
+
+    def pool_closed(self, event):
+        with self._lock:
+            self._server(event.address)["poolReady"] = False
+
+    def connection_created(self, event):
+        with self._lock:
+            stats = self._server(event.address)
+            stats["openConnections"] += 1
+            stats["connectionsCreated"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            stats = self._server(event.address)
+            stats["openConnections"] = max(0, stats["openConnections"] - 1)
+            stats["connectionsClosed"] += 1
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            stats = self._server(event.address)
+            stats["waitQueue"] += 1
+            stats["maxWaitQueue"] = max(stats["maxWaitQueue"], stats["waitQueue"])
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            stats = self._server(event.address)
+            stats["waitQueue"] = max(0, stats["waitQueue"] - 1)
+            reason = str(event.reason)
+            stats["checkOutFailures"][reason] = stats["checkOutFailures"].get(reason, 0) + 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            stats = self._server(event.address)
+            stats["waitQueue"] = max(0, stats["waitQueue"] - 1)
+            stats["checkedOut"] += 1
+            stats["checkOuts"] += 1
+            stats["maxCheckedOut"] = max(stats["maxCheckedOut"], stats["checkedOut"])
+            # Event duration (driver >= 4.7) is the time spent waiting for the connection
+            duration = getattr(event, "duration", None)
+            if duration is not None:
+                stats["totalCheckOutWaitMs"] += duration * 1000
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            stats = self._server(event.address)
+            stats["checkedOut"] = max(0, stats["checkedOut"] - 1)
+
+    def snapshot(self):
+        """
+        Return a copy of the current pool counters.
+        Returns:
+            dict: Pool settings plus per-server connection counters
+        """
+        with self._lock:
+            servers = {}
+            for address, stats in self._servers.items():
+                entry = dict(stats)
+                entry["checkOutFailures"] = dict(stats["checkOutFailures"])
+                checkouts = stats["checkOuts"]
+                entry["avgCheckOutWaitMs"] = round(stats["totalCheckOutWaitMs"] / checkouts, 3) if checkouts else 0.0
+                entry["totalCheckOutWaitMs"] = round(stats["totalCheckOutWaitMs"], 3)
+                servers[address] = entry
+        return {
+            "settings": {
+                "maxPoolSize": config.mongo_max_pool_size,
+                "minPoolSize": config.mongo_min_pool_size,
+                "maxIdleTimeMS": config.mongo_max_idle_time_ms,
+                "waitQueueTimeoutMS": config.mongo_wait_queue_timeout_ms,
+                "writeConcern": config.mongo_write_concern,
+                "readConcern": config.mongo_read_concern,
+                "readOnlyRouting": {
+                    "readPreference": config.mongo_read_only_read_preference,
+                    "maxStalenessSeconds": config.mongo_read_only_max_staleness_seconds,
+                    "readConcern": config.mongo_read_only_read_concern,
+                    "overrides": config.mongo_operation_read_preferences
+                }
+            },
+            "servers": servers,
+            "timestamp": time.time()
+        }
+
+def _client_options(pool_listener=None):
+    """Keyword arguments shared by the sync and async clients"""
+    if not config.validate_config():
+        raise ValueError("Invalid MongoDB configuration")
+
+    # MongoDB Atlas (mongodb+srv://) automatically enables TLS
+    # tlsAllowInvalidCertificates defaults to True for Docker environments to avoid SSL issues
+    options = {
+        "maxPoolSize": config.mongo_max_pool_size,
+        "minPoolSize": config.mongo_min_pool_size,
+        "maxIdleTimeMS": config.mongo_max_idle_time_ms,
+        "waitQueueTimeoutMS": config.mongo_wait_queue_timeout_ms,
+        "serverSelectionTimeoutMS": config.mongo_server_selection_timeout_ms,
+        "connectTimeoutMS": config.mongo_connect_timeout_ms,
+        "socketTimeoutMS": config.mongo_socket_timeout_ms,
+        "tlsAllowInvalidCertificates": config.mongo_allow_invalid_certs,
+        "directConnection": False,  # Important for mongodb+srv:// connections
+        # Defaults for everything not routed by routed_database: the write path
+        "w": int(config.mongo_write_concern) if config.mongo_write_concern.isdigit() else config.mongo_write_concern,
+        "readConcernLevel": config.mongo_read_concern
+    }
+    if config.mongo_write_concern_timeout_ms > 0:
+        options["wTimeoutMS"] = config.mongo_write_concern_timeout_ms
+    if pool_listener is not None:
+        options["event_listeners"] = [pool_listener]
+    return options
+
+def create_mongodb_client(pool_listener=None):
+    """
+    Build a pooled synchronous MongoClient (scripts and benchmarks).
+    Args:
+        pool_listener: Optional PoolStatsListener registered for pool events
+
+    Returns:
+        MongoClient: A client configured from config.Config pool settings
+    """
+    return MongoClient(config.get_mongodb_connection_string(), **_client_options(pool_listener))
+
+def create_async_mongodb_client(pool_listener=None):
+    """
+    Build the pooled AsyncMongoClient shared by every request in this worker.
+    Args:
+        pool_listener: Optional PoolStatsListener registered for pool events
+
+    Returns:
+        AsyncMongoClient: A client configured from config.Config pool settings
+    """
+    return AsyncMongoClient(config.get_mongodb_connection_string(), **_client_options(pool_listener))
+
+_READ_PREFERENCE_CLASSES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+def read_preference_of(operation):
+    """Name of the read preference configured for a read-only operation"""
+    return config.mongo_operation_read_preferences.get(operation, config.mongo_read_only_read_preference)
+
+def _routing_options(preference):
+    if preference == 'primary':
+        # maxStalenessSeconds is not allowed with primary
+        read_preference = Primary()
+    else:
+        read_preference = _READ_PREFERENCE_CLASSES[preference](max_staleness=config.mongo_read_only_max_staleness_seconds)
+    return {"read_preference": read_preference, "read_concern": ReadConcern(config.mongo_read_only_read_concern)}
+
+# read preference name -> get_database options, built once
+_routing = {preference: _routing_options(preference) for preference in _READ_PREFERENCE_CLASSES}
+
+def routed_database(client, operation):
+    """
+    The service database as seen by one read-only operation. It carries the
+    operation's configured read preference (with max staleness) and read
+    concern, and is counted in hardware_db_routed_reads. The write path uses
+    client[config.mongo_database], so it stays on the primary with the client's
+    write and read concerns.
+    Args:
+        client: An AsyncMongoClient instance
+        operation(str): The operation name (as in the timed metrics)
+
+    Returns:
+        AsyncDatabase: The database handle to read through
+    """
+    preference = read_preference_of(operation)
+    count_routed_read(operation, preference)
+    return client.get_database(config.mongo_database, **_routing[preference])
@@ -0,0 +1,97 @@
+# Per-worker readiness state behind /readyz, refreshed by a background probe
+import asyncio
+import time
+
+class ReadinessProbe:
+    """
+    Cached readiness of this worker. A background task pings storage every
+    `interval` seconds (each ping bounded by `timeout`), so /readyz answers from
+    memory and probe traffic reaches the database at most once per interval per
+    worker, however often the orchestrator asks.
+
+    The worker is ready once every check is "ok":
+    - config: every required environment variable is set
+    - warmUp: the background warm-up (connections, indexes, watcher) finished
+    - storage: the last ping succeeded
+    A failed check holds its error message instead.
+    """
+
+    def __init__(self, interval, timeout, missing_config=()):
+        self.interval = interval
+        self.timeout = timeout
+        self.storage = None
+        self.checks = {
+            "config": f"missing {', '.join(missing_config)}" if missing_config else "ok",
+            "warmUp": "pending",
+            "storage": "pending"
+        }
+        self.checked_at = None
+        self.ready_since = None
+        self.probes = 0
+        self.failures = 0
+        self._task = None
+
+    @property
+    def ready(self):
+        return all(check == "ok" for check in self.checks.values())
+
+    def start(self, storage):
+        """Start probing storage in the background"""
+        self.storage = storage
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def warmed(self, error=None):
+        """Record the outcome of a warm-up attempt"""
+        self.checks["warmUp"] = "ok" if error is None else str(error)
+        self._update()
+
+    async def probe(self):
+        """Ping storage once and record the result"""
+        self.probes += 1
+        try:
+            await asyncio.wait_for(self.storage.ping(), self.timeout)
+            self.checks["storage"] = "ok"
+        except asyncio.TimeoutError:
+            self.failures += 1
+            self.checks["storage"] = f"ping took longer than {self.timeout}s"
+        except Exception as e:
+            self.failures += 1
+            self.checks["storage"] = str(e) or type(e).__name__
+        self.checked_at = time.time()
+        self._update()
+
+    def _update(self):
+        if not self.ready:
+            self.ready_since = None
+        elif self.ready_since is None:
+            self.ready_since = time.time()
+
+    async def _run(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.interval)
+
+    def snapshot(self):
+        """
+        Return the cached readiness state.
+        Returns:
+            dict: ready, each check's result, when storage was last pinged, and probe counters
+        """
+        return {
+            "ready": self.ready,
+            "checks": dict(self.checks),
+            "checkedAt": self.checked_at,
+            "readySince": self.ready_since,
+            "probes": self.probes,
+            "failures": self.failures
+        }
@@ -0,0 +1,125 @@
+# In-process cache for the holdings and utilization reports
+import time
+from collections import OrderedDict
+from config import config
+
+UTILIZATION = ('utilization',)
+
+def holdings_key(projectId):
+    return ('holdings', projectId)
+
+class ReportCache:
+    """
+    LRU cache of aggregation results (per-project holdings, fleet utilization), with a TTL.
+    Checkout writes made through this process's data layer invalidate the affected
+    project and the utilization report right away; the TTL bounds staleness for
+    writes made by other processes (or, with the watcher running, until its event
+    arrives).
+
+    A report is computed from several documents, so a read that overlaps a write
+    could cache a result from before it. Every invalidation bumps `version`; a
+    report is only stored if no invalidation happened since its read started.
+    Only touched from the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, key):
+        """
+        Return a cached report, or None on a miss or an expired entry.
+        Args:
+            key(tuple): holdings_key(projectId) or UTILIZATION
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, report, version):
+        """
+        Store a report unless something was invalidated since `version` was read.
+        Args:
+            key(tuple): holdings_key(projectId) or UTILIZATION
+            report(dict): The report (treated as read-only by callers)
+            version(int): `version` as read before the report's query started
+        """
+        if not self.enabled or version != self.version:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, report)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _drop(self, key):
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def invalidateProject(self, projectId):
+        """Drop a project's holdings and the utilization report after a checkout write"""
+        self.version += 1
+        self._drop(holdings_key(projectId))
+        self._drop(UTILIZATION)
+
+    def invalidateUtilization(self):
+        """Drop the utilization report after a hardware set write"""
+        self.version += 1
+        self._drop(UTILIZATION)
+
+    def clear(self):
+        self.version += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def onChange(self, change):
+        """
+        Hardware watcher listener: invalidate for writes made by other processes.
+        Args:
+            change(dict): A change stream event
+        """
+        collection = change.get("ns", {}).get("coll")
+        if collection == config.mongo_collection_hardware:
+            self.invalidateUtilization()
+        elif collection == config.mongo_collection_checkouts:
+            document = change.get("fullDocument")
+            if document is not None:
+                self.invalidateProject(document["projectId"])
+            else:
+                # A deleted record carries only its _id, so the project is unknown
+                self.clear()
+
+    def stats(self):
+        """
+        Return cache counters.
+        Returns:
+            dict: Settings, size and hit/miss/invalidation counters
+        """
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "maxEntries": self.max_entries,
+            "ttlSeconds": self.ttl_seconds,
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+# Global cache instance shared by the async data layer
+report_cache = ReportCache(config.report_cache_max_entries, config.report_cache_ttl_seconds)
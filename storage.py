@@ -0,0 +1,950 @@
+# Pluggable storage backends behind the routes: MongoDB, or an in-process engine for CI and benchmarks
+import bisect
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from abc import ABC, abstractmethod
+from contextlib import ExitStack
+import checkout_ledger as ledger
+import hardware_database_async as hardwareDB
+from config import config
+from idempotency import request_fingerprint
+from write_combiner import WriteCombiner
+
+class HardwareStorage(ABC):
+    """
+    Storage interface used by the routes. Method names, arguments and return
+    values match hardware_database_async minus the client argument, so a
+    backend can be swapped without touching route code.
+
+    Check-out/check-in outcomes are the hardware_database_async constants
+    (CHECKOUT_OK, HW_NOT_FOUND, ...).
+    """
+
+    name = None
+
+    @abstractmethod
+    async def createHardwareSet(self, hwSetName, initCapacity, shards=None):
+        """Returns (success, message)"""
+
+    @abstractmethod
+    async def shardHardwareSet(self, hwSetName, shards):
+        """Split a set's availability across sub-counters. Returns (CHECKOUT_OK, HW_NOT_FOUND or ALREADY_SHARDED, shard count)"""
+
+    @abstractmethod
+    async def queryHardwareSet(self, hwSetName, readOnly=False):
+        """Returns (exists, hardware set dict or error message). readOnly lookups may be served by a secondary"""
+
+    @abstractmethod
+    async def queryHardwareSets(self, hwSetNames, readOnly=False):
+        """Returns {hwSetName: hardware set dict} for the names that exist"""
+
+    @abstractmethod
+    async def requestSpace(self, hwSetName, amount):
+        """Take amount units if available. Returns bool"""
+
+    @abstractmethod
+    async def updateAvailability(self, hwSetName, delta):
+        """Add delta to availability, staying within 0..capacity. Returns bool"""
+
+    @abstractmethod
+    async def getProjectCheckout(self, projectId, hwSetName):
+        """Returns the quantity the project holds (0 if none)"""
+
+    @abstractmethod
+    async def updateProjectCheckout(self, projectId, hwSetName, qty):
+        """Add qty (negative for check-in) to the project's record. Returns bool"""
+
+    @abstractmethod
+    async def getAllHwSetNames(self):
+        """Returns a list of every hardware set name"""
+
+    @abstractmethod
+    async def checkOutHardware(self, projectId, hwSetName, qty, idempotency_key=None, userId=None, leaseSeconds=None):
+        """Take units and record them against the project. Returns an outcome (replayed for a repeated key)"""
+
+    @abstractmethod
+    async def checkInHardware(self, projectId, hwSetName, qty, idempotency_key=None, userId=None):
+        """Return units from the project. Returns an outcome (replayed for a repeated key)"""
+
+    @abstractmethod
+    async def checkOutHardwareBatch(self, projectId, items, atomic=True, userId=None, leaseSeconds=None):
+        """items is a list of (hwSetName, qty). Returns one outcome per item"""
+
+    @abstractmethod
+    async def checkInHardwareBatch(self, projectId, items, atomic=True, userId=None):
+        """items is a list of (hwSetName, qty). Returns one outcome per item"""
+
+    @abstractmethod
+    async def renewLease(self, projectId, hwSetName, leaseSeconds):
+        """Returns (outcome, new expiry or None)"""
+
+    @abstractmethod
+    async def expireLeases(self, batch_size=500):
+        """Return the units of every overdue lease. Returns {expired, units, hwSetNames}"""
+
+    @abstractmethod
+    async def enqueueCheckout(self, projectId, hwSetName, qty, userId=None, priority=0, leaseSeconds=None,
+                              idempotency_key=None):
+        """Queue a check-out until it fits. Returns (outcome, public waitlist entry or None)"""
+
+    @abstractmethod
+    async def drainWaitlist(self, hwSetName):
+        """Grant the set's waiting check-outs in queue order while they fit. Returns the granted entries"""
+
+    @abstractmethod
+    async def getWaitlistedHwSets(self):
+        """Returns the names of hardware sets with waiting check-outs"""
+
+    @abstractmethod
+    async def expireWaits(self):
+        """Expire waiting entries past their giveUpAt. Returns how many"""
+
+    @abstractmethod
+    async def getWaitlistEntry(self, waitId):
+        """Returns the public waitlist entry, or None"""
+
+    @abstractmethod
+    async def getFinishedWaits(self, waitIds):
+        """Returns the public entries among waitIds that are granted, cancelled or expired"""
+
+    @abstractmethod
+    async def cancelWait(self, waitId):
+        """Returns CHECKOUT_OK, NO_WAIT_ENTRY or WAIT_FINISHED"""
+
+    @abstractmethod
+    async def getHwSetNamesPage(self, limit, after=None, prefix=None):
+        """Returns (names, next cursor or None)"""
+
+    @abstractmethod
+    def streamHwSetNames(self, prefix=None, batch_size=500):
+        """Async iterator over hardware set names in name order"""
+
+    @abstractmethod
+    async def importRecords(self, records, batch_size=1000):
+        """Bulk insert (line, dict) records. Returns the import summary dict"""
+
+    @abstractmethod
+    def exportState(self, include=('hardware', 'checkout'), batch_size=1000):
+        """Async iterator over typed hardware/checkout records"""
+
+    @abstractmethod
+    async def getProjectHoldings(self, projectId):
+        """Returns the project's holdings report (see hardware_database_async.holdingsReport)"""
+
+    @abstractmethod
+    def streamProjectHoldings(self, projectId, batch_size=500):
+        """Async iterator over the project's {hwSetName, quantity, capacity} in name order"""
+
+    @abstractmethod
+    async def getUtilization(self):
+        """Returns the utilization report (see hardware_database_async.utilizationReport)"""
+
+    @abstractmethod
+    def streamUtilization(self, batch_size=500):
+        """Async iterator over utilizationRecord dicts in name order"""
+
+    @abstractmethod
+    async def getLedger(self, projectId=None, hwSetName=None, since=None, until=None, limit=100, after=None):
+        """Returns (ledger entries in log order, next cursor or None)"""
+
+    @abstractmethod
+    async def getBalancesAt(self, at=None, projectId=None, hwSetName=None):
+        """Returns holdings rebuilt from the newest snapshot before `at` plus the ledger tail"""
+
+    @abstractmethod
+    async def takeLedgerSnapshot(self, min_age_seconds=0):
+        """Compact the ledger into a new snapshot unless the latest is younger than min_age_seconds. Returns its header"""
+
+    @abstractmethod
+    async def auditLedger(self):
+        """Compare holdings rebuilt from the ledger with the checkout records. Returns a report"""
+
+    async def ping(self):
+        """Check the backend can serve requests; raises if it can't"""
+
+    async def close(self):
+        """Release backend resources"""
+
+class MongoHardwareStorage(HardwareStorage):
+    """
+    The MongoDB data layer (hardware_database_async) bound to one pooled client.
+    With a combiner, check-outs and check-ins without an Idempotency-Key go
+    through it (see write_combiner).
+    """
+
+    name = "mongo"
+
+    def __init__(self, client, use_transactions=False, combiner=None):
+        self.client = client
+        self.use_transactions = use_transactions
+        self.combiner = combiner
+
+    async def createHardwareSet(self, hwSetName, initCapacity, shards=None):
+        return await hardwareDB.createHardwareSet(self.client, hwSetName, initCapacity, shards)
+
+    async def shardHardwareSet(self, hwSetName, shards):
+        return await hardwareDB.shardHardwareSet(self.client, hwSetName, shards)
+
+    async def queryHardwareSet(self, hwSetName, readOnly=False):
+        return await hardwareDB.queryHardwareSet(self.client, hwSetName, readOnly=readOnly)
+
+    async def queryHardwareSets(self, hwSetNames, readOnly=False):
+        return await hardwareDB.queryHardwareSets(self.client, hwSetNames, readOnly=readOnly)
+
+    async def requestSpace(self, hwSetName, amount):
+        return await hardwareDB.requestSpace(self.client, hwSetName, amount)
+
+    async def updateAvailability(self, hwSetName, delta):
+        return await hardwareDB.updateAvailability(self.client, hwSetName, delta)
+
+    async def getProjectCheckout(self, projectId, hwSetName):
+        return await hardwareDB.getProjectCheckout(self.client, projectId, hwSetName)
+
+    async def updateProjectCheckout(self, projectId, hwSetName, qty):
+        return await hardwareDB.updateProjectCheckout(self.client, projectId, hwSetName, qty)
+
+    async def getAllHwSetNames(self):
+        return await hardwareDB.getAllHwSetNames(self.client)
+
+    async def checkOutHardware(self, projectId, hwSetName, qty, idempotency_key=None, userId=None, leaseSeconds=None):
+        if self.combiner is not None and idempotency_key is None:
+            return await self.combiner.submit(
+                hwSetName, projectId, qty, userId=userId, leaseSeconds=leaseSeconds, use_transaction=self.use_transactions
+            )
+        return await hardwareDB.checkOutHardware(
+            self.client, projectId, hwSetName, qty,
+            use_transaction=self.use_transactions, idempotency_key=idempotency_key, userId=userId,
+            leaseSeconds=leaseSeconds
+        )
+
+    async def checkInHardware(self, projectId, hwSetName, qty, idempotency_key=None, userId=None):
+        if self.combiner is not None and idempotency_key is None:
+            return await self.combiner.submit(hwSetName, projectId, -qty, userId=userId, use_transaction=self.use_transactions)
+        return await hardwareDB.checkInHardware(
+            self.client, projectId, hwSetName, qty,
+            use_transaction=self.use_transactions, idempotency_key=idempotency_key, userId=userId
+        )
+
+    async def checkOutHardwareBatch(self, projectId, items, atomic=True, userId=None, leaseSeconds=None):
+        return await hardwareDB.checkOutHardwareBatch(
+            self.client, projectId, items, atomic=atomic, use_transaction=self.use_transactions, userId=userId,
+            leaseSeconds=leaseSeconds
+        )
+
+    async def checkInHardwareBatch(self, projectId, items, atomic=True, userId=None):
+        return await hardwareDB.checkInHardwareBatch(
+            self.client, projectId, items, atomic=atomic, use_transaction=self.use_transactions, userId=userId
+        )
+
+    async def renewLease(self, projectId, hwSetName, leaseSeconds):
+        return await hardwareDB.renewLease(self.client, projectId, hwSetName, leaseSeconds)
+
+    async def expireLeases(self, batch_size=500):
+        return await hardwareDB.expireLeases(self.client, use_transaction=self.use_transactions, batch_size=batch_size)
+
+    async def enqueueCheckout(self, projectId, hwSetName, qty, userId=None, priority=0, leaseSeconds=None,
+                              idempotency_key=None):
+        return await hardwareDB.enqueueCheckout(
+            self.client, projectId, hwSetName, qty, userId=userId, priority=priority,
+            leaseSeconds=leaseSeconds, idempotency_key=idempotency_key
+        )
+
+    async def drainWaitlist(self, hwSetName):
+        return await hardwareDB.drainWaitlist(self.client, hwSetName, use_transaction=self.use_transactions)
+
+    async def getWaitlistedHwSets(self):
+        return await hardwareDB.getWaitlistedHwSets(self.client)
+
+    async def expireWaits(self):
+        return await hardwareDB.expireWaits(self.client)
+
+    async def getWaitlistEntry(self, waitId):
+        return await hardwareDB.getWaitlistEntry(self.client, waitId)
+
+    async def getFinishedWaits(self, waitIds):
+        return await hardwareDB.getFinishedWaits(self.client, waitIds)
+
+    async def cancelWait(self, waitId):
+        return await hardwareDB.cancelWait(self.client, waitId)
+
+    async def getHwSetNamesPage(self, limit, after=None, prefix=None):
+        return await hardwareDB.getHwSetNamesPage(self.client, limit, after=after, prefix=prefix)
+
+    def streamHwSetNames(self, prefix=None, batch_size=500):
+        return hardwareDB.streamHwSetNames(self.client, prefix=prefix, batch_size=batch_size)
+
+    async def importRecords(self, records, batch_size=1000):
+        return await hardwareDB.importRecords(self.client, records, batch_size=batch_size)
+
+    def exportState(self, include=('hardware', 'checkout'), batch_size=1000):
+        return hardwareDB.exportState(self.client, include=include, batch_size=batch_size)
+
+    async def getProjectHoldings(self, projectId):
+        return await hardwareDB.getProjectHoldings(self.client, projectId)
+
+    def streamProjectHoldings(self, projectId, batch_size=500):
+        return hardwareDB.streamProjectHoldings(self.client, projectId, batch_size=batch_size)
+
+    async def getUtilization(self):
+        return await hardwareDB.getUtilization(self.client)
+
+    def streamUtilization(self, batch_size=500):
+        return hardwareDB.streamUtilization(self.client, batch_size=batch_size)
+
+    async def getLedger(self, projectId=None, hwSetName=None, since=None, until=None, limit=100, after=None):
+        return await ledger.getLedger(self.client, projectId, hwSetName, since, until, limit, after)
+
+    async def getBalancesAt(self, at=None, projectId=None, hwSetName=None):
+        return await ledger.getBalancesAt(self.client, at, projectId, hwSetName)
+
+    async def takeLedgerSnapshot(self, min_age_seconds=0):
+        return await ledger.takeLedgerSnapshot(
+            self.client, lag_seconds=config.ledger_snapshot_lag_seconds,
+            keep=config.ledger_snapshots_kept, min_age_seconds=min_age_seconds
+        )
+
+    async def auditLedger(self):
+        return await ledger.auditLedger(self.client)
+
+    async def ping(self):
+        await self.client.admin.command('ping')
+
+    async def close(self):
+        await self.client.close()
+
+class InMemoryHardwareStorage(HardwareStorage):
+    """
+    Process-local engine with the same semantics as the MongoDB layer. Nothing
+    is persisted and nothing is shared between workers.
+
+    Thread-safe: every hardware set has its own lock, held while its
+    availability and the checkout records for it change, so a check-out or
+    check-in is atomic and operations on different sets never contend. Batches
+    take their sets' locks in name order to avoid deadlocks. Readers take a
+    set's lock too, and the utilization report and export copy everything with
+    every set's lock held (in the same order), so a report never pairs one
+    moment's availability with another's checkout totals. The registry lock
+    only guards creating sets, and the idempotency lock only the key table.
+    No lock is held across an await.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._registry_lock = threading.Lock()
+        self._hardware = {}       # hwSetName -> {'hwSetName', 'capacity', 'availability', 'version'}
+        self._locks = {}          # hwSetName -> threading.Lock
+        self._sorted_names = []   # Kept sorted for paging and streaming
+        self._checkouts = {}      # (projectId, hwSetName) -> quantity
+        self._leases = {}         # (projectId, hwSetName) -> expiresAt, for leased holdings only
+        self._lease_lock = threading.Lock()
+        self._lease_heap = []     # (expiresAt, projectId, hwSetName); superseded entries are skipped when popped
+        self._idempotency_lock = threading.Lock()
+        self._idempotency = OrderedDict()  # Idempotency-Key -> (expires at, fingerprint, outcome)
+        self._ledger_lock = threading.Lock()
+        self._ledger = []         # Ledger entries; _id is the position in the list
+        self._snapshots = []      # Oldest first: (header, balances dict)
+        self._waitlist_lock = threading.Lock()  # Taken after a set's lock, never before
+        self._waits = {}          # waitId -> waitlist entry (as stored by the MongoDB layer, _id an int)
+        self._queues = {}         # hwSetName -> heap of (-priority, _id); finished entries are skipped when popped
+        self._wait_keys = {}      # Idempotency-Key -> waitId
+        self._next_wait_id = 0
+
+    def _lockFor(self, hwSetName):
+        return self._locks.get(hwSetName)
+
+    def _append(self, entry):
+        with self._ledger_lock:
+            entry['_id'] = len(self._ledger)
+            self._ledger.append(entry)
+
+    def _snapshot(self):
+        """
+        Copy every set, the checkout records and the leases with all set locks held.
+        Returns:
+            tuple: Set copies in name order, checkouts dict, leases dict
+        """
+        with self._registry_lock:
+            names = list(self._sorted_names)
+        with ExitStack() as stack:
+            for name in names:
+                stack.enter_context(self._locks[name])
+            return [dict(self._hardware[name]) for name in names], dict(self._checkouts), dict(self._leases)
+
+    def _lease(self, key, expiresAt):
+        """Caller holds the set's lock"""
+        self._leases[key] = expiresAt
+        with self._lease_lock:
+            heapq.heappush(self._lease_heap, (expiresAt, *key))
+
+    def _addAvailability(self, hwSetName, delta):
+        """Caller holds the set's lock. Bumps the version and tells listeners, like the MongoDB layer's guarded $inc"""
+        hw_set = self._hardware[hwSetName]
+        hw_set['availability'] += delta
+        hw_set['version'] = hw_set.get('version', 0) + 1
+        hardwareDB.announceAvailability(hwSetName, dict(hw_set))
+
+    def _take(self, projectId, hwSetName, qty, userId=None, expiresAt=None):
+        """Caller holds the set's lock, so the ledger entry lands with the change"""
+        self._addAvailability(hwSetName, -qty)
+        key = (projectId, hwSetName)
+        self._checkouts[key] = self._checkouts.get(key, 0) + qty
+        current = self._leases.get(key)
+        if expiresAt is not None and (current is None or expiresAt > current):
+            self._lease(key, expiresAt)
+        self._append(ledger.ledgerEntry(projectId, hwSetName, qty, userId, 'check_out'))
+
+    def _give_back(self, projectId, hwSetName, qty, userId=None):
+        self._addAvailability(hwSetName, qty)
+        key = (projectId, hwSetName)
+        remaining = self._checkouts[key] - qty
+        if remaining:
+            self._checkouts[key] = remaining
+        else:
+            del self._checkouts[key]
+            self._leases.pop(key, None)
+        self._append(ledger.ledgerEntry(projectId, hwSetName, -qty, userId, 'check_in'))
+
+    def _insert(self, hw_set):
+        """Add a hardware set unless the name exists. Returns False on a duplicate"""
+        with self._registry_lock:
+            if hw_set['hwSetName'] in self._hardware:
+                return False
+            self._hardware[hw_set['hwSetName']] = hw_set
+            self._locks[hw_set['hwSetName']] = threading.Lock()
+            bisect.insort(self._sorted_names, hw_set['hwSetName'])
+            return True
+
+    def _insertCheckout(self, projectId, hwSetName, quantity, expiresAt=None):
+        """Restore an exported checkout record (and its lease) unless one exists. Returns False on a duplicate"""
+        with self._lockFor(hwSetName) or self._registry_lock:
+            key = (projectId, hwSetName)
+            if key in self._checkouts:
+                return False
+            self._checkouts[key] = quantity
+            if expiresAt is not None:
+                self._lease(key, expiresAt)
+            self._append(ledger.ledgerEntry(projectId, hwSetName, quantity, None, 'import'))
+            return True
+
+    async def createHardwareSet(self, hwSetName, initCapacity, shards=None):
+        # shards is accepted for interface parity: an in-process counter has no document write conflicts to spread
+        if not self._insert({'hwSetName': hwSetName, 'capacity': initCapacity, 'availability': initCapacity, 'version': 0}):
+            return False, f"{hwSetName} set already exists"
+        return True, "Hardware set created successfully!"
+
+    async def shardHardwareSet(self, hwSetName, shards):
+        """Nothing to split in memory; reports 0 shards for an existing set"""
+        if self._lockFor(hwSetName) is None:
+            return hardwareDB.HW_NOT_FOUND, 0
+        return hardwareDB.CHECKOUT_OK, 0
+
+    async def queryHardwareSet(self, hwSetName, readOnly=False):
+        lock = self._lockFor(hwSetName)
+        if lock is None:
+            return False, "Hardware set does not exist"
+        with lock:
+            # A copy, so callers never see a later write
+            return True, dict(self._hardware[hwSetName])
+
+    async def queryHardwareSets(self, hwSetNames, readOnly=False):
+        found = {}
+        for hwSetName in hwSetNames:
+            exists, hw_set = await self.queryHardwareSet(hwSetName)
+            if exists:
+                found[hwSetName] = hw_set
+        return found
+
+    async def requestSpace(self, hwSetName, amount):
+        lock = self._lockFor(hwSetName)
+        if lock is None:
+            return False
+        with lock:
+            hw_set = self._hardware[hwSetName]
+            if hw_set['availability'] < amount:
+                return False
+            self._addAvailability(hwSetName, -amount)
+            return True
+
+    async def updateAvailability(self, hwSetName, delta):
+        lock = self._lockFor(hwSetName)
+        if lock is None:
+            return False
+        with lock:
+            hw_set = self._hardware[hwSetName]
+            if not 0 <= hw_set['availability'] + delta <= hw_set['capacity']:
+                return False
+            self._addAvailability(hwSetName, delta)
+            return True
+
+    async def getProjectCheckout(self, projectId, hwSetName):
+        with self._lockFor(hwSetName) or self._registry_lock:
+            return self._checkouts.get((projectId, hwSetName), 0)
+
+    async def updateProjectCheckout(self, projectId, hwSetName, qty):
+        # A primitive like the MongoDB layer's: it writes no ledger entry, that is up to the caller
+        lock = self._lockFor(hwSetName)
+        if lock is None:
+            return False
+        with lock:
+            key = (projectId, hwSetName)
+            quantity = self._checkouts.get(key, 0) + qty
+            if quantity < 0:
+                return False  # Cannot check in more than checked out
+            if quantity:
+                self._checkouts[key] = quantity
+            else:
+                # Nothing left to expire, as in _give_back
+                self._checkouts.pop(key, None)
+                self._leases.pop(key, None)
+            return True
+
+    async def getAllHwSetNames(self):
+        with self._registry_lock:
+            return list(self._sorted_names)
+
+    def _claimKey(self, key, fingerprint):
+        """Claim an Idempotency-Key. Returns None if this call owns it, else the outcome to replay"""
+        now = time.monotonic()
+        with self._idempotency_lock:
+            # Every key has the same TTL, so the expired ones are at the front
+            while self._idempotency and next(iter(self._idempotency.values()))[0] <= now:
+                self._idempotency.popitem(last=False)
+            entry = self._idempotency.get(key)
+            if entry is not None:
+                return hardwareDB.idempotentReplay(entry[1], entry[2], fingerprint)
+            self._idempotency[key] = (now + config.idempotency_ttl_seconds, fingerprint, None)
+            return None
+
+    def _completeKey(self, key, fingerprint, outcome):
+        with self._idempotency_lock:
+            if key in self._idempotency:
+                self._idempotency[key] = (self._idempotency[key][0], fingerprint, outcome)
+
+    def _dropKey(self, key):
+        """Release a claim that never completed"""
+        with self._idempotency_lock:
+            entry = self._idempotency.get(key)
+            if entry is not None and entry[2] is None:
+                del self._idempotency[key]
+
+    def _keyed(self, operation, projectId, hwSetName, qty, idempotency_key, run, leaseSeconds=None):
+        if idempotency_key is None:
+            return run()
+        fingerprint = request_fingerprint(operation, projectId, hwSetName, qty, *([leaseSeconds] if leaseSeconds else []))
+        replay = self._claimKey(idempotency_key, fingerprint)
+        if replay is not None:
+            return replay
+        try:
+            outcome = run()
+        except BaseException:
+            # Nothing to replay; let a retry run the request again
+            self._dropKey(idempotency_key)
+            raise
+        self._completeKey(idempotency_key, fingerprint, outcome)
+        return outcome
+
+    def _checkOut(self, projectId, hwSetName, qty, userId, expiresAt=None):
+        lock = self._lockFor(hwSetName)
+        if lock is None:
+            return hardwareDB.HW_NOT_FOUND
+        with lock:
+            outcome = hardwareDB.validateCheckOut(self._hardware[hwSetName], qty)
+            if outcome == hardwareDB.CHECKOUT_OK:
+                self._take(projectId, hwSetName, qty, userId, expiresAt)
+            return outcome
+
+    def _checkIn(self, projectId, hwSetName, qty, userId):
+        lock = self._lockFor(hwSetName)
+        if lock is None:
+            return hardwareDB.HW_NOT_FOUND
+        with lock:
+            held = self._checkouts.get((projectId, hwSetName), 0)
+            outcome = hardwareDB.validateCheckIn(self._hardware[hwSetName], held, qty)
+            if outcome == hardwareDB.CHECKOUT_OK:
+                self._give_back(projectId, hwSetName, qty, userId)
+            return outcome
+
+    async def checkOutHardware(self, projectId, hwSetName, qty, idempotency_key=None, userId=None, leaseSeconds=None):
+        expiresAt = hardwareDB.leaseExpiry(leaseSeconds)
+        return self._keyed('check_out', projectId, hwSetName, qty, idempotency_key,
+                           lambda: self._checkOut(projectId, hwSetName, qty, userId, expiresAt), leaseSeconds)
+
+    async def checkInHardware(self, projectId, hwSetName, qty, idempotency_key=None, userId=None):
+        return self._keyed('check_in', projectId, hwSetName, qty, idempotency_key,
+                           lambda: self._checkIn(projectId, hwSetName, qty, userId))
+
+    def _runBatch(self, items, atomic, validate, apply):
+        """Validate and apply a batch with every touched set locked (so atomic batches never conflict)"""
+        with ExitStack() as stack:
+            hw_sets = {}
+            for name in sorted({name for name, _ in items}):
+                lock = self._lockFor(name)
+                if lock is not None:
+                    stack.enter_context(lock)
+                    hw_sets[name] = self._hardware[name]
+            # A set created after its lock was looked up stays "not found" for this batch
+            outcomes = [validate(hw_sets.get(name), name, qty) for name, qty in items]
+            if atomic and any(outcome != hardwareDB.CHECKOUT_OK for outcome in outcomes):
+                return hardwareDB.notApplied(outcomes)
+            for (name, qty), outcome in zip(items, outcomes):
+                if outcome == hardwareDB.CHECKOUT_OK:
+                    apply(name, qty)
+            return outcomes
+
+    async def checkOutHardwareBatch(self, projectId, items, atomic=True, userId=None, leaseSeconds=None):
+        expiresAt = hardwareDB.leaseExpiry(leaseSeconds)
+        return self._runBatch(
+            items, atomic,
+            lambda hw_set, name, qty: hardwareDB.validateCheckOut(hw_set, qty),
+            lambda name, qty: self._take(projectId, name, qty, userId, expiresAt)
+        )
+
+    async def checkInHardwareBatch(self, projectId, items, atomic=True, userId=None):
+        return self._runBatch(
+            items, atomic,
+            lambda hw_set, name, qty: hardwareDB.validateCheckIn(hw_set, self._checkouts.get((projectId, name), 0), qty),
+            lambda name, qty: self._give_back(projectId, name, qty, userId)
+        )
+
+    async def renewLease(self, projectId, hwSetName, leaseSeconds):
+        lock = self._lockFor(hwSetName)
+        key = (projectId, hwSetName)
+        if lock is None:
+            return hardwareDB.NO_HOLDING, None
+        with lock:
+            if key not in self._checkouts:
+                return hardwareDB.NO_HOLDING, None
+            now = datetime.now(timezone.utc)
+            if key not in self._leases:
+                return hardwareDB.NOT_LEASED, None
+            if self._leases[key] <= now:
+                return hardwareDB.LEASE_EXPIRED, None
+            expiresAt = now + timedelta(seconds=leaseSeconds)
+            self._lease(key, expiresAt)
+            return hardwareDB.CHECKOUT_OK, expiresAt
+
+    async def expireLeases(self, batch_size=500):
+        # The heap plays the expiresAt index: only overdue (or superseded) entries are popped
+        now = datetime.now(timezone.utc)
+        summary = {'expired': 0, 'units': 0, 'hwSetNames': set()}
+        while True:
+            with self._lease_lock:
+                due = []
+                while len(due) < batch_size and self._lease_heap and self._lease_heap[0][0] <= now:
+                    due.append(heapq.heappop(self._lease_heap))
+            for expiresAt, projectId, hwSetName in due:
+                key = (projectId, hwSetName)
+                with self._lockFor(hwSetName):
+                    # Renewed, extended or checked in since this entry was pushed
+                    if self._leases.get(key) != expiresAt:
+                        continue
+                    del self._leases[key]
+                    qty = self._checkouts.pop(key)
+                    self._addAvailability(hwSetName, qty)
+                    self._append(ledger.ledgerEntry(projectId, hwSetName, -qty, None, 'expire'))
+                summary['expired'] += 1
+                summary['units'] += qty
+                summary['hwSetNames'].add(hwSetName)
+            if len(due) < batch_size:
+                summary['hwSetNames'] = sorted(summary['hwSetNames'])
+                return summary
+
+    def _waitPosition(self, entry):
+        """Caller holds the waitlist lock"""
+        if entry['status'] != hardwareDB.WAIT_WAITING:
+            return None
+        rank = (-entry['priority'], entry['_id'])
+        return sum(
+            1 for other in self._queues.get(entry['hwSetName'], ())
+            if other < rank and self._isWaiting(str(other[1]))
+        )
+
+    def _isWaiting(self, waitId):
+        """Caller holds the waitlist lock. Entries past retention are gone from _waits"""
+        entry = self._waits.get(waitId)
+        return entry is not None and entry['status'] == hardwareDB.WAIT_WAITING
+
+    async def enqueueCheckout(self, projectId, hwSetName, qty, userId=None, priority=0, leaseSeconds=None,
+                              idempotency_key=None):
+        hw_exists, hw_set = await self.queryHardwareSet(hwSetName)
+        if not hw_exists:
+            return hardwareDB.HW_NOT_FOUND, None
+        if qty > hw_set['capacity']:
+            return hardwareDB.EXCEEDS_CAPACITY, None
+        fingerprint = request_fingerprint('waitlist', projectId, hwSetName, qty, priority, leaseSeconds)
+        now = datetime.now(timezone.utc)
+        with self._waitlist_lock:
+            if idempotency_key is not None and idempotency_key in self._wait_keys:
+                entry = self._waits[self._wait_keys[idempotency_key]]
+                if entry['fingerprint'] != fingerprint:
+                    return hardwareDB.IDEMPOTENCY_KEY_REUSED, None
+                return hardwareDB.CHECKOUT_OK, hardwareDB.publicWaitEntry(entry, self._waitPosition(entry))
+            entry = {
+                '_id': self._next_wait_id, 'hwSetName': hwSetName, 'projectId': projectId, 'userId': userId,
+                'qty': qty, 'priority': priority, 'leaseSeconds': leaseSeconds, 'status': hardwareDB.WAIT_WAITING,
+                'createdAt': now, 'giveUpAt': now + timedelta(seconds=config.waitlist_max_wait_seconds),
+                'idempotencyKey': idempotency_key, 'fingerprint': fingerprint
+            }
+            self._next_wait_id += 1
+            self._waits[str(entry['_id'])] = entry
+            if idempotency_key is not None:
+                self._wait_keys[idempotency_key] = str(entry['_id'])
+            heapq.heappush(self._queues.setdefault(hwSetName, []), (-priority, entry['_id']))
+            return hardwareDB.CHECKOUT_OK, hardwareDB.publicWaitEntry(entry, self._waitPosition(entry))
+
+    async def drainWaitlist(self, hwSetName):
+        lock = self._lockFor(hwSetName)
+        if lock is None:
+            return []
+        now = datetime.now(timezone.utc)
+        granted = []
+        # The set's lock makes each grant atomic with the availability it was checked against
+        with lock, self._waitlist_lock:
+            queue = self._queues.get(hwSetName, [])
+            while queue:
+                entry = self._waits.get(str(queue[0][1]))
+                if entry is not None and entry['status'] == hardwareDB.WAIT_WAITING and entry['giveUpAt'] <= now:
+                    entry.update(status=hardwareDB.WAIT_EXPIRED, finishedAt=now)
+                if not self._isWaiting(str(queue[0][1])):
+                    heapq.heappop(queue)
+                    continue
+                if self._hardware[hwSetName]['availability'] < entry['qty']:
+                    break
+                heapq.heappop(queue)
+                self._take(entry['projectId'], hwSetName, entry['qty'], entry['userId'],
+                           hardwareDB.leaseExpiry(entry['leaseSeconds']))
+                entry.update(status=hardwareDB.WAIT_GRANTED, grantedAt=now, finishedAt=now)
+                granted.append(hardwareDB.publicWaitEntry(entry))
+        return granted
+
+    async def getWaitlistedHwSets(self):
+        with self._waitlist_lock:
+            return sorted({
+                entry['hwSetName'] for entry in self._waits.values() if entry['status'] == hardwareDB.WAIT_WAITING
+            })
+
+    async def expireWaits(self):
+        now = datetime.now(timezone.utc)
+        retained_after = now - timedelta(seconds=config.waitlist_retention_seconds)
+        expired = 0
+        with self._waitlist_lock:
+            for waitId, entry in list(self._waits.items()):
+                if entry['status'] == hardwareDB.WAIT_WAITING and entry['giveUpAt'] <= now:
+                    entry.update(status=hardwareDB.WAIT_EXPIRED, finishedAt=now)
+                    expired += 1
+                elif entry['status'] != hardwareDB.WAIT_WAITING and entry['createdAt'] <= retained_after:
+                    # Plays the TTL index; finished entries are no longer in any queue heap
+                    del self._waits[waitId]
+                    self._wait_keys.pop(entry['idempotencyKey'], None)
+        return expired
+
+    async def getWaitlistEntry(self, waitId):
+        with self._waitlist_lock:
+            entry = self._waits.get(waitId)
+            return hardwareDB.publicWaitEntry(entry, self._waitPosition(entry)) if entry is not None else None
+
+    async def getFinishedWaits(self, waitIds):
+        with self._waitlist_lock:
+            return [
+                hardwareDB.publicWaitEntry(self._waits[waitId]) for waitId in waitIds
+                if waitId in self._waits and self._waits[waitId]['status'] != hardwareDB.WAIT_WAITING
+            ]
+
+    async def cancelWait(self, waitId):
+        with self._waitlist_lock:
+            entry = self._waits.get(waitId)
+            if entry is None:
+                return hardwareDB.NO_WAIT_ENTRY
+            if entry['status'] != hardwareDB.WAIT_WAITING:
+                return hardwareDB.WAIT_FINISHED
+            entry.update(status=hardwareDB.WAIT_CANCELLED, finishedAt=datetime.now(timezone.utc))
+            return hardwareDB.CHECKOUT_OK
+
+    def _namesFrom(self, after=None, prefix=None):
+        """Names after the cursor matching the prefix; callers hold the registry lock"""
+        names = self._sorted_names
+        start = bisect.bisect_right(names, after) if after is not None else 0
+        if prefix:
+            start = max(start, bisect.bisect_left(names, prefix))
+        for index in range(start, len(names)):
+            name = names[index]
+            if prefix and not name.startswith(prefix):
+                return
+            yield name
+
+    async def getHwSetNamesPage(self, limit, after=None, prefix=None):
+        names = []
+        with self._registry_lock:
+            for name in self._namesFrom(after, prefix):
+                names.append(name)
+                if len(names) > limit:
+                    return names[:limit], names[limit - 1]
+        return names, None
+
+    async def streamHwSetNames(self, prefix=None, batch_size=500):
+        # Snapshot the matching names so concurrent creates can't shift the iteration
+        with self._registry_lock:
+            names = list(self._namesFrom(prefix=prefix))
+        for name in names:
+            yield name
+
+    async def importRecords(self, records, batch_size=1000):
+        summary = hardwareDB.newImportSummary()
+        async for line, record in records:
+            try:
+                record_type, document = hardwareDB.parseImportRecord(record)
+            except ValueError as e:
+                hardwareDB.reportImportError(summary, line, str(e))
+                continue
+            if record_type == 'hardware':
+                inserted = self._insert(document)
+            else:
+                inserted = self._insertCheckout(
+                    document['projectId'], document['hwSetName'], document['quantity'], document.get('expiresAt')
+                )
+            if inserted:
+                summary['inserted'] += 1
+            else:
+                hardwareDB.reportImportDuplicate(summary, line, document)
+        return summary
+
+    async def exportState(self, include=('hardware', 'checkout'), batch_size=1000):
+        hw_sets, checkouts, leases = self._snapshot()
+        if 'hardware' in include:
+            for hw_set in hw_sets:
+                yield {'type': 'hardware', 'hwSetName': hw_set['hwSetName'], 'capacity': hw_set['capacity'], 'availability': hw_set['availability']}
+        if 'checkout' in include:
+            for (projectId, hwSetName), quantity in sorted(checkouts.items()):
+                record = {'type': 'checkout', 'projectId': projectId, 'hwSetName': hwSetName, 'quantity': quantity}
+                expiresAt = leases.get((projectId, hwSetName))
+                if expiresAt is not None:
+                    record['expiresAt'] = expiresAt.isoformat()
+                yield record
+
+    async def streamProjectHoldings(self, projectId, batch_size=500):
+        held = sorted(hwSetName for (holder, hwSetName) in dict(self._checkouts) if holder == projectId)
+        for hwSetName in held:
+            key = (projectId, hwSetName)
+            # Quantity, capacity and lease read together under the set's lock
+            with self._lockFor(hwSetName) or self._registry_lock:
+                quantity = self._checkouts.get(key, 0)
+                hw_set = self._hardware.get(hwSetName)
+                record = hardwareDB.holdingRecord(
+                    hwSetName, quantity, hw_set['capacity'] if hw_set else None, self._leases.get(key)
+                )
+            if quantity > 0:
+                yield record
+
+    async def getProjectHoldings(self, projectId):
+        return hardwareDB.holdingsReport(projectId, [holding async for holding in self.streamProjectHoldings(projectId)])
+
+    async def streamUtilization(self, batch_size=500):
+        hw_sets, checkouts, _ = self._snapshot()
+        usage = {}
+        for (_, hwSetName), quantity in checkouts.items():
+            if quantity > 0:
+                checkedOut, projects = usage.get(hwSetName, (0, 0))
+                usage[hwSetName] = (checkedOut + quantity, projects + 1)
+        for hw_set in hw_sets:
+            name = hw_set['hwSetName']
+            yield hardwareDB.utilizationRecord(name, hw_set['capacity'], hw_set['availability'], *usage.get(name, (0, 0)))
+
+    async def getUtilization(self):
+        return hardwareDB.utilizationReport([record async for record in self.streamUtilization()])
+
+    @staticmethod
+    def _matches(entry, projectId, hwSetName):
+        return (projectId is None or entry['projectId'] == projectId) and \
+            (hwSetName is None or entry['hwSetName'] == hwSetName)
+
+    @staticmethod
+    def _publicHeader(header):
+        if header is None:
+            return None
+        return {**header, 'upTo': header['upTo'].isoformat(), 'takenAt': header['takenAt'].isoformat()}
+
+    async def getLedger(self, projectId=None, hwSetName=None, since=None, until=None, limit=100, after=None):
+        since, until = ledger.utc(since), ledger.utc(until)
+        if after is not None and not after.isdigit():
+            raise ValueError("invalid cursor")
+        start = int(after) + 1 if after is not None else 0
+        entries = []
+        for entry in self._ledger[start:]:
+            if not self._matches(entry, projectId, hwSetName):
+                continue
+            if (since is not None and entry['at'] < since) or (until is not None and entry['at'] > until):
+                continue
+            entries.append(ledger.publicEntry(entry))
+            if len(entries) > limit:
+                return entries[:limit], entries[limit - 1]['id']
+        return entries, None
+
+    async def getBalancesAt(self, at=None, projectId=None, hwSetName=None):
+        at = ledger.utc(at)
+        header, balances, start = None, {}, 0
+        for snapshot_header, snapshot_balances in reversed(self._snapshots):
+            if at is None or snapshot_header['upTo'] <= at:
+                header, start = snapshot_header, snapshot_header['entries']
+                balances = {key: quantity for key, quantity in snapshot_balances.items()
+                            if self._matches({'projectId': key[0], 'hwSetName': key[1]}, projectId, hwSetName)}
+                break
+        tail = [
+            entry for entry in self._ledger[start:]
+            if self._matches(entry, projectId, hwSetName) and (at is None or entry['at'] <= at)
+        ]
+        replayed = ledger.foldEntries(balances, tail)
+        return {'snapshot': self._publicHeader(header), 'replayed': replayed, 'balances': ledger.balanceList(balances)}
+
+    async def takeLedgerSnapshot(self, min_age_seconds=0):
+        # Entries are appended under a lock in order, so no lag is needed: the snapshot covers everything so far
+        with self._ledger_lock:
+            upTo = len(self._ledger)
+            now = datetime.now(timezone.utc)
+        previous_header, balances = self._snapshots[-1] if self._snapshots else (None, {})
+        start = previous_header['entries'] if previous_header else 0
+        if previous_header is not None and (
+            start == upTo or previous_header['takenAt'] > now - timedelta(seconds=min_age_seconds)
+        ):
+            return self._publicHeader(previous_header)
+        balances = dict(balances)
+        ledger.foldEntries(balances, self._ledger[start:upTo])
+        header = {'id': str(upTo), 'upTo': now, 'takenAt': now, 'entries': upTo, 'balances': len(balances)}
+        self._snapshots.append((header, balances))
+        del self._snapshots[:-config.ledger_snapshots_kept]
+        return self._publicHeader(header)
+
+    async def auditLedger(self):
+        result = await self.getBalancesAt()
+        rebuilt = {(b['projectId'], b['hwSetName']): b['quantity'] for b in result['balances']}
+        projection = dict(self._checkouts)
+        count, mismatches = ledger.compareBalances(rebuilt, projection)
+        return {
+            'consistent': count == 0,
+            'snapshot': result['snapshot'],
+            'replayed': result['replayed'],
+            'holdings': len(projection),
+            'mismatchCount': count,
+            'mismatches': mismatches
+        }
+
+def create_storage(client=None, use_transactions=False):
+    """
+    Build the backend selected by STORAGE_BACKEND.
+    Args:
+        client: An AsyncMongoClient instance (required for the mongo backend)
+        use_transactions(bool): Run Mongo check-out/check-in in transactions
+
+    Returns:
+        HardwareStorage: The storage backend
+    """
+    if config.storage_backend == "memory":
+        # Per-set locks already make each check-out a few dict updates; there is nothing to combine
+        return InMemoryHardwareStorage()
+    combiner = None
+    if config.write_combiner_enabled:
+        combiner = WriteCombiner(client, config.write_combiner_window_ms / 1000, config.write_combiner_max_batch)
+    return MongoHardwareStorage(client, use_transactions=use_transactions, combiner=combiner)
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import os
+import sys
+
+# Admission control is plain asyncio, so this test runs without MongoDB or a server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import admission
+from admission import AdmissionController, AdmissionMiddleware, ProjectRateLimiter
+
+async def call(middleware, method, path, body=None):
+    """Send one request through the middleware; returns (status, headers, body)"""
+    sent = []
+    messages = [{"type": "http.request", "body": json.dumps(body).encode() if body else b"", "more_body": False}]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "headers": [], "query_string": b""}
+    await middleware(scope, receive, send)
+    headers = {key.decode(): value.decode() for key, value in sent[0].get("headers", [])}
+    return sent[0]["status"], headers, b"".join(message.get("body", b"") for message in sent[1:])
+
+def test_limits_queue_and_shed():
+    """A full route queues up to its queue size, then sheds with 503 + Retry-After; reads go before writes"""
+    async def scenario():
+        release = asyncio.Event()
+        order = []
+
+        async def app(scope, receive, send):
+            order.append(scope["path"])
+            await release.wait()
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"{}"})
+
+        controller = AdmissionController(
+            {"/check_out": (1, 1), "/get_hw_info": (10, 10), "/projects/{projectId}/holdings": (1, 0)},
+            max_in_flight=2, read_reserved=1, queue_timeout=5, retry_after=2
+        )
+        middleware = AdmissionMiddleware(app, controller)
+        running = asyncio.create_task(call(middleware, "POST", "/check_out"))
+        queued = asyncio.create_task(call(middleware, "POST", "/check_out"))
+        await asyncio.sleep(0.01)
+        status, headers, _ = await call(middleware, "POST", "/check_out")
+        assert status == 503 and headers["retry-after"] == "2"
+
+        # The write holds the only unreserved worker slot; the reserved one still takes a read
+        read = asyncio.create_task(call(middleware, "GET", "/get_hw_info"))
+        blocked = asyncio.create_task(call(middleware, "GET", "/get_hw_info"))
+        await asyncio.sleep(0.01)
+        assert order == ["/check_out", "/get_hw_info"]
+        assert controller.worker.waiting(admission.READ) == 1
+        # Templated routes match any project
+        holdings = asyncio.create_task(call(middleware, "GET", "/projects/p1/holdings"))
+        await asyncio.sleep(0.01)
+        release.set()
+        results = await asyncio.gather(running, queued, read, blocked, holdings)
+        assert [status for status, _, _ in results] == [200] * 5
+        assert controller.routes["/projects/{projectId}/holdings"].admitted == 1
+        # The waiting read was admitted before the queued write
+        assert order.index("/get_hw_info", 2) < order.index("/check_out", 1)
+        assert controller.worker.in_flight == 0 and controller.routes["/check_out"].slots.in_flight == 0
+        assert controller.stats()["routes"]["/check_out"]["rejected"][admission.QUEUE_FULL] == 1
+
+        release.clear()
+        slow = AdmissionMiddleware(app, AdmissionController({"/check_in": (1, 5)}, 0, 0, queue_timeout=0.05, retry_after=1))
+        first = asyncio.create_task(call(slow, "POST", "/check_in"))
+        await asyncio.sleep(0.01)
+        assert (await call(slow, "POST", "/check_in"))[0] == 503
+        release.set()
+        assert (await first)[0] == 200
+        assert slow.controller.routes["/check_in"].rejected[admission.QUEUE_TIMEOUT] == 1
+
+    asyncio.run(scenario())
+    print("✅ Admission queued, shed and preferred reads.")
+
+def test_project_rate_limit():
+    """Each project gets its own token bucket; the app still sees the request body"""
+    async def scenario():
+        bodies = []
+
+        async def app(scope, receive, send):
+            bodies.append(json.loads((await receive())["body"]))
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"{}"})
+
+        controller = AdmissionController({}, 0, 0, 1, 1, ProjectRateLimiter(1, 2, 100), ["/check_out"])
+        middleware = AdmissionMiddleware(app, controller)
+        statuses = [(await call(middleware, "POST", "/check_out", {"projectId": "p1", "qty": 1}))[0] for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        status, headers, _ = await call(middleware, "POST", "/check_out", {"projectId": "p1"})
+        assert status == 429 and headers["retry-after"] == "1"
+        assert (await call(middleware, "POST", "/check_out", {"projectId": "p2"}))[0] == 200
+        # Bodies without a projectId are left for request validation
+        assert (await call(middleware, "POST", "/check_out", {"qty": 1}))[0] == 200
+        assert bodies[0] == {"projectId": "p1", "qty": 1} and len(bodies) == 4
+        assert controller.routes["/check_out"].rejected[admission.RATE_LIMITED] == 2
+
+    asyncio.run(scenario())
+    print("✅ Projects were rate limited separately.")
+
+if __name__ == "__main__":
+    test_limits_queue_and_shed()
+    test_project_rate_limit()
@@ -0,0 +1,54 @@
+import requests
+import os
+
+# Base URL for the hardware service
+# Reads from environment variable or defaults to localhost:5002
+BASE_URL = os.getenv('HARDWARE_SERVICE_URL', 'http://localhost:5002')
+
+def _post(path, payload):
+    response = requests.post(f"{BASE_URL}{path}", json=payload)
+    print("Status Code:", response.status_code)
+    try:
+        print("RESPONSE JSON:", response.json())
+    except requests.exceptions.JSONDecodeError:
+        print("❌ Server returned non-JSON response")
+        print("Raw response:", response.text)
+    return response
+
+def test_check_out_batch():
+    """Test checking out several hardware sets at once (all-or-nothing)"""
+    payload = {
+        "projectId": "project123",
+        "userId": "user123",
+        "items": [
+            {"hwSetName": "HWSet1", "qty": 2},
+            {"hwSetName": "HWSet2", "qty": 1}
+        ],
+        "atomic": True
+    }
+    response = _post("/check_out_batch", payload)
+    if response.status_code == 200:
+        print("✅ Batch checked out successfully.")
+    else:
+        print("❌ Batch checkout failed with status:", response.status_code)
+
+def test_check_in_batch():
+    """Test checking in several hardware sets at once (best-effort)"""
+    payload = {
+        "projectId": "project123",
+        "userId": "user123",
+        "items": [
+            {"hwSetName": "HWSet1", "qty": 2},
+            {"hwSetName": "HWSet2", "qty": 1}
+        ],
+        "atomic": False
+    }
+    response = _post("/check_in_batch", payload)
+    if response.status_code == 200:
+        print("✅ Batch check-in processed; see per-item results.")
+    else:
+        print("❌ Batch check-in failed with status:", response.status_code)
+
+if __name__ == "__main__":
+    test_check_out_batch()
+    test_check_in_batch()
@@ -0,0 +1,63 @@
+import requests
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Base URL for the hardware service
+# Reads from environment variable or defaults to localhost:5002
+BASE_URL = os.getenv('HARDWARE_SERVICE_URL', 'http://localhost:5002')
+
+CAPACITY = 20
+REQUESTS = 100
+WORKERS = 25
+
+def _check_out(hw_set_name, i):
+    payload = {
+        "projectId": f"stress-project-{i}",
+        "hwSetName": hw_set_name,
+        "qty": 1,
+        "userId": "stress-user"
+    }
+    response = requests.post(f"{BASE_URL}/check_out", json=payload)
+    return i, response.status_code
+
+def _check_in(hw_set_name, i):
+    payload = {
+        "projectId": f"stress-project-{i}",
+        "hwSetName": hw_set_name,
+        "qty": 1,
+        "userId": "stress-user"
+    }
+    response = requests.post(f"{BASE_URL}/check_in", json=payload)
+    return i, response.status_code
+
+def test_concurrent_checkout_never_oversubscribes():
+    """Fire many concurrent check-outs at one small hardware set and verify the counts"""
+    hw_set_name = f"StressSet-{uuid.uuid4().hex[:8]}"
+    response = requests.post(f"{BASE_URL}/create_hardware_set", json={"hwSetName": hw_set_name, "capacity": CAPACITY})
+    assert response.status_code == 200, response.text
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        results = list(pool.map(lambda i: _check_out(hw_set_name, i), range(REQUESTS)))
+    granted = [i for i, status in results if status == 200]
+    rejected = [i for i, status in results if status == 400]
+
+    info = requests.get(f"{BASE_URL}/get_hw_info", params={"hwSetName": hw_set_name}).json()
+    print("Granted:", len(granted), "Rejected:", len(rejected), "RESPONSE JSON:", info)
+
+    assert len(granted) + len(rejected) == REQUESTS
+    assert len(granted) == CAPACITY
+    assert info["availability"] == 0
+
+    # Check everything back in concurrently; availability must return to capacity exactly
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        results = list(pool.map(lambda i: _check_in(hw_set_name, i), granted))
+    assert all(status == 200 for _, status in results)
+
+    info = requests.get(f"{BASE_URL}/get_hw_info", params={"hwSetName": hw_set_name}).json()
+    print("After check-in RESPONSE JSON:", info)
+    assert info["availability"] == CAPACITY
+    print("✅ No oversubscription under concurrent load.")
+
+if __name__ == "__main__":
+    test_concurrent_checkout_never_oversubscribes()
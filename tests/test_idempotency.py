@@ -0,0 +1,35 @@
+import requests
+import os
+import uuid
+
+# Base URL for the hardware service
+# Reads from environment variable or defaults to localhost:5002
+BASE_URL = os.getenv('HARDWARE_SERVICE_URL', 'http://localhost:5002')
+
+def _availability(hw_set_name):
+    return requests.get(f"{BASE_URL}/get_hw_info", params={"hwSetName": hw_set_name}).json()["availability"]
+
+def test_retried_check_out_applies_once():
+    """A check-out retried with the same Idempotency-Key is only applied once"""
+    hw_set_name = f"IdemSet-{uuid.uuid4().hex[:8]}"
+    response = requests.post(f"{BASE_URL}/create_hardware_set", json={"hwSetName": hw_set_name, "capacity": 10})
+    assert response.status_code == 200, response.text
+
+    payload = {"projectId": "idem-project", "hwSetName": hw_set_name, "qty": 3, "userId": "user123"}
+    headers = {"Idempotency-Key": uuid.uuid4().hex}
+    first = requests.post(f"{BASE_URL}/check_out", json=payload, headers=headers)
+    retry = requests.post(f"{BASE_URL}/check_out", json=payload, headers=headers)
+    print("First:", first.status_code, first.json(), "Retry:", retry.status_code, retry.json())
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert _availability(hw_set_name) == 7
+
+    # Same key, different request: rejected instead of replaying the wrong response
+    reused = requests.post(f"{BASE_URL}/check_out", json={**payload, "qty": 1}, headers=headers)
+    print("Reused key:", reused.status_code, reused.json())
+    assert reused.status_code == 422
+    assert _availability(hw_set_name) == 7
+    print("✅ Retried check-out was applied once.")
+
+if __name__ == "__main__":
+    test_retried_check_out_applies_once()
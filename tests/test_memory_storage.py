@@ -0,0 +1,479 @@
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# The in-memory backend needs no database, so this test runs without MongoDB or a server
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('SERVICE_PORT', '5002')
+os.environ.setdefault('ENVIRONMENT', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import bulk_io
+import hardware_database_async as hardwareDB
+from storage import InMemoryHardwareStorage
+from waitlist import Waitlist
+from availability_stream import AvailabilityBroadcaster
+from readiness import ReadinessProbe
+
+CAPACITY = 20
+REQUESTS = 200
+WORKERS = 16
+
+def test_threads_never_oversubscribe():
+    """Many threads checking out of one small set: exactly CAPACITY succeed"""
+    storage = InMemoryHardwareStorage()
+    asyncio.run(storage.createHardwareSet("HWSet1", CAPACITY))
+
+    def check_out(i):
+        return asyncio.run(storage.checkOutHardware(f"project-{i}", "HWSet1", 1))
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        outcomes = list(pool.map(check_out, range(REQUESTS)))
+    granted = [i for i, outcome in enumerate(outcomes) if outcome == hardwareDB.CHECKOUT_OK]
+    assert len(granted) == CAPACITY
+    assert outcomes.count(hardwareDB.NOT_ENOUGH_AVAILABLE) == REQUESTS - CAPACITY
+
+    def check_in(i):
+        return asyncio.run(storage.checkInHardware(f"project-{i}", "HWSet1", 1))
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        assert all(outcome == hardwareDB.CHECKOUT_OK for outcome in pool.map(check_in, granted))
+    _, hw_set = asyncio.run(storage.queryHardwareSet("HWSet1"))
+    print("After check-in:", hw_set)
+    assert hw_set["availability"] == CAPACITY
+
+def test_same_outcomes_as_mongo_layer():
+    """Error outcomes, atomic batches and paging behave like hardware_database_async"""
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        assert (await storage.createHardwareSet("HWSet1", 10))[0]
+        assert (await storage.createHardwareSet("HWSet2", 5))[0]
+        assert not (await storage.createHardwareSet("HWSet1", 10))[0]
+
+        assert await storage.checkOutHardware("p1", "Missing", 1) == hardwareDB.HW_NOT_FOUND
+        assert await storage.checkOutHardware("p1", "HWSet2", 6) == hardwareDB.NOT_ENOUGH_AVAILABLE
+        assert await storage.checkInHardware("p1", "HWSet1", 1) == hardwareDB.MORE_THAN_CHECKED_OUT
+
+        # All-or-nothing: HWSet2 is short, so HWSet1 is not touched either
+        outcomes = await storage.checkOutHardwareBatch("p1", [("HWSet1", 3), ("HWSet2", 6)])
+        assert outcomes == [hardwareDB.BATCH_NOT_APPLIED, hardwareDB.NOT_ENOUGH_AVAILABLE]
+        assert (await storage.queryHardwareSet("HWSet1"))[1]["availability"] == 10
+
+        outcomes = await storage.checkOutHardwareBatch("p1", [("HWSet1", 3), ("HWSet2", 6)], atomic=False)
+        assert outcomes == [hardwareDB.CHECKOUT_OK, hardwareDB.NOT_ENOUGH_AVAILABLE]
+        assert await storage.getProjectCheckout("p1", "HWSet1") == 3
+
+        names, cursor = await storage.getHwSetNamesPage(1, prefix="HWSet")
+        assert names == ["HWSet1"] and cursor == "HWSet1"
+        names, cursor = await storage.getHwSetNamesPage(1, after=cursor, prefix="HWSet")
+        assert names == ["HWSet2"] and cursor is None
+
+        assert await storage.checkOutHardware("p2", "HWSet2", 2, leaseSeconds=60) == hardwareDB.CHECKOUT_OK
+        exported = [record async for record in storage.exportState()]
+        assert {"type": "checkout", "projectId": "p1", "hwSetName": "HWSet1", "quantity": 3} in exported
+        leased = next(record for record in exported if record.get("projectId") == "p2")
+        assert leased["expiresAt"] == (await storage.getProjectHoldings("p2"))["holdings"][0]["expiresAt"]
+
+        # A round-trip keeps the lease, so the sweeper still returns those units
+        restored = InMemoryHardwareStorage()
+
+        async def records():
+            for line, record in enumerate(exported, 1):
+                yield line, record
+        assert (await restored.importRecords(records()))["inserted"] == len(exported)
+        assert [record async for record in restored.exportState()] == exported
+        assert (await restored.renewLease("p2", "HWSet2", 60))[0] == hardwareDB.CHECKOUT_OK
+
+    asyncio.run(scenario())
+    print("✅ In-memory storage matches the Mongo data layer.")
+
+def test_failed_keyed_call_releases_its_key():
+    """A keyed call that raises doesn't leave its Idempotency-Key claimed"""
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        await storage.createHardwareSet("HWSet1", 10)
+        check_out = storage._checkOut
+
+        def failing(*args):
+            raise RuntimeError("failed")
+        storage._checkOut = failing
+        try:
+            await storage.checkOutHardware("p1", "HWSet1", 2, idempotency_key="key-1")
+            assert False, "the check-out should have raised"
+        except RuntimeError:
+            pass
+        storage._checkOut = check_out
+        assert await storage.checkOutHardware("p1", "HWSet1", 2, idempotency_key="key-1") == hardwareDB.CHECKOUT_OK
+        assert await storage.checkOutHardware("p1", "HWSet1", 2, idempotency_key="key-1") == hardwareDB.CHECKOUT_OK
+        assert (await storage.queryHardwareSet("HWSet1"))[1]["availability"] == 8
+
+    asyncio.run(scenario())
+    print("✅ A failed keyed call released its key.")
+
+def test_import_parsers():
+    """NDJSON/CSV parsing keeps file line numbers, skips blank lines, and bad records are rejected"""
+    async def parse(parser, text):
+        async def chunks():
+            # Split mid-line, as a request body may be
+            for start in range(0, len(text), 7):
+                yield text[start:start + 7].encode()
+        return [record async for record in parser(bulk_io.iter_lines(chunks()))]
+
+    async def scenario():
+        ndjson = '{"hwSetName": "A", "capacity": 5}\n\n{not json}\r\n{"hwSetName": "B", "capacity": 2}'
+        assert await parse(bulk_io.parse_ndjson, ndjson) == [
+            (1, {"hwSetName": "A", "capacity": 5}), (3, None), (4, {"hwSetName": "B", "capacity": 2})
+        ]
+        csv = " hwSetName , capacity,availability\n\nA,5,\n\"B, two\",2,1\n"
+        assert await parse(bulk_io.parse_csv, csv) == [
+            (3, {"hwSetName": "A", "capacity": "5"}), (4, {"hwSetName": "B, two", "capacity": "2", "availability": "1"})
+        ]
+        assert bulk_io.parser_for("csv") is bulk_io.parse_csv and bulk_io.parser_for("ndjson") is bulk_io.parse_ndjson
+
+    asyncio.run(scenario())
+
+    assert hardwareDB.parseImportRecord({"hwSetName": "A", "capacity": "5"}) == (
+        "hardware", {"hwSetName": "A", "capacity": 5, "availability": 5}
+    )
+    assert hardwareDB.parseImportRecord({"type": "checkout", "projectId": "p1", "hwSetName": "A", "quantity": 2}) == (
+        "checkout", {"projectId": "p1", "hwSetName": "A", "quantity": 2}
+    )
+    rejected = [
+        (None, "not a valid record"),
+        ({"capacity": 5}, "hwSetName is required"),
+        ({"hwSetName": "A", "capacity": "five"}, "capacity must be an integer"),
+        ({"hwSetName": "A", "capacity": 0}, "capacity must be positive"),
+        ({"hwSetName": "A", "capacity": 5, "availability": 6}, "availability must be between 0 and capacity"),
+        ({"type": "checkout", "hwSetName": "A", "quantity": 1}, "projectId and hwSetName are required"),
+        ({"type": "checkout", "projectId": "p1", "hwSetName": "A", "quantity": 0}, "quantity must be positive"),
+        ({"type": "checkout", "projectId": "p1", "hwSetName": "A", "quantity": 1, "expiresAt": "soon"},
+         "expiresAt must be an ISO 8601 timestamp"),
+        ({"type": "project"}, "unknown record type 'project'")
+    ]
+    for record, error in rejected:
+        try:
+            hardwareDB.parseImportRecord(record)
+            assert False, f"{record} should have been rejected"
+        except ValueError as e:
+            assert str(e) == error
+    print("✅ Import parsers kept line numbers and rejected bad records.")
+
+def test_combined_admission_matches_sequential():
+    """A write-combiner batch admits exactly what the same requests would get one after another"""
+    ops = [("p1", 4, None, None), ("p2", 5, None, None), ("p1", -2, None, None), ("p3", 4, None, None),
+           ("p2", -6, None, None), ("p3", 3, None, None), ("p4", -1, None, None)]
+
+    async def sequential():
+        storage = InMemoryHardwareStorage()
+        await storage.createHardwareSet("HWSet1", 10)
+        outcomes = []
+        for projectId, qty, _, _ in ops:
+            if qty > 0:
+                outcomes.append(await storage.checkOutHardware(projectId, "HWSet1", qty))
+            else:
+                outcomes.append(await storage.checkInHardware(projectId, "HWSet1", -qty))
+        return outcomes, (await storage.queryHardwareSet("HWSet1"))[1]["availability"]
+
+    expected, availability = asyncio.run(sequential())
+    outcomes, net, _ = hardwareDB._admitCombined({"capacity": 10, "availability": 10}, {}, ops)
+    assert outcomes == expected
+    assert 10 - sum(net.values()) == availability
+    assert dict(net) == {"p1": 2, "p2": 5, "p3": 3}
+    print("✅ Combined admission matches sequential requests.")
+
+def test_shard_capacities_add_up():
+    """Sharded sets split capacity as evenly as possible, and the in-memory engine reports no shards"""
+    assert hardwareDB.splitCapacity(10, 4) == [3, 3, 2, 2]
+    assert hardwareDB.splitCapacity(8, 8) == [1] * 8
+
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        assert (await storage.createHardwareSet("HWSet1", 10, shards=4))[0]
+        assert await storage.shardHardwareSet("HWSet1", 4) == (hardwareDB.CHECKOUT_OK, 0)
+        assert await storage.shardHardwareSet("missing", 4) == (hardwareDB.HW_NOT_FOUND, 0)
+        assert await storage.checkOutHardware("proj1", "HWSet1", 10) == hardwareDB.CHECKOUT_OK
+
+    asyncio.run(scenario())
+    print("✅ Shard capacities add up.")
+
+def test_versions_track_availability_writes():
+    """Every availability write bumps the version behind the ETag; rejected writes leave it alone"""
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        await storage.createHardwareSet("HWSet1", 10)
+        await storage.createHardwareSet("HWSet2", 5)
+        version = lambda hw_set: hw_set["version"]
+        assert version((await storage.queryHardwareSet("HWSet1"))[1]) == 0
+        assert await storage.checkOutHardware("proj1", "HWSet1", 4) == hardwareDB.CHECKOUT_OK
+        assert await storage.checkOutHardware("proj1", "HWSet1", 40) == hardwareDB.NOT_ENOUGH_AVAILABLE
+        assert await storage.checkInHardware("proj1", "HWSet1", 1) == hardwareDB.CHECKOUT_OK
+        found = await storage.queryHardwareSets(["HWSet1", "missing", "HWSet2"])
+        assert sorted(found) == ["HWSet1", "HWSet2"]
+        assert (version(found["HWSet1"]), found["HWSet1"]["availability"]) == (2, 7)
+        assert version(found["HWSet2"]) == 0
+
+    asyncio.run(scenario())
+    print("✅ Versions track availability writes.")
+
+def test_ledger_replays_to_checkout_records():
+    """Ledger entries, snapshots and the audit agree with the checkout records"""
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        await storage.createHardwareSet("HWSet1", 10)
+        assert await storage.checkOutHardware("p1", "HWSet1", 4, userId="u1") == hardwareDB.CHECKOUT_OK
+        assert await storage.checkOutHardware("p1", "HWSet1", 20) == hardwareDB.NOT_ENOUGH_AVAILABLE
+        snapshot = await storage.takeLedgerSnapshot()
+        assert snapshot["entries"] == 1
+
+        await storage.checkInHardware("p1", "HWSet1", 1, userId="u1")
+        await storage.checkOutHardwareBatch("p2", [("HWSet1", 2)], userId="u2")
+
+        # Rejected requests never reach the ledger
+        entries, cursor = await storage.getLedger(projectId="p1", limit=1)
+        assert [(e["qty"], e["op"], e["userId"]) for e in entries] == [(4, "check_out", "u1")]
+        entries, cursor = await storage.getLedger(projectId="p1", after=cursor)
+        assert [e["qty"] for e in entries] == [-1] and cursor is None
+
+        result = await storage.getBalancesAt()
+        assert result["snapshot"]["id"] == snapshot["id"] and result["replayed"] == 2
+        assert {(b["projectId"], b["quantity"]) for b in result["balances"]} == {("p1", 3), ("p2", 2)}
+        audit = await storage.auditLedger()
+        assert audit["consistent"], audit
+
+    asyncio.run(scenario())
+    print("✅ Ledger replays to the checkout records.")
+
+def test_holdings_and_utilization_reports():
+    """Holdings and utilization match the checkout records"""
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        await storage.createHardwareSet("HWSet1", 10)
+        await storage.createHardwareSet("HWSet2", 4)
+        await storage.checkOutHardwareBatch("p1", [("HWSet2", 1), ("HWSet1", 3)])
+        await storage.checkOutHardware("p2", "HWSet1", 2)
+
+        holdings = await storage.getProjectHoldings("p1")
+        assert holdings["holdings"] == [
+            {"hwSetName": "HWSet1", "quantity": 3, "capacity": 10, "expiresAt": None},
+            {"hwSetName": "HWSet2", "quantity": 1, "capacity": 4, "expiresAt": None}
+        ]
+        assert holdings["totalQuantity"] == 4
+
+        report = await storage.getUtilization()
+        assert [(r["hwSetName"], r["checkedOut"], r["projects"]) for r in report["hardwareSets"]] == [
+            ("HWSet1", 5, 2), ("HWSet2", 1, 1)
+        ]
+        assert report["totals"]["checkedOut"] + report["totals"]["availability"] == report["totals"]["capacity"]
+
+    asyncio.run(scenario())
+    print("✅ Holdings and utilization match the checkout records.")
+
+def test_reports_are_consistent_under_writes():
+    """Utilization and export never pair one moment's availability with another's checkout totals"""
+    storage = InMemoryHardwareStorage()
+    asyncio.run(storage.createHardwareSet("HWSet1", CAPACITY))
+
+    def churn(i):
+        for _ in range(20):
+            if asyncio.run(storage.checkOutHardware(f"project-{i}", "HWSet1", 1)) == hardwareDB.CHECKOUT_OK:
+                asyncio.run(storage.checkInHardware(f"project-{i}", "HWSet1", 1))
+
+    def read(_):
+        for _ in range(20):
+            record = asyncio.run(storage.getUtilization())["hardwareSets"][0]
+            assert record["availability"] + record["checkedOut"] == record["capacity"]
+
+            async def export():
+                return [record async for record in storage.exportState()]
+            exported = asyncio.run(export())
+            held = sum(record["quantity"] for record in exported if record["type"] == "checkout")
+            assert exported[0]["availability"] + held == CAPACITY
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        list(pool.map(lambda i: churn(i) if i % 2 else read(i), range(WORKERS)))
+    print("✅ Reports stayed consistent under concurrent writes.")
+
+def test_expired_leases_return_units():
+    """Overdue leases are returned to availability; renewed and unleased holdings are kept"""
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        await storage.createHardwareSet("HWSet1", 10)
+        await storage.checkOutHardware("leased", "HWSet1", 3, leaseSeconds=1)
+        await storage.checkOutHardware("leased2", "HWSet1", 1, leaseSeconds=1)
+        await storage.checkOutHardware("renewed", "HWSet1", 2, leaseSeconds=1)
+        await storage.checkOutHardware("kept", "HWSet1", 1)
+        assert (await storage.renewLease("renewed", "HWSet1", 60))[0] == hardwareDB.CHECKOUT_OK
+        assert (await storage.renewLease("kept", "HWSet1", 60))[0] == hardwareDB.NOT_LEASED
+        assert (await storage.expireLeases())["expired"] == 0
+
+        await asyncio.sleep(1.1)
+        # One record per batch still returns every overdue lease
+        assert await storage.expireLeases(batch_size=1) == {"expired": 2, "units": 4, "hwSetNames": ["HWSet1"]}
+        assert (await storage.renewLease("leased", "HWSet1", 60))[0] == hardwareDB.NO_HOLDING
+        assert (await storage.queryHardwareSet("HWSet1"))[1]["availability"] == 7
+        assert (await storage.auditLedger())["consistent"]
+
+        # A holding emptied through updateProjectCheckout leaves no lease for the sweeper to trip over
+        emptied = InMemoryHardwareStorage()
+        await emptied.createHardwareSet("HWSet1", 5)
+        await emptied.checkOutHardware("p", "HWSet1", 2, leaseSeconds=1)
+        assert await emptied.updateProjectCheckout("p", "HWSet1", -2)
+        await asyncio.sleep(1.1)
+        assert await emptied.expireLeases() == {"expired": 0, "units": 0, "hwSetNames": []}
+
+    asyncio.run(scenario())
+    print("✅ Expired leases were returned.")
+
+def test_waitlist_grants_in_order():
+    """Waiting check-outs are granted by priority then arrival, and the head blocks smaller requests behind it"""
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        await storage.createHardwareSet("HWSet1", 10)
+        await storage.checkOutHardware("holder", "HWSet1", 9)
+        _, first = await storage.enqueueCheckout("first", "HWSet1", 4)
+        _, second = await storage.enqueueCheckout("second", "HWSet1", 1)
+        _, urgent = await storage.enqueueCheckout("urgent", "HWSet1", 2, priority=1)
+        assert (await storage.enqueueCheckout("huge", "HWSet1", 11))[0] == hardwareDB.EXCEEDS_CAPACITY
+        positions = [(await storage.getWaitlistEntry(entry["waitId"]))["position"] for entry in (urgent, first, second)]
+        assert positions == [0, 1, 2]
+        # One unit is free, but the urgent head needs two
+        assert await storage.drainWaitlist("HWSet1") == []
+
+        # A long-poll is answered by the poll loop, not by the drain that granted it
+        waitlist = Waitlist(storage, poll_interval=0.05, drain_interval=0)
+        waitlist.start()
+        waiting = asyncio.create_task(waitlist.wait(first["waitId"], 5))
+        await asyncio.sleep(0.1)
+        await storage.checkInHardware("holder", "HWSet1", 6)
+        granted = await storage.drainWaitlist("HWSet1")
+        assert [entry["projectId"] for entry in granted] == ["urgent", "first", "second"]
+        assert (await asyncio.wait_for(waiting, 1))["status"] == hardwareDB.WAIT_GRANTED
+        await waitlist.stop()
+
+        assert (await storage.queryHardwareSet("HWSet1"))[1]["availability"] == 0
+        assert await storage.cancelWait(second["waitId"]) == hardwareDB.WAIT_FINISHED
+        assert (await storage.auditLedger())["consistent"]
+
+    asyncio.run(scenario())
+    print("✅ Waitlist granted in order.")
+
+def test_transaction_writes_announced_after_commit():
+    """Availability writes inside a transaction reach the listeners after commit, once, and never on abort"""
+    class Session:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def with_transaction(self, callback):
+            # The first attempt hits a transient error and is retried, as with_transaction does
+            await callback(self)
+            return await callback(self)
+
+    class Client:
+        def start_session(self):
+            return Session()
+
+    announced = []
+    listener = lambda hwSetName, hw_set: announced.append((hwSetName, hw_set))
+
+    async def steps(session):
+        hardwareDB._announceWrite("HWSet1", {"availability": 1}, session)
+        hardwareDB._announceWrite("HWSet2", session=session)
+        assert announced == []
+        return hardwareDB.CHECKOUT_OK
+
+    async def aborted(session):
+        hardwareDB._announceWrite("HWSet1", session=session)
+        raise hardwareDB._AbortTransaction(hardwareDB.NOT_ENOUGH_AVAILABLE)
+
+    hardwareDB.addAvailabilityListener(listener)
+    try:
+        assert asyncio.run(hardwareDB._runInTransaction(Client(), steps)) == hardwareDB.CHECKOUT_OK
+        # The committed document isn't known, so listeners re-read it
+        assert sorted(announced) == [("HWSet1", None), ("HWSet2", None)]
+        del announced[:]
+        assert asyncio.run(hardwareDB._runInTransaction(Client(), aborted)) == hardwareDB.NOT_ENOUGH_AVAILABLE
+        assert announced == [] and hardwareDB._pendingAnnouncements == {}
+        hardwareDB._announceWrite("HWSet1", {"availability": 1})
+        assert announced == [("HWSet1", {"availability": 1})]
+    finally:
+        hardwareDB.removeAvailabilityListener(listener)
+    print("✅ Transaction writes were announced after commit.")
+
+def test_availability_stream_coalesces_slow_readers():
+    """Writes reach every stream following the set; an unread stream keeps only the latest value"""
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        await storage.createHardwareSet("HWSet1", 10)
+        await storage.createHardwareSet("HWSet2", 5)
+        broadcaster = AvailabilityBroadcaster(storage, poll_interval=0)
+        broadcaster.start()
+        fast, current, missing = await broadcaster.subscribe(["HWSet1", "nope"])
+        assert [event["availability"] for event in current] == [10] and missing == ["nope"]
+        broadcaster.unsubscribe(fast)
+        fast, _, _ = await broadcaster.subscribe(["HWSet1"])
+        slow, _, _ = await broadcaster.subscribe(["HWSet1", "HWSet2"])
+
+        await storage.checkOutHardware("p1", "HWSet1", 3)
+        assert [(event["availability"], event["change"]) for event in await fast.next(1)] == [(7, -3)]
+        await storage.checkOutHardware("p2", "HWSet1", 2)
+        await storage.checkInHardware("p1", "HWSet1", 1)
+        await storage.checkOutHardware("p1", "HWSet2", 5)
+        # Unfollowed sets and timeouts produce nothing
+        await storage.createHardwareSet("HWSet3", 1)
+        await storage.checkOutHardware("p1", "HWSet3", 1)
+        events = {event["hardwareName"]: event for event in await slow.next(1)}
+        assert events["HWSet1"]["availability"] == 6 and events["HWSet2"]["availability"] == 0
+        assert [event["availability"] for event in await fast.next(1)] == [6]
+        assert await slow.next(0.01) == []
+
+        broadcaster.unsubscribe(fast)
+        broadcaster.unsubscribe(slow)
+        stats = broadcaster.stats()
+        assert stats["streams"] == 0 and stats["followedSets"] == 0 and stats["coalesced"] == 3
+        await broadcaster.stop()
+
+    asyncio.run(scenario())
+    print("✅ Availability stream coalesced the slow reader.")
+
+def test_readiness_follows_warm_up_and_pings():
+    """A worker is ready only after warm-up and while storage answers its pings"""
+    async def scenario():
+        storage = InMemoryHardwareStorage()
+        readiness = ReadinessProbe(interval=0.02, timeout=0.05)
+        readiness.start(storage)
+        await asyncio.sleep(0.05)
+        assert readiness.checks["storage"] == "ok" and not readiness.ready
+        readiness.warmed()
+        assert readiness.snapshot()["ready"]
+
+        async def hang():
+            await asyncio.sleep(1)
+        storage.ping = hang
+        await asyncio.sleep(0.1)
+        assert not readiness.ready and readiness.failures > 0
+        await readiness.stop()
+        assert not ReadinessProbe(1, 1, ["MONGO_HOST"]).ready
+
+    asyncio.run(scenario())
+    print("✅ Readiness followed warm-up and pings.")
+
+if __name__ == "__main__":
+    test_threads_never_oversubscribe()
+    test_same_outcomes_as_mongo_layer()
+    test_failed_keyed_call_releases_its_key()
+    test_import_parsers()
+    test_combined_admission_matches_sequential()
+    test_shard_capacities_add_up()
+    test_versions_track_availability_writes()
+    test_ledger_replays_to_checkout_records()
+    test_holdings_and_utilization_reports()
+    test_reports_are_consistent_under_writes()
+    test_expired_leases_return_units()
+    test_waitlist_grants_in_order()
+    test_transaction_writes_announced_after_commit()
+    test_availability_stream_coalesces_slow_readers()
+    test_readiness_follows_warm_up_and_pings()
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sys
+
+# The report queries are replaced by canned results, so this test runs without MongoDB or a server
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('SERVICE_PORT', '5002')
+os.environ.setdefault('ENVIRONMENT', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hardware_database_async as hardwareDB
+from config import config
+from report_cache import report_cache
+
+def test_routed_reports_skip_the_cache():
+    """Reports read away from the primary are served but never cached; primary reads are"""
+    reads = []
+
+    async def streamProjectHoldings(client, projectId):
+        reads.append(projectId)
+        yield {"hwSetName": "HWSet1", "quantity": 2, "capacity": 10, "expiresAt": None}
+
+    async def streamUtilization(client):
+        reads.append("utilization")
+        yield hardwareDB.utilizationRecord("HWSet1", 10, 8, 2, 1)
+
+    async def scenario():
+        # Every holdings/utilization read below is a miss unless the one before it was cached
+        for preference, overrides, cached in [
+            ("primary", {}, True),
+            ("secondaryPreferred", {}, False),
+            ("secondaryPreferred", {"streamProjectHoldings": "primary", "streamUtilization": "primary"}, True)
+        ]:
+            config.mongo_read_only_read_preference = preference
+            config.mongo_operation_read_preferences = overrides
+            assert hardwareDB._fromPrimary(False, "streamProjectHoldings")
+            assert hardwareDB._fromPrimary(True, "streamProjectHoldings") == cached
+            report_cache.clear()
+            del reads[:]
+            for _ in range(2):
+                assert (await hardwareDB.getProjectHoldings(None, "p1"))["totalQuantity"] == 2
+                assert (await hardwareDB.getUtilization(None))["totals"]["checkedOut"] == 2
+            assert reads == (["p1", "utilization"] if cached else ["p1", "utilization"] * 2)
+
+    saved = (
+        hardwareDB.streamProjectHoldings, hardwareDB.streamUtilization,
+        config.mongo_read_only_read_preference, config.mongo_operation_read_preferences,
+        report_cache.max_entries, report_cache.ttl_seconds
+    )
+    hardwareDB.streamProjectHoldings = streamProjectHoldings
+    hardwareDB.streamUtilization = streamUtilization
+    report_cache.max_entries, report_cache.ttl_seconds = 10, 60
+    try:
+        asyncio.run(scenario())
+    finally:
+        (
+            hardwareDB.streamProjectHoldings, hardwareDB.streamUtilization,
+            config.mongo_read_only_read_preference, config.mongo_operation_read_preferences,
+            report_cache.max_entries, report_cache.ttl_seconds
+        ) = saved
+        report_cache.clear()
+    print("✅ Routed reports were not cached.")
+
+if __name__ == "__main__":
+    test_routed_reports_skip_the_cache()
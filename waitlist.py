@@ -0,0 +1,189 @@
+# Per-worker checkout waitlist service: drains queues as units come back and wakes clients waiting on an entry
+import asyncio
+import hardware_database_async as hardwareDB
+
+# Statuses after which an entry never changes again
+FINISHED = (hardwareDB.WAIT_GRANTED, hardwareDB.WAIT_CANCELLED, hardwareDB.WAIT_EXPIRED)
+
+class Waitlist:
+    """
+    Grants waiting check-outs and tells waiting clients when their entry is
+    finished (granted, cancelled or expired).
+
+    Check-ins and lease expiry on this worker call schedule_drain for the sets
+    that got units back; drains of one set are coalesced, so a burst of
+    check-ins costs one running drain plus at most one rerun. Entries granted
+    here wake this worker's waiters at once.
+
+    Grants made by another worker are picked up by the background loop: every
+    poll interval it runs one getFinishedWaits query covering every entry this
+    worker has clients waiting on, so N long-polling clients cost one query per
+    interval instead of N polling requests. Every drain interval it also expires
+    overdue entries and drains every non-empty waitlist, which catches units
+    returned by other workers or written to the database directly.
+    Only touched from the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, storage, poll_interval, drain_interval):
+        self.storage = storage
+        self.poll_interval = poll_interval
+        self.drain_interval = drain_interval
+        self._events = {}      # waitId -> asyncio.Event set once the entry is finished
+        self._waiters = {}     # waitId -> number of clients waiting on it
+        self._draining = {}    # hwSetName -> running drain task
+        self._rerun = set()    # Sets whose drain must run again once the current one ends
+        self._task = None
+        self.granted = 0
+        self.drains = 0
+        self.polls = 0
+        self.errors = 0
+
+    def start(self):
+        """Start the poll/drain loop in the background"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background loop and any running drains"""
+        tasks = [task for task in (self._task, *self._draining.values()) if task is not None]
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._draining.clear()
+        self._rerun.clear()
+
+    def resolve(self, entries):
+        """Wake the clients waiting on any of these finished entries"""
+        for entry in entries:
+            event = self._events.get(entry['waitId'])
+            if event is not None:
+                event.set()
+
+    async def drain(self, hwSetName):
+        """
+        Grant a set's waiting check-outs now.
+        Returns:
+            list: The entries granted
+        """
+        granted = await self.storage.drainWaitlist(hwSetName)
+        self.drains += 1
+        self.granted += len(granted)
+        self.resolve(granted)
+        return granted
+
+    def schedule_drain(self, hwSetNames):
+        """
+        Drain these sets in the background, without delaying the caller's response.
+        Args:
+            hwSetNames(iterable): Sets that just got units back
+        """
+        for name in hwSetNames:
+            if name in self._draining:
+                self._rerun.add(name)
+            else:
+                self._draining[name] = asyncio.create_task(self._drainLoop(name))
+
+    async def _drainLoop(self, hwSetName):
+        try:
+            while True:
+                self._rerun.discard(hwSetName)
+                try:
+                    await self.drain(hwSetName)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"⚠ Waitlist drain of {hwSetName} failed: {e}")
+                if hwSetName not in self._rerun:
+                    return
+        finally:
+            self._draining.pop(hwSetName, None)
+
+    def _register(self, waitId):
+        self._waiters[waitId] = self._waiters.get(waitId, 0) + 1
+        return self._events.setdefault(waitId, asyncio.Event())
+
+    def _unregister(self, waitId):
+        self._waiters[waitId] -= 1
+        if not self._waiters[waitId]:
+            del self._waiters[waitId]
+            del self._events[waitId]
+
+    async def wait(self, waitId, timeout):
+        """
+        Long-poll: return an entry once it is finished, or after timeout seconds.
+        Args:
+            waitId(str): The entry's waitId
+            timeout(float): Longest time to hold the request
+
+        Returns:
+            dict or None: The public entry as it is on return, or None if there is no such entry
+        """
+        # Registered before the first read, so a grant landing in between still wakes us
+        event = self._register(waitId)
+        try:
+            entry = await self.storage.getWaitlistEntry(waitId)
+            if entry is None or entry['status'] in FINISHED or timeout <= 0:
+                return entry
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            self._unregister(waitId)
+        return await self.storage.getWaitlistEntry(waitId)
+
+    async def follow(self, waitId, heartbeat):
+        """
+        Yield an entry now, every `heartbeat` seconds while it waits (with its
+        current position), and once more when it finishes.
+        Args:
+            waitId(str): The entry's waitId
+            heartbeat(float): Seconds between updates while nothing changes
+
+        Yields:
+            dict: The public entry
+        """
+        while True:
+            entry = await self.wait(waitId, heartbeat)
+            if entry is None:
+                return
+            yield entry
+            if entry['status'] in FINISHED:
+                return
+
+    async def _run(self):
+        elapsed = 0.0
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            elapsed += self.poll_interval
+            try:
+                if self._events:
+                    self.polls += 1
+                    self.resolve(await self.storage.getFinishedWaits(list(self._events)))
+                if self.drain_interval > 0 and elapsed >= self.drain_interval:
+                    elapsed = 0.0
+                    await self.storage.expireWaits()
+                    self.schedule_drain(await self.storage.getWaitlistedHwSets())
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠ Waitlist poll failed: {e}")
+
+    def stats(self):
+        """
+        Return waitlist counters for this worker.
+        Returns:
+            dict: Waiting clients, running drains and grant/drain/poll/error counters
+        """
+        return {
+            "waitingClients": sum(self._waiters.values()),
+            "waitedEntries": len(self._waiters),
+            "runningDrains": len(self._draining),
+            "drains": self.drains,
+            "granted": self.granted,
+            "polls": self.polls,
+            "errors": self.errors
+        }
@@ -0,0 +1,95 @@
+# Per-worker write combiner: concurrent check-outs/check-ins of one hardware set become one write
+import asyncio
+import hardware_database_async as hardwareDB
+
+class WriteCombiner:
+    """
+    Gathers concurrent check-outs and check-ins of the same hardware set and
+    applies them with hardware_database_async.applyCombined: one guarded $inc of
+    the set's availability plus one bulk write to the checkout records, instead
+    of one update per request all queueing on the same document.
+
+    The first request for an idle set starts a flush task for it. The task
+    waits `window_seconds` for more requests, applies up to `max_batch` of them
+    and keeps flushing while requests are pending, so requests arriving during
+    a flush form the next batch. Each caller gets its own outcome. With a window
+    of 0 only requests that arrive while a flush is in flight are combined.
+    Only touched from the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, client, window_seconds, max_batch):
+        self.client = client
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self._pending = {}    # hwSetName -> [(op, future)] in arrival order
+        self._flushers = {}   # hwSetName -> running flush task
+        self.submitted = 0
+        self.flushes = 0
+        self.largest_batch = 0
+
+    async def submit(self, hwSetName, projectId, qty, userId=None, leaseSeconds=None, use_transaction=False):
+        """
+        Queue one check-out (qty > 0) or check-in (qty < 0) and wait for its outcome.
+        Args:
+            hwSetName(str): The hardware set name
+            projectId(str): The project ID
+            qty(int): Units to take; negative to return units
+            userId(str): The requesting user, recorded in the ledger
+            leaseSeconds(int): Optional lease for a check-out
+            use_transaction(bool): Apply the batch in one transaction (replica set only)
+
+        Returns:
+            str: The op's outcome, as checkOutHardware/checkInHardware would return it
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(hwSetName, []).append(((projectId, qty, userId, leaseSeconds), future))
+        self.submitted += 1
+        if hwSetName not in self._flushers:
+            self._flushers[hwSetName] = asyncio.create_task(self._flush(hwSetName, use_transaction))
+        return await future
+
+    async def _flush(self, hwSetName, use_transaction):
+        batch = []
+        try:
+            while self._pending.get(hwSetName):
+                if self.window_seconds > 0:
+                    await asyncio.sleep(self.window_seconds)
+                pending = self._pending[hwSetName]
+                batch, self._pending[hwSetName] = pending[:self.max_batch], pending[self.max_batch:]
+                self.flushes += 1
+                self.largest_batch = max(self.largest_batch, len(batch))
+                try:
+                    outcomes = await hardwareDB.applyCombined(
+                        self.client, hwSetName, [op for op, _ in batch], use_transaction=use_transaction
+                    )
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), outcome in zip(batch, outcomes):
+                    # A caller that went away no longer waits, but its op was applied
+                    if not future.done():
+                        future.set_result(outcome)
+                batch = []
+        finally:
+            # Cancelled (shutdown): nobody will apply what is left
+            for _, future in batch + self._pending.pop(hwSetName, []):
+                future.cancel()
+            del self._flushers[hwSetName]
+
+    def stats(self):
+        """
+        Return combiner settings and counters for this worker.
+        Returns:
+            dict: Window, batch limit, requests submitted, flushes and batch sizes
+        """
+        return {
+            "windowMs": self.window_seconds * 1000,
+            "maxBatch": self.max_batch,
+            "submitted": self.submitted,
+            "flushes": self.flushes,
+            "averageBatch": round(self.submitted / self.flushes, 2) if self.flushes else 0.0,
+            "largestBatch": self.largest_batch,
+            "pendingSets": len(self._pending)
+        }